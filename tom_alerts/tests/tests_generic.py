@@ -203,6 +203,30 @@ class TestBrokerViews(TestCase):
         self.assertEqual(Target.objects.count(), 2)
         self.assertRedirects(response, reverse('tom_targets:list'))
 
+    @override_settings(CACHES={
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            }
+        })
+    def test_create_target_existing_name(self):
+        Target.objects.create(name='HOTH', type=Target.SIDEREAL, ra=66, dec=50)
+        cache.set('alert_2', json.dumps(test_alerts[1]))
+        query = BrokerQuery.objects.create(
+            name='find hoth',
+            broker='TEST',
+            parameters='{"name": "Hoth"}',
+        )
+        post_data = {
+            'broker': 'TEST',
+            'query_id': query.id,
+            'alerts': [2]
+        }
+        response = self.client.post(reverse('tom_alerts:create-target'), data=post_data)
+        self.assertEqual(Target.objects.count(), 1)
+        self.assertRedirects(
+            response, reverse('tom_alerts:run', kwargs={'pk': query.id}), fetch_redirect_response=False
+        )
+
     def test_create_no_targets(self):
         query = BrokerQuery.objects.create(
             name='find anything',
@@ -15,6 +15,7 @@ from django_filters import FilterSet, ChoiceFilter, CharFilter
 
 from tom_alerts.models import BrokerQuery
 from tom_alerts.alerts import get_service_class, get_service_classes
+from tom_targets.models import Target
 
 
 class BrokerQueryCreateView(LoginRequiredMixin, FormView):
@@ -235,6 +236,10 @@ class CreateTargetFromAlertView(LoginRequiredMixin, View):
                 return redirect(reverse('tom_alerts:run', kwargs={'pk': query_id}))
             generic_alert = broker_class().to_generic_alert(json.loads(cached_alert))
             target = generic_alert.to_target()
+            if Target.objects.resolve(target.name).exists():
+                messages.warning(request, f'Unable to save {target.name}, target with that name already exists.')
+                errors.append(target.name)
+                continue
             try:
                 target.save()
                 broker_class().process_reduced_data(target, json.loads(cached_alert))
@@ -3,7 +3,7 @@ from django.shortcuts import redirect
 from django.contrib import messages
 from django.conf import settings
 
-from tom_common.exceptions import ImproperCredentialsException
+from tom_common.exceptions import ImproperCredentialsException, RateLimitedException
 
 
 class ExternalServiceMiddleware:
@@ -25,6 +25,9 @@ class ExternalServiceMiddleware:
             )
             messages.error(request, msg)
             return redirect(reverse('home'))
+        if isinstance(exception, RateLimitedException):
+            messages.error(request, '{} is receiving too many requests. Please try again later.'.format(str(exception)))
+            return redirect(reverse('home'))
         raise exception
 
 
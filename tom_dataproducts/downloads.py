@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+from django.conf import settings
+
+from tom_dataproducts.exceptions import DownloadError
+
+logger = logging.getLogger(__name__)
+
+try:
+    DOWNLOAD_WORKERS = settings.DATA_PRODUCT_DOWNLOAD_WORKERS
+except AttributeError:
+    DOWNLOAD_WORKERS = 4
+
+try:
+    DOWNLOAD_DIR = settings.DATA_PRODUCT_DOWNLOAD_DIR
+except AttributeError:
+    DOWNLOAD_DIR = os.path.join(tempfile.gettempdir(), 'tom_downloads')
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+UNSAFE_FILENAME_CHARACTERS = re.compile(r'[^\w.-]')
+
+
+def staging_path(key, filename, directory=None):
+    """
+    Returns the path at which a download is staged before it is saved to its ``DataProduct``. The path only depends
+    on the key and filename of the download, so that an interrupted download is resumed by the next attempt.
+
+    :param key: key identifying the download, such as the facility name and product id
+    :type key: str
+
+    :param filename: name of the downloaded file
+    :type filename: str
+
+    :param directory: staging directory, defaults to ``DATA_PRODUCT_DOWNLOAD_DIR``
+    :type directory: str
+
+    :rtype: str
+    """
+    name = UNSAFE_FILENAME_CHARACTERS.sub('_', '{0}_{1}'.format(key, os.path.basename(filename)))
+    return os.path.join(directory or DOWNLOAD_DIR, name)
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def download_file(session, url, path, size=None, md5=None):
+    """
+    Streams a file to ``path`` in chunks. The file is written to ``path`` with a ``.part`` suffix first, and a partial
+    file left by an earlier attempt is resumed with a range request when the server supports it. The download is
+    verified against ``size`` and ``md5`` when they are given, and otherwise against the length sent by the server.
+
+    :param session: HTTP session to download with
+    :type session: requests.Session
+
+    :param url: URL of the file
+    :type url: str
+
+    :param path: path to save the file to
+    :type path: str
+
+    :param size: expected size of the file in bytes
+    :type size: int
+
+    :param md5: expected MD5 checksum of the file, as a hexadecimal string
+    :type md5: str
+
+    :returns: path of the downloaded file
+    :rtype: str
+
+    :raises DownloadError: if the downloaded file does not match its expected size or checksum
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    part_path = path + '.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if size is not None and offset > size:
+        offset = 0
+    headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
+
+    with session.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 416:
+            # The partial file cannot be resumed, so the download starts over
+            os.remove(part_path)
+            return download_file(session, url, path, size=size, md5=md5)
+        response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0
+        expected_size = size
+        if expected_size is None and response.headers.get('Content-Length'):
+            expected_size = offset + int(response.headers['Content-Length'])
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+    actual_size = os.path.getsize(part_path)
+    if expected_size is not None and actual_size != expected_size:
+        if actual_size > expected_size:
+            os.remove(part_path)
+        raise DownloadError('Downloaded {0} of {1} bytes of {2}'.format(actual_size, expected_size, url))
+    if md5 and file_md5(part_path) != md5.lower():
+        os.remove(part_path)
+        raise DownloadError('Checksum of {0} does not match'.format(url))
+    os.replace(part_path, path)
+    return path
+
+
+def download_files(session, downloads, workers=None):
+    """
+    Downloads files concurrently with a bounded pool of ``DATA_PRODUCT_DOWNLOAD_WORKERS`` threads, yielding each
+    download as it finishes. The downloads only write to the staging files, so that the caller can save the results
+    to the database from its own thread as they are yielded.
+
+    :param session: HTTP session to download with
+    :type session: requests.Session
+
+    :param downloads: dictionaries with the ``url`` and ``path`` of each file, and optionally its ``size`` and ``md5``
+    :type downloads: list
+
+    :param workers: number of concurrent downloads, defaults to ``DATA_PRODUCT_DOWNLOAD_WORKERS``
+    :type workers: int
+
+    :returns: iterator of (download, error) tuples, where error is None for successful downloads
+    :rtype: iterator
+    """
+    if not downloads:
+        return
+    executor = ThreadPoolExecutor(max_workers=workers or DOWNLOAD_WORKERS)
+    try:
+        futures = {
+            executor.submit(
+                download_file, session, download['url'], download['path'], download.get('size'), download.get('md5')
+            ): download for download in downloads
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+                yield futures[future], None
+            except Exception as e:
+                logger.warning('Failed to download {0}: {1}'.format(futures[future]['url'], e))
+                yield futures[future], e
+    finally:
+        executor.shutdown(wait=False)
@@ -1,2 +1,6 @@
 class InvalidFileFormatException(Exception):
     pass
+
+
+class DownloadError(Exception):
+    pass
@@ -1,19 +1,27 @@
 from django.core.management.base import BaseCommand
-from tom_observations import facility
-from tom_observations.models import ObservationRecord
+
+from tom_dataproducts.sync import sync_data_products
+from tom_observations.sync import sync_observation_statuses
 
 
 class Command(BaseCommand):
-    help = 'Downloads data for all completed observations'
+    help = 'Downloads new data products of the observations that can still produce data'
 
-    def handle(self, *args, **options):
-        facility_classes = {}
-        for facility_name in facility.get_service_classes():
-            facility_classes[facility_name] = facility.get_service_class(facility_name)()
-        observation_records = ObservationRecord.objects.all()
-        for record in observation_records:
-            if record.status not in facility_classes[record.facility].get_terminal_observing_states():
-                facility_classes[record.facility].update_observation_status(record.observation_id)
-                facility_classes[record.facility].save_data_products(record)
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--facility',
+            action='append',
+            help='Only download data products of this facility, can be given several times'
+        )
 
-        return 'completed command'
+    def handle(self, *args, **options):
+        status_report = sync_observation_statuses(facility_names=options['facility'])
+        self.stdout.write(str(status_report))
+        report = sync_data_products(facility_names=options['facility'])
+        self.stdout.write(str(report))
+        if status_report.success and report.success:
+            return 'completed command'
+        else:
+            return 'completed command with errors: statuses {0}, data products {1}'.format(
+                status_report.failed_records, report.failed_records
+            )
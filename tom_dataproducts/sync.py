@@ -0,0 +1,122 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+import logging
+
+from django.conf import settings
+from django.db.models import DateTimeField, ExpressionWrapper, F, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from tom_dataproducts.downloads import DOWNLOAD_WORKERS
+from tom_dataproducts.models import DataProduct
+from tom_observations.facility import get_service_classes
+from tom_observations.models import ObservationRecord
+
+logger = logging.getLogger(__name__)
+
+try:
+    ARCHIVE_WINDOW = timedelta(days=settings.DATA_PRODUCT_ARCHIVE_WINDOW)
+except AttributeError:
+    ARCHIVE_WINDOW = timedelta(days=7)
+
+
+def archive_candidates():
+    """
+    Returns the observations that can still produce new data products: those that have not reached a terminal state,
+    and those that have not been checked since ``DATA_PRODUCT_ARCHIVE_WINDOW`` days after their end, or after their
+    last status change if their end is unknown.
+
+    :rtype: QuerySet
+    """
+    data_until = ExpressionWrapper(
+        Coalesce('scheduled_end', 'modified') + ARCHIVE_WINDOW, output_field=DateTimeField()
+    )
+    return ObservationRecord.objects.annotate(data_until=data_until).filter(
+        Q(terminal=False) | Q(archive_checked__isnull=True) | Q(archive_checked__lt=F('data_until'))
+    )
+
+
+class ArchiveSyncReport:
+    """
+    Summary of a data product synchronization: for each facility, the number of observations checked, the number of
+    new data products saved and the observations that failed.
+    """
+
+    def __init__(self):
+        self.facilities = {}
+
+    def facility(self, facility_name):
+        return self.facilities.setdefault(facility_name, {'checked': 0, 'saved': 0, 'failed': []})
+
+    @property
+    def failed_records(self):
+        return {name: summary['failed'] for name, summary in self.facilities.items()}
+
+    @property
+    def success(self):
+        return not any(summary['failed'] for summary in self.facilities.values())
+
+    def __str__(self):
+        return '\n'.join(
+            '{0}: {1} observations checked, {2} data products saved, {3} failed'.format(
+                name, summary['checked'], summary['saved'], len(summary['failed'])
+            ) for name, summary in self.facilities.items()
+        )
+
+
+def sync_data_products(facility_names=None, workers=None):
+    """
+    Saves the new data products of every observation that can still produce data. The data product listings of the
+    observations are requested concurrently, with a bounded pool of ``DATA_PRODUCT_DOWNLOAD_WORKERS`` threads, and
+    only products that have not been saved yet are downloaded. Each observation that is checked successfully records
+    the time of the check, which excludes it from later runs once its data can no longer change.
+
+    :param facility_names: only check the observations of these facilities, rather than of all facilities
+    :type facility_names: list
+
+    :param workers: number of concurrent listing requests, defaults to ``DATA_PRODUCT_DOWNLOAD_WORKERS``
+    :type workers: int
+
+    :returns: summary of the synchronization
+    :rtype: ArchiveSyncReport
+    """
+    report = ArchiveSyncReport()
+    facilities = {
+        name: facility_class() for name, facility_class in get_service_classes().items()
+        if facility_names is None or name in facility_names
+    }
+    records = archive_candidates().filter(facility__in=facilities)
+    saved = set(
+        DataProduct.objects.filter(observation_record__in=records.values('pk'), product_id__isnull=False)
+        .exclude(data='').values_list('observation_record_id', 'product_id')
+    )
+    records = list(records)
+    if not records:
+        return report
+
+    executor = ThreadPoolExecutor(max_workers=workers or DOWNLOAD_WORKERS)
+    try:
+        futures = {
+            executor.submit(facilities[record.facility].data_products, record.observation_id): record
+            for record in records
+        }
+        for future in as_completed(futures):
+            record = futures[future]
+            summary = report.facility(record.facility)
+            try:
+                products = future.result()
+                new_products = [product for product in products if (record.id, str(product['id'])) not in saved]
+                if new_products:
+                    facilities[record.facility].store_data_products(record, new_products)
+            except Exception as e:
+                logger.warning('Failed to save data products of {0} observation {1}: {2}'.format(
+                    record.facility, record.observation_id, e
+                ))
+                summary['failed'].append((record.observation_id, str(e)))
+                continue
+            ObservationRecord.objects.filter(pk=record.pk).update(archive_checked=timezone.now())
+            summary['checked'] += 1
+            summary['saved'] += len(new_products)
+    finally:
+        executor.shutdown(wait=False)
+    return report
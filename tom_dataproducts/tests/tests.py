@@ -1,8 +1,13 @@
+import hashlib
 import json
 import os
 import tempfile
+from datetime import timedelta
+from io import StringIO
 
+from django.core.management import call_command
 from django.test import TestCase, override_settings
+from django.utils import timezone
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
@@ -15,14 +20,18 @@ from astropy.io import fits
 from astropy.table import Table
 import numpy as np
 
-from tom_observations.tests.utils import FakeFacility
+from tom_observations.sessions import get_session
+from tom_observations.tests.utils import FakeFacility, StubFileServer
 from tom_observations.tests.factories import TargetFactory, ObservingRecordFactory
 from tom_dataproducts.models import DataProduct, is_fits_image_file
 from tom_dataproducts.forms import DataProductUploadForm
 from tom_dataproducts.processors.photometry_processor import PhotometryProcessor
 from tom_dataproducts.processors.spectroscopy_processor import SpectroscopyProcessor
 from tom_dataproducts.processors.data_serializers import SpectrumSerializer
-from tom_dataproducts.exceptions import InvalidFileFormatException
+from tom_dataproducts.downloads import download_file
+from tom_dataproducts.exceptions import DownloadError, InvalidFileFormatException
+from tom_dataproducts.sync import sync_data_products
+from tom_observations.models import ObservationRecord
 from tom_dataproducts.utils import create_image_dataproduct
 from guardian.shortcuts import assign_perm
 
@@ -146,6 +155,147 @@ class Views(TestCase):
         self.assertEqual(products.count(), 1)
 
 
+@override_settings(TOM_FACILITY_CLASSES=['tom_observations.tests.utils.FakeFacility'])
+class TestDownloadDataProducts(TestCase):
+    def setUp(self):
+        self.target = TargetFactory.create()
+        self.observation_record = ObservingRecordFactory.create(
+            target_id=self.target.id,
+            facility=FakeFacility.name,
+            parameters='{}'
+        )
+        self.files = {'/frames/{0}.fits'.format(i): os.urandom(3000 + i) for i in range(3)}
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        patcher = patch('tom_dataproducts.downloads.DOWNLOAD_DIR', self.tmpdir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def products(self, server, checksums=None):
+        checksums = checksums or {}
+        return [{
+            'id': 'frame{0}'.format(i),
+            'filename': 'frame{0}.fits'.format(i),
+            'url': server.url + path,
+            'size': len(content),
+            'md5': checksums.get(path, hashlib.md5(content).hexdigest()),
+        } for i, (path, content) in enumerate(sorted(self.files.items()))]
+
+    def test_save_data_products(self):
+        with StubFileServer(self.files) as server:
+            with patch.object(FakeFacility, 'data_products', return_value=self.products(server)):
+                products = FakeFacility().save_data_products(self.observation_record)
+                # Data products that were already downloaded are not downloaded again
+                self.assertEqual(FakeFacility().save_data_products(self.observation_record), products)
+        self.assertEqual(server.request_count, 3)
+        for i, product in enumerate(products):
+            self.assertEqual(product.product_id, 'frame{0}'.format(i))
+            self.assertEqual(product.data.read(), self.files['/frames/{0}.fits'.format(i)])
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_save_data_products_checksum_mismatch(self):
+        with StubFileServer(self.files) as server:
+            products = self.products(server, checksums={'/frames/1.fits': 'bad'})
+            with patch.object(FakeFacility, 'data_products', return_value=products):
+                with self.assertRaises(DownloadError):
+                    FakeFacility().save_data_products(self.observation_record)
+        # No data product is created for the file that failed, so it is not mistaken for a saved one
+        saved = DataProduct.objects.filter(observation_record=self.observation_record).order_by('product_id')
+        self.assertEqual([dp.product_id for dp in saved], ['frame0', 'frame2'])
+        self.assertTrue(all(dp.data for dp in saved))
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+        with StubFileServer(self.files) as server:
+            with patch.object(FakeFacility, 'data_products', return_value=self.products(server)):
+                products = FakeFacility().save_data_products(self.observation_record)
+        self.assertEqual(server.request_count, 1)
+        self.assertEqual([dp.product_id for dp in products], ['frame0', 'frame1', 'frame2'])
+        self.assertEqual(products[1].data.read(), self.files['/frames/1.fits'])
+
+    def test_download_resumes_partial_file(self):
+        content = self.files['/frames/0.fits']
+        path = os.path.join(self.tmpdir.name, 'frame0.fits')
+        with open(path + '.part', 'wb') as f:
+            f.write(content[:1000])
+        with StubFileServer(self.files) as server:
+            download_file(
+                get_session(FakeFacility.name), server.url + '/frames/0.fits', path, size=len(content),
+                md5=hashlib.md5(content).hexdigest()
+            )
+        self.assertEqual(server.ranges, ['bytes=1000-'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(path + '.part'))
+
+
+@override_settings(TOM_FACILITY_CLASSES=['tom_observations.tests.utils.FakeFacility'])
+class TestSyncDataProducts(TestCase):
+    def setUp(self):
+        self.target = TargetFactory.create()
+        long_ago = timezone.now() - timedelta(days=30)
+        self.pending = self.create_record('pending', 'PENDING')
+        self.recent = self.create_record('recent', 'COMPLETED', scheduled_end=timezone.now())
+        self.old = self.create_record('old', 'COMPLETED', scheduled_end=long_ago)
+        self.old_checked = self.create_record('old_checked', 'COMPLETED', scheduled_end=long_ago)
+        ObservationRecord.objects.filter(pk=self.old_checked.pk).update(archive_checked=timezone.now())
+        self.files = {'/{0}.fits'.format(record.observation_id): b'data' for record in [self.pending, self.recent]}
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        patcher = patch('tom_dataproducts.downloads.DOWNLOAD_DIR', self.tmpdir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_record(self, observation_id, status, scheduled_end=None):
+        return ObservingRecordFactory.create(
+            target_id=self.target.id, facility=FakeFacility.name, observation_id=observation_id, status=status,
+            scheduled_end=scheduled_end, parameters='{}'
+        )
+
+    def data_products(self, server):
+        def data_products(observation_id, product_id=None):
+            path = '/{0}.fits'.format(observation_id)
+            if path not in self.files:
+                return []
+            return [{'id': observation_id, 'filename': observation_id + '.fits', 'url': server.url + path}]
+        return data_products
+
+    def test_sync_data_products(self):
+        with StubFileServer(self.files) as server:
+            with patch.object(FakeFacility, 'data_products', side_effect=self.data_products(server)) as dp_mock:
+                report = sync_data_products()
+                summary = report.facilities[FakeFacility.name]
+                self.assertEqual((summary['checked'], summary['saved']), (3, 2))
+                # Observations that finished long before their last check are not listed again
+                self.assertEqual(
+                    sorted(call[0][0] for call in dp_mock.call_args_list), ['old', 'pending', 'recent']
+                )
+                self.assertEqual(server.request_count, 2)
+
+                dp_mock.reset_mock()
+                report = sync_data_products()
+                self.assertEqual(report.facilities[FakeFacility.name]['saved'], 0)
+                self.assertEqual(sorted(call[0][0] for call in dp_mock.call_args_list), ['pending', 'recent'])
+                self.assertEqual(server.request_count, 2)
+        record = ObservationRecord.objects.get(pk=self.recent.pk)
+        self.assertIsNotNone(record.archive_checked)
+        self.assertEqual(DataProduct.objects.get(product_id='recent').data.read(), b'data')
+
+    def test_sync_data_products_failure_is_retried(self):
+        with patch.object(FakeFacility, 'data_products', side_effect=ValueError('archive down')):
+            report = sync_data_products()
+        self.assertFalse(report.success)
+        self.assertEqual(len(report.facilities[FakeFacility.name]['failed']), 3)
+        self.assertIsNone(ObservationRecord.objects.get(pk=self.old.pk).archive_checked)
+
+    def test_downloaddata_command(self):
+        out = StringIO()
+        with patch.object(FakeFacility, 'data_products', return_value=[]):
+            call_command('downloaddata', stdout=out)
+        self.assertIn('FakeFacility: 3 observations checked, 0 data products saved, 0 failed', out.getvalue())
+        # The status of the pending observation is updated first
+        self.assertEqual(ObservationRecord.objects.get(pk=self.pending.pk).status, 'COMPLETED')
+
+
 @override_settings(TOM_FACILITY_CLASSES=['tom_observations.tests.utils.FakeFacility'])
 @patch('tom_dataproducts.views.run_data_processor')
 class TestUploadDataProducts(TestCase):
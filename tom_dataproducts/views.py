@@ -20,7 +20,7 @@ from django_filters.views import FilterView
 from guardian.shortcuts import get_objects_for_user
 
 from .models import DataProduct, DataProductGroup, ReducedDatum
-from .exceptions import InvalidFileFormatException
+from .exceptions import DownloadError, InvalidFileFormatException
 from .forms import AddProductToGroupForm, DataProductUploadForm
 from .filters import DataProductFilter
 from .data_processor import run_data_processor
@@ -46,23 +46,26 @@ class DataProductSaveView(LoginRequiredMixin, View):
         service_class = get_service_class(request.POST['facility'])
         observation_record = ObservationRecord.objects.get(pk=kwargs['pk'])
         products = request.POST.getlist('products')
-        if not products:
-            messages.warning(request, 'No products were saved, please select at least one dataproduct')
-        elif products[0] == 'ALL':
-            products = service_class().save_data_products(observation_record)
-            messages.success(request, 'Saved all available data products')
-        else:
-            for product in products:
-                products = service_class().save_data_products(
-                    observation_record,
-                    product
-                )
-                messages.success(
-                    request,
-                    'Successfully saved: {0}'.format('\n'.join(
-                        [str(p) for p in products]
-                    ))
-                )
+        try:
+            if not products:
+                messages.warning(request, 'No products were saved, please select at least one dataproduct')
+            elif products[0] == 'ALL':
+                products = service_class().save_data_products(observation_record)
+                messages.success(request, 'Saved all available data products')
+            else:
+                for product in products:
+                    products = service_class().save_data_products(
+                        observation_record,
+                        product
+                    )
+                    messages.success(
+                        request,
+                        'Successfully saved: {0}'.format('\n'.join(
+                            [str(p) for p in products]
+                        ))
+                    )
+        except DownloadError as e:
+            messages.error(request, '{0}, please try again'.format(e))
         return redirect(reverse(
             'tom_observations:detail',
             kwargs={'pk': observation_record.id})
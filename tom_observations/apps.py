@@ -1,5 +1,18 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class TomObservationsConfig(AppConfig):
     name = 'tom_observations'
+
+    def ready(self):
+        from tom_observations.templatetags.observation_extras import observation_distribution_changed
+        for sender in ['tom_observations.ObservationRecord', 'tom_targets.Target']:
+            post_save.connect(
+                observation_distribution_changed, sender=sender,
+                dispatch_uid='observation_distribution_saved_{0}'.format(sender)
+            )
+            post_delete.connect(
+                observation_distribution_changed, sender=sender,
+                dispatch_uid='observation_distribution_deleted_{0}'.format(sender)
+            )
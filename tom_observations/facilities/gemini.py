@@ -1,4 +1,3 @@
-import requests
 from django.conf import settings
 from django import forms
 from dateutil.parser import parse
@@ -6,7 +5,8 @@ from crispy_forms.layout import Layout, Div, HTML
 from astropy import units as u
 
 from tom_observations.facility import GenericObservationForm
-from tom_common.exceptions import ImproperCredentialsException
+from tom_common.exceptions import ImproperCredentialsException, RateLimitedException
+from tom_observations.sessions import get_session
 from tom_observations.facility import GenericObservationFacility
 from tom_targets.models import Target
 
@@ -59,7 +59,9 @@ SITES = {
 
 
 def make_request(*args, **kwargs):
-    response = requests.request(*args, **kwargs)
+    response = get_session('GEM').request(*args, **kwargs)
+    if response.status_code == 429:
+        raise RateLimitedException('GEM')
     if 400 <= response.status_code < 500:
         print('Request failed: {}'.format(response.content))
         raise ImproperCredentialsException('GEM')
@@ -1,13 +1,16 @@
-import requests
 from django.conf import settings
 from django import forms
 from dateutil.parser import parse
+from datetime import timedelta
 from crispy_forms.layout import Layout, Div
 from django.core.cache import cache
+from django.utils import timezone
 from astropy import units as u
 
 from tom_observations.facility import GenericObservationForm
-from tom_common.exceptions import ImproperCredentialsException
+from tom_common.exceptions import ImproperCredentialsException, RateLimitedException
+from tom_observations.metadata import get_metadata, register_metadata
+from tom_observations.sessions import get_session
 from tom_observations.facility import GenericObservationFacility, get_service_class
 from tom_targets.models import (
     Target, REQUIRED_NON_SIDEREAL_FIELDS,
@@ -26,6 +29,8 @@ except (AttributeError, KeyError):
 # Module specific settings.
 PORTAL_URL = LCO_SETTINGS['portal_url']
 TERMINAL_OBSERVING_STATES = ['COMPLETED', 'CANCELED', 'WINDOW_EXPIRED']
+# Requests modified within this time are listed in batch status requests, older ones are requested individually
+STATUS_LISTING_WINDOW = timedelta(days=7)
 
 # Units of flux and wavelength for converting to Specutils Spectrum1D objects
 FLUX_CONSTANT = (1e-15 * u.erg) / (u.cm ** 2 * u.second * u.angstrom)
@@ -40,13 +45,43 @@ FITS_FACILITY_DATE_OBS_KEYWORD = 'DATE-OBS'
 
 
 def make_request(*args, **kwargs):
-    response = requests.request(*args, **kwargs)
+    response = get_session('LCO').request(*args, **kwargs)
+    if response.status_code == 429:
+        raise RateLimitedException('LCO')
     if 400 <= response.status_code < 500:
         raise ImproperCredentialsException('LCO: ' + str(response.content))
     response.raise_for_status()
     return response
 
 
+def get_instruments():
+    """
+    Requests the instruments available at LCO and SOAR from the observation portal.
+    """
+    response = make_request(
+        'GET',
+        PORTAL_URL + '/api/instruments/',
+        headers={'Authorization': 'Token {0}'.format(LCO_SETTINGS['api_key'])}
+    )
+    return response.json()
+
+
+def get_proposals():
+    """
+    Requests the proposals of the user from the observation portal.
+    """
+    response = make_request(
+        'GET',
+        PORTAL_URL + '/api/profile/',
+        headers={'Authorization': 'Token {0}'.format(LCO_SETTINGS['api_key'])}
+    )
+    return response.json()['proposals']
+
+
+register_metadata('lco_instruments', get_instruments)
+register_metadata('lco_proposals', get_proposals)
+
+
 class LCOBaseObservationForm(GenericObservationForm):
     name = forms.CharField()
     ipp_value = forms.FloatField()
@@ -88,18 +123,8 @@ class LCOBaseObservationForm(GenericObservationForm):
         return Div()
 
     def _get_instruments(self):
-        cached_instruments = cache.get('lco_instruments')
-
-        if not cached_instruments:
-            response = make_request(
-                'GET',
-                PORTAL_URL + '/api/instruments/',
-                headers={'Authorization': 'Token {0}'.format(LCO_SETTINGS['api_key'])}
-            )
-            cached_instruments = {k: v for k, v in response.json().items() if 'SOAR' not in k}
-            cache.set('lco_instruments', cached_instruments)
-
-        return cached_instruments
+        instruments = get_metadata('lco_instruments', default={})
+        return {k: v for k, v in instruments.items() if 'SOAR' not in k}
 
     def instrument_choices(self):
         return [(k, v['name']) for k, v in self._get_instruments().items()]
@@ -111,13 +136,8 @@ class LCOBaseObservationForm(GenericObservationForm):
             ])
 
     def proposal_choices(self):
-        response = make_request(
-            'GET',
-            PORTAL_URL + '/api/profile/',
-            headers={'Authorization': 'Token {0}'.format(LCO_SETTINGS['api_key'])}
-        )
         choices = []
-        for p in response.json()['proposals']:
+        for p in get_metadata('lco_proposals', default=[]):
             if p['current']:
                 choices.append((p['id'], '{} ({})'.format(p['title'], p['id'])))
         return choices
@@ -431,30 +451,56 @@ class LCOFacility(GenericObservationFacility):
             PORTAL_URL + '/api/requests/{0}/observations/'.format(observation_id),
             headers=self._portal_headers()
         )
-        blocks = response.json()
-        current_block = None
-        for block in blocks:
-            if block['state'] == 'COMPLETED':
-                current_block = block
-                break
-            elif block['state'] == 'PENDING':
-                current_block = block
-        if current_block:
-            scheduled_start = current_block['start']
-            scheduled_end = current_block['end']
-        else:
-            scheduled_start, scheduled_end = None, None
+        scheduled_start, scheduled_end = self._scheduled_times(response.json())
 
         return {'state': state, 'scheduled_start': scheduled_start, 'scheduled_end': scheduled_end}
 
+    def get_observation_statuses(self, observation_ids):
+        """
+        Returns the statuses of the requests that are pending or were modified in the last ``STATUS_LISTING_WINDOW``,
+        from listings of request groups and observation blocks, so that only a few paged calls are needed however many
+        requests there are. Scheduled times are taken from the blocks as by ``get_observation_status``. Requests that
+        were last modified before the window are omitted, and requested individually.
+        """
+        observation_ids = set(str(observation_id) for observation_id in observation_ids)
+        modified_after = (timezone.now() - STATUS_LISTING_WINDOW).strftime('%Y-%m-%dT%H:%M:%S')
+        pending, recent = 'state=PENDING', 'modified_after={0}'.format(modified_after)
+
+        states = {}
+        for query in (pending, recent):
+            for requestgroup in self._portal_listing('/api/requestgroups/?{0}&limit=1000'.format(query)):
+                for request in requestgroup['requests']:
+                    # Only pending and recently modified requests have all of their current blocks in the listings
+                    if str(request['id']) in observation_ids and (query == recent or request['state'] == 'PENDING'):
+                        states[str(request['id'])] = request['state']
+        if not states:
+            return {}
+
+        blocks = {request_id: {} for request_id in states}
+        for query in (pending, recent):
+            for block in self._portal_listing('/api/observations/?{0}&limit=1000'.format(query)):
+                request_blocks = blocks.get(str(block['request']['id']))
+                if request_blocks is not None:
+                    request_blocks[block['id']] = block
+
+        statuses = {}
+        for request_id, state in states.items():
+            scheduled_start, scheduled_end = self._scheduled_times(blocks[request_id].values())
+            statuses[request_id] = {'state': state, 'scheduled_start': scheduled_start, 'scheduled_end': scheduled_end}
+        return statuses
+
     def data_products(self, observation_id, product_id=None):
         products = []
         for frame in self._archive_frames(observation_id, product_id):
+            # Checksums are only known unambiguously for frames with a single version
+            versions = frame.get('version_set') or []
             products.append({
                 'id': frame['id'],
                 'filename': frame['filename'],
                 'created': parse(frame['DATE_OBS']),
-                'url': frame['url']
+                'url': frame['url'],
+                'size': frame.get('filesize'),
+                'md5': versions[0].get('md5') if len(versions) == 1 else None,
             })
         return products
 
@@ -467,6 +513,32 @@ class LCOFacility(GenericObservationFacility):
         else:
             return {}
 
+    def _scheduled_times(self, blocks):
+        # The completed block if there is one, and otherwise the latest pending block
+        current_block = None
+        for block in blocks:
+            if block['state'] == 'COMPLETED':
+                current_block = block
+                break
+            elif block['state'] == 'PENDING' and (current_block is None or block['start'] > current_block['start']):
+                current_block = block
+        if current_block:
+            return current_block['start'], current_block['end']
+        return None, None
+
+    def _portal_listing(self, path):
+        results = []
+        url = PORTAL_URL + path
+        while url:
+            response = make_request(
+                'GET',
+                url,
+                headers=self._portal_headers()
+            )
+            results.extend(response.json()['results'])
+            url = response.json()['next']
+        return results
+
     def _archive_headers(self):
         if LCO_SETTINGS.get('api_key'):
             archive_token = cache.get('LCO_ARCHIVE_TOKEN')
@@ -1,10 +1,10 @@
-import requests
 from django.conf import settings
-from django.core.cache import cache
 
 from tom_observations.facilities.lco import LCOFacility, LCOBaseObservationForm
 from tom_observations.facilities.lco import LCOImagingObservationForm, LCOSpectroscopyObservationForm
-from tom_common.exceptions import ImproperCredentialsException
+from tom_common.exceptions import ImproperCredentialsException, RateLimitedException
+from tom_observations.metadata import get_metadata
+from tom_observations.sessions import get_session
 
 
 # Determine settings for this module.
@@ -25,7 +25,9 @@ SPECTRAL_GRATING = 'SYZY_400'
 
 
 def make_request(*args, **kwargs):
-    response = requests.request(*args, **kwargs)
+    response = get_session('SOAR').request(*args, **kwargs)
+    if response.status_code == 429:
+        raise RateLimitedException('SOAR')
     if 400 <= response.status_code < 500:
         raise ImproperCredentialsException('SOAR: ' + str(response.content))
     response.raise_for_status()
@@ -35,19 +37,8 @@ def make_request(*args, **kwargs):
 class SOARBaseObservationForm(LCOBaseObservationForm):
 
     def _get_instruments(self):
-        cached_instruments = cache.get('soar_instruments')
-
-        if not cached_instruments:
-            response = make_request(
-                'GET',
-                PORTAL_URL + '/api/instruments/',
-                headers={'Authorization': 'Token {0}'.format(LCO_SETTINGS['api_key'])}
-            )
-
-            cached_instruments = {k: v for k, v in response.json().items() if 'SOAR' in k}
-            cache.set('soar_instruments', cached_instruments)
-
-        return cached_instruments
+        instruments = get_metadata('lco_instruments', default={})
+        return {k: v for k, v in instruments.items() if 'SOAR' in k}
 
     def instrument_to_type(self, instrument_type):
         if 'IMAGER' in instrument_type:
@@ -1,14 +1,18 @@
 from importlib import import_module
 import json
-import requests
 from abc import ABC, abstractmethod
 from crispy_forms.helper import FormHelper
+from dateutil.parser import parse
 from crispy_forms.layout import Submit, Layout
 from django import forms
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.core.files import File
+from django.utils import timezone
 import logging
+import os
 
+from tom_observations.sessions import get_session
 from tom_targets.models import Target
 
 logger = logging.getLogger(__name__)
@@ -24,6 +28,28 @@ try:
 except AttributeError:
     AUTO_THUMBNAILS = False
 
+try:
+    DATA_PRODUCT_LIST_CACHE_TIMEOUT = settings.DATA_PRODUCT_LIST_CACHE_TIMEOUT
+except AttributeError:
+    DATA_PRODUCT_LIST_CACHE_TIMEOUT = 300
+
+
+def to_datetime(value):
+    """
+    Converts a time reported by a facility, as a datetime or an ISO 8601 string, to the datetime it is stored as, so
+    that unchanged times compare equal to the values loaded from the database.
+
+    :param value: the time, or None
+    :type value: datetime or str
+
+    :rtype: datetime
+    """
+    if isinstance(value, str):
+        value = parse(value)
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
 
 def get_service_classes():
     try:
@@ -70,35 +96,87 @@ class GenericObservationFacility(ABC):
         try:
             record = ObservationRecord.objects.get(observation_id=observation_id)
             status = self.get_observation_status(observation_id)
-            record.status = status['state']
-            record.scheduled_start = status['scheduled_start']
-            record.scheduled_end = status['scheduled_end']
-            record.save()
+            self.apply_observation_status(record, status)
         except ObservationRecord.DoesNotExist:
             raise Exception('No record exists for that observation id')
 
+    def apply_observation_status(self, record, status):
+        """
+        Stores a status, as returned by ``get_observation_status``, on an ``ObservationRecord`` and saves it.
+
+        :param record: the record to update
+        :type record: ObservationRecord
+
+        :param status: dictionary with the ``state``, ``scheduled_start`` and ``scheduled_end`` of the observation
+        :type status: dict
+
+        :returns: whether the state of the observation changed
+        :rtype: bool
+        """
+        changed = record.status != status['state']
+        record.status = status['state']
+        record.scheduled_start = to_datetime(status['scheduled_start'])
+        record.scheduled_end = to_datetime(status['scheduled_end'])
+        record.save()
+        return changed
+
     def update_all_observation_statuses(self, target=None):
         from tom_observations.models import ObservationRecord
         failed_records = []
         records = ObservationRecord.objects.filter(facility=self.name)
         if target:
             records = records.filter(target=target)
-        records = records.exclude(status__in=self.get_terminal_observing_states())
+        records = list(records.filter(terminal=False))
+        if not records:
+            return failed_records
+        try:
+            statuses = self.get_observation_statuses([record.observation_id for record in records])
+        except NotImplementedError:
+            statuses = {}
+        except Exception as e:
+            logger.warning('Batch status request to {0} failed, requesting statuses individually: {1}'.format(
+                self.name, e
+            ))
+            statuses = {}
         for record in records:
             try:
-                self.update_observation_status(record.observation_id)
+                if record.observation_id in statuses:
+                    self.apply_observation_status(record, statuses[record.observation_id])
+                else:
+                    self.update_observation_status(record.observation_id)
             except Exception as e:
                 failed_records.append((record.observation_id, str(e)))
         return failed_records
 
+    def cached_data_products(self, observation_record):
+        """
+        Returns the data products of an observation, as returned by ``data_products``, from the cache if they were
+        listed less than ``DATA_PRODUCT_LIST_CACHE_TIMEOUT`` seconds ago.
+
+        :param observation_record: the observation to list the data products of
+        :type observation_record: ObservationRecord
+
+        :rtype: list
+        """
+        cache_key = 'data_products_{0}_{1}'.format(self.name, observation_record.observation_id)
+        products = cache.get(cache_key)
+        if products is None:
+            products = self.data_products(observation_record.observation_id)
+            cache.set(cache_key, products, DATA_PRODUCT_LIST_CACHE_TIMEOUT)
+        return products
+
     def all_data_products(self, observation_record):
         from tom_dataproducts.models import DataProduct
         products = {'saved': [], 'unsaved': []}
-        for product in self.data_products(observation_record.observation_id):
-            try:
-                dp = DataProduct.objects.get(product_id=product['id'])
+        facility_products = self.cached_data_products(observation_record)
+        saved_products = DataProduct.objects.in_bulk(
+            [str(product['id']) for product in facility_products], field_name='product_id'
+        )
+        for product in facility_products:
+            dp = saved_products.get(str(product['id']))
+            if dp:
                 products['saved'].append(dp)
-            except DataProduct.DoesNotExist:
+            else:
                 products['unsaved'].append(product)
         # Obtain products uploaded manually by users
         user_products = DataProduct.objects.filter(
@@ -116,27 +194,88 @@ class GenericObservationFacility(ABC):
         return products
 
     def save_data_products(self, observation_record, product_id=None):
+        """
+        Saves the data products of an observation, as returned by ``data_products``, as ``DataProduct`` objects.
+        Products that have not been downloaded yet are streamed to disk concurrently, resuming any download that was
+        interrupted earlier, and verified against the ``size`` and ``md5`` of the product when the facility provides
+        them.
+
+        :param observation_record: the observation to save the data products of
+        :type observation_record: ObservationRecord
+
+        :param product_id: only save the data product with this id
+        :type product_id: str
+
+        :returns: the saved data products
+        :rtype: list
+
+        :raises DownloadError: if any of the data products could not be downloaded, after saving all others. No
+            ``DataProduct`` is created for the products that failed, so that they are downloaded again by a later call
+        """
+        products = self.data_products(observation_record.observation_id, product_id)
+        return self.store_data_products(observation_record, products)
+
+    def store_data_products(self, observation_record, products):
+        """
+        Saves already listed data products of an observation as ``DataProduct`` objects, downloading those that have
+        not been downloaded yet. See ``save_data_products``.
+
+        :param observation_record: the observation to save the data products of
+        :type observation_record: ObservationRecord
+
+        :param products: data products as returned by ``data_products``
+        :type products: list
+
+        :returns: the saved data products
+        :rtype: list
+        """
+        from tom_dataproducts.downloads import download_files, staging_path
+        from tom_dataproducts.exceptions import DownloadError
         from tom_dataproducts.models import DataProduct
         from tom_dataproducts.utils import create_image_dataproduct
-        final_products = []
-        products = self.data_products(observation_record.observation_id, product_id)
+        data_products = []
+        downloads = []
 
+        saved_products = DataProduct.objects.in_bulk(
+            [str(product['id']) for product in products], field_name='product_id'
+        )
         for product in products:
-            dp, created = DataProduct.objects.get_or_create(
+            # The data product is only created once its file has been downloaded, so that a failed download leaves
+            # nothing behind that would be taken for a saved product
+            dp = saved_products.get(str(product['id'])) or DataProduct(
                 product_id=product['id'],
                 target=observation_record.target,
                 observation_record=observation_record,
             )
-            if created:
-                product_data = requests.get(product['url']).content
-                dfile = ContentFile(product_data)
-                dp.data.save(product['filename'], dfile)
-                dp.save()
-                logger.info('Saved new dataproduct: {}'.format(dp.data))
-            if AUTO_THUMBNAILS:
+            if not dp.data:
+                downloads.append({
+                    'data_product': dp,
+                    'filename': product['filename'],
+                    'url': product['url'],
+                    'path': staging_path('{0}_{1}'.format(self.name, product['id']), product['filename']),
+                    'size': product.get('size'),
+                    'md5': product.get('md5'),
+                })
+            data_products.append(dp)
+
+        failed = []
+        for download, error in download_files(get_session(self.name), downloads):
+            if error:
+                failed.append(download['filename'])
+                continue
+            dp = download['data_product']
+            with open(download['path'], 'rb') as f:
+                dp.data.save(download['filename'], File(f))
+            os.remove(download['path'])
+            logger.info('Saved new dataproduct: {}'.format(dp.data))
+
+        final_products = [dp for dp in data_products if dp.data]
+        if AUTO_THUMBNAILS:
+            for dp in final_products:
                 create_image_dataproduct(dp)
                 dp.get_preview()
-            final_products.append(dp)
+        if failed:
+            raise DownloadError('Failed to download {0}'.format(', '.join(failed)))
         return final_products
 
     @abstractmethod
@@ -217,6 +356,21 @@ class GenericObservationFacility(ABC):
         """
         pass
 
+    def get_observation_statuses(self, observation_ids):
+        """
+        Returns the statuses of many observations at once, as the dictionaries returned by
+        ``get_observation_status``, keyed by observation id. Facilities whose API can list or filter observations
+        should implement this, so that updating all statuses takes a few requests rather than one per observation.
+        Observations missing from the result are requested individually with ``get_observation_status``.
+
+        :param observation_ids: ids of the observations to request the status of
+        :type observation_ids: list
+
+        :returns: dictionary of observation ids to statuses
+        :rtype: dict
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def data_products(self, observation_id, product_id=None):
         """
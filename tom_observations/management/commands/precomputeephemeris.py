@@ -0,0 +1,32 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+
+from tom_observations.utils import get_all_observing_sites, get_site_ephemerides
+
+
+class Command(BaseCommand):
+    help = 'Calculates the sun and moon tables of all observing sites for the coming nights and caches them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--nights',
+            type=int,
+            default=7,
+            help='Number of nights, starting tonight, to calculate the tables for'
+        )
+        parser.add_argument(
+            '--resolution',
+            type=int,
+            help='Time interval, in minutes, between the rows of the tables'
+        )
+
+    def handle(self, *args, **options):
+        sites = get_all_observing_sites()
+        today = datetime.utcnow().date()
+        # A night spans two UTC dates, so the tables of the date after the last night are needed as well
+        for i in range(options['nights'] + 1):
+            day = today + timedelta(days=i)
+            get_site_ephemerides(list(sites.values()), day, options['resolution'])
+            self.stdout.write('Cached {0} sites for {1}'.format(len(sites), day.isoformat()))
+        return 'Ephemeris tables cached successfully'
@@ -2,7 +2,7 @@ from django.core.management.base import BaseCommand
 from django.core.exceptions import ObjectDoesNotExist
 
 from tom_targets.models import Target
-from tom_observations import facility
+from tom_observations.sync import sync_observation_statuses
 
 
 class Command(BaseCommand):
@@ -22,16 +22,9 @@ class Command(BaseCommand):
             except ObjectDoesNotExist:
                 raise Exception('Invalid target id provided')
 
-        failed_records = {}
-        for facility_name in facility.get_service_classes():
-            clazz = facility.get_service_class(facility_name)
-            failed_records[facility_name] = clazz().update_all_observation_statuses(target=target)
-        success = True
-        for facility_name, errors in failed_records.items():
-            if len(errors) > 0:
-                success = False
-                break
-        if success:
+        report = sync_observation_statuses(target=target)
+        self.stdout.write(str(report))
+        if report.success:
             return 'Update completed successfully'
         else:
-            return 'Update completed with errors: {0}'.format(str(failed_records))
+            return 'Update completed with errors: {0}'.format(str(report.failed_records))
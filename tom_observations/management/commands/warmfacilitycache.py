@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from tom_observations.facility import get_service_classes
+from tom_observations.metadata import refresh_metadata, registered_metadata
+
+
+class Command(BaseCommand):
+    help = 'Requests the metadata of all facilities, such as available instruments, and caches it'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--key',
+            action='append',
+            help='Only refresh the metadata with this name, can be given several times'
+        )
+
+    def handle(self, *args, **options):
+        # Loading the facility classes registers their metadata
+        get_service_classes()
+        failed = []
+        for key in registered_metadata():
+            if options['key'] and key not in options['key']:
+                continue
+            try:
+                refresh_metadata(key)
+                self.stdout.write('Cached {0}'.format(key))
+            except Exception as e:
+                failed.append(key)
+                self.stdout.write('Failed to cache {0}: {1}'.format(key, e))
+        if failed:
+            return 'Cache warmed with errors: {0}'.format(', '.join(failed))
+        return 'Cache warmed successfully'
@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+try:
+    METADATA_CACHE_TTL = settings.FACILITY_METADATA_CACHE_TTL
+except AttributeError:
+    METADATA_CACHE_TTL = 3600
+
+try:
+    METADATA_CACHE_MAX_AGE = settings.FACILITY_METADATA_CACHE_MAX_AGE
+except AttributeError:
+    METADATA_CACHE_MAX_AGE = 7 * 24 * 3600
+
+# Seconds after which a refresh that never finished, for example because its process died, may be started again
+REFRESH_LOCK_TIMEOUT = 300
+
+_loaders = {}
+
+
+def register_metadata(key, loader):
+    """
+    Registers a function loading a piece of facility metadata, such as the instruments available at a facility, so
+    that it can be cached under ``key`` by ``get_metadata`` and warmed by the ``warmfacilitycache`` command.
+
+    :param key: unique name of the metadata
+    :type key: str
+
+    :param loader: function without arguments that requests the metadata from the facility
+    :type loader: callable
+    """
+    _loaders[key] = loader
+
+
+def registered_metadata():
+    return sorted(_loaders)
+
+
+def _cache_key(key):
+    return 'facility_metadata_{0}'.format(key)
+
+
+def refresh_metadata(key):
+    """
+    Requests a piece of facility metadata from its facility and caches it.
+
+    :param key: name the metadata was registered under
+    :type key: str
+
+    :returns: the metadata
+    """
+    value = _loaders[key]()
+    cache.set(_cache_key(key), {'value': value, 'fetched': time.time()}, METADATA_CACHE_MAX_AGE)
+    return value
+
+
+def _refresh(key):
+    try:
+        refresh_metadata(key)
+    except Exception as e:
+        logger.warning('Failed to refresh facility metadata {0}: {1}'.format(key, e))
+    finally:
+        cache.delete(_cache_key(key) + '_refreshing')
+
+
+def refresh_in_background(key):
+    """
+    Refreshes a piece of facility metadata in a background thread, unless a refresh of it is already running.
+
+    :param key: name the metadata was registered under
+    :type key: str
+
+    :returns: the thread running the refresh, or None if a refresh was already running
+    :rtype: threading.Thread
+    """
+    if not cache.add(_cache_key(key) + '_refreshing', True, REFRESH_LOCK_TIMEOUT):
+        return None
+    thread = threading.Thread(target=_refresh, args=(key,), daemon=True)
+    thread.start()
+    return thread
+
+
+def get_metadata(key, default=None):
+    """
+    Returns a piece of facility metadata from the cache. Metadata cached more than ``FACILITY_METADATA_CACHE_TTL``
+    seconds ago is still returned, but refreshed in the background for later calls. If nothing is cached yet, the
+    metadata is requested from the facility before returning, so that forms built from it can be validated, and
+    ``default`` is returned only if that request fails.
+
+    :param key: name the metadata was registered under
+    :type key: str
+
+    :param default: value to return if the metadata is not cached and cannot be requested
+    """
+    entry = cache.get(_cache_key(key))
+    if entry is None:
+        try:
+            return refresh_metadata(key)
+        except Exception as e:
+            logger.warning('Failed to load facility metadata {0}: {1}'.format(key, e))
+            return default
+    if time.time() - entry['fetched'] > METADATA_CACHE_TTL:
+        refresh_in_background(key)
+    return entry['value']
@@ -0,0 +1,45 @@
+# Generated by Django 3.0.14 on 2026-10-16 20:44
+
+import logging
+
+from django.db import migrations, models
+
+from tom_observations.facility import get_service_class
+
+logger = logging.getLogger(__name__)
+
+
+def populate_terminal(apps, schema_editor):
+    ObservationRecord = apps.get_model('tom_observations', 'ObservationRecord')
+    for facility_name in ObservationRecord.objects.order_by().values_list('facility', flat=True).distinct():
+        try:
+            terminal_states = get_service_class(facility_name)().get_terminal_observing_states()
+        except Exception as e:
+            # Records of facilities that are missing or broken keep terminal unset until their status is next saved
+            logger.warning('Skipped computing the terminal state of {0} observations: {1}'.format(facility_name, e))
+            continue
+        ObservationRecord.objects.filter(facility=facility_name, status__in=terminal_states).update(terminal=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_observations', '0003_auto_20190503_2318'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='observationrecord',
+            name='terminal',
+            field=models.BooleanField(db_index=True, default=False, editable=False, help_text='Whether the status is one of the terminal observing states of the facility.'),
+        ),
+        migrations.AddIndex(
+            model_name='observationrecord',
+            index=models.Index(fields=['facility', 'status'], name='tom_observa_facilit_5fcf5b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='observationrecord',
+            index=models.Index(fields=['observation_id'], name='tom_observa_observa_44e56f_idx'),
+        ),
+        migrations.RunPython(populate_terminal, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-16 20:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_observations', '0004_observationrecord_terminal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='observationrecord',
+            name='archive_checked',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+    ]
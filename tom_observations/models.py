@@ -34,6 +34,14 @@ class ObservationRecord(models.Model):
     :param scheduled_end: The time at which the observation is scheduled to end, according to the facility.
     :type scheduled_end: datetime
 
+    :param terminal: Whether the status is one of the terminal observing states of the facility. Computed whenever the
+        status changes.
+    :type terminal: bool
+
+    :param archive_checked: The time at which the data products of this observation were last listed by the
+        ``downloaddata`` command.
+    :type archive_checked: datetime
+
     :param created: The time at which this object was created.
     :type created: datetime
 
@@ -47,31 +55,121 @@ class ObservationRecord(models.Model):
     status = models.CharField(max_length=200)
     scheduled_start = models.DateTimeField(null=True)
     scheduled_end = models.DateTimeField(null=True)
+    terminal = models.BooleanField(
+        default=False, editable=False, db_index=True,
+        help_text='Whether the status is one of the terminal observing states of the facility.'
+    )
+    archive_checked = models.DateTimeField(null=True, editable=False)
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ('-created',)
+        indexes = [
+            models.Index(fields=['facility', 'status']),
+            models.Index(fields=['observation_id']),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = instance._current_values()
+        return instance
+
+    def _current_values(self):
+        return {
+            field.attname: self.__dict__[field.attname]
+            for field in self._meta.concrete_fields if field.attname in self.__dict__
+        }
+
+    def _snapshot_values(self, field_names=None):
+        """
+        Records the current values of the given fields, or of all fields, as the values stored in the database, which
+        ``get_dirty_fields`` compares against.
+        """
+        current_values = self._current_values()
+        if field_names is not None:
+            attnames = {self._meta.get_field(name).attname for name in field_names}
+            current_values = dict(getattr(self, '_loaded_values', {}), **{
+                attname: value for attname, value in current_values.items() if attname in attnames
+            })
+        self._loaded_values = current_values
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._snapshot_values(fields)
+
+    def get_dirty_fields(self):
+        """
+        Returns the names of the fields that changed since this record was loaded from or last saved to the database,
+        without querying the database. Fields of records that were not loaded from the database are all considered
+        changed.
+
+        :returns: names of the changed fields
+        :rtype: list
+        """
+        loaded_values = getattr(self, '_loaded_values', {})
+        return [
+            field.name for field in self._meta.concrete_fields
+            if field.attname in self.__dict__ and (
+                field.attname not in loaded_values or loaded_values[field.attname] != self.__dict__[field.attname]
+            )
+        ]
 
     def save(self, *args, **kwargs):
-        if self.id:
-            presave_data = ObservationRecord.objects.get(pk=self.id)
-            super().save(*args, **kwargs)
-            if self.status != presave_data.status:
-                run_hook('observation_change_state', self, presave_data.status)
+        """
+        Saves the record, writing only the fields that changed since it was loaded, and skipping the save entirely if
+        none did. When the status changes, ``terminal`` is recomputed and the ``observation_change_state`` hook is run
+        with the previous status, unless ``update_fields`` leaves the status out.
+        """
+        if self.pk is None or kwargs.get('force_insert'):
+            created, previous_status = True, None
+        elif not self._state.adding:
+            created = False
+            previous_status = self._loaded_values.get('status', self.status)
+            if kwargs.get('update_fields') is None:
+                dirty_fields = self.get_dirty_fields()
+                if not dirty_fields:
+                    return
+                kwargs['update_fields'] = dirty_fields + ['modified']
         else:
-            super().save(*args, **kwargs)
-            run_hook('observation_change_state', self, None)
+            # The record was built with an id rather than loaded from the database, so whether it exists and its
+            # previous status are unknown
+            previous_status = ObservationRecord.objects.filter(pk=self.pk).values_list('status', flat=True).first()
+            created = previous_status is None
+
+        update_fields = kwargs.get('update_fields')
+        if created or {'status', 'facility'}.intersection(update_fields or self.get_dirty_fields()):
+            self.terminal = self.is_terminal_status()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'terminal'}
+        super().save(*args, **kwargs)
+
+        update_fields = kwargs.get('update_fields')
+        self._snapshot_values(update_fields)
+        status_saved = update_fields is None or 'status' in update_fields
+        if created or (status_saved and self.status != previous_status):
+            run_hook('observation_change_state', self, previous_status)
+
+    def is_terminal_status(self):
+        """
+        Determines whether the current status is one of the terminal observing states of the facility, as stored in
+        ``terminal`` when the record is saved. Statuses of facilities that are not available in the TOM are treated as
+        not terminal.
+
+        :returns: whether the status is terminal
+        :rtype: bool
+        """
+        try:
+            facility = get_service_class(self.facility)
+        except ImportError:
+            return False
+        return self.status in facility().get_terminal_observing_states()
 
     @property
     def parameters_as_dict(self):
         return json.loads(self.parameters)
 
-    @property
-    def terminal(self):
-        facility = get_service_class(self.facility)
-        return self.status in facility().get_terminal_observing_states()
-
     @property
     def url(self):
         facility = get_service_class(self.facility)
@@ -0,0 +1,184 @@
+from astropy.coordinates import get_body_barycentric
+import numpy as np
+
+from tom_targets.models import REQUIRED_NON_SIDEREAL_FIELDS, REQUIRED_NON_SIDEREAL_FIELDS_PER_SCHEME, Target
+
+# Gaussian gravitational constant, in radians per day for distances in AU
+GAUSSIAN_GRAVITATIONAL_CONSTANT = 0.01720209895
+# Speed of light in AU per day
+SPEED_OF_LIGHT = 173.1446326846693
+# Obliquity of the ecliptic at J2000, in degrees
+OBLIQUITY_J2000 = 23.4392911
+# Epochs above this are taken to be Julian Dates, and below it Modified Julian Dates
+JULIAN_DATE_THRESHOLD = 2400000.5
+# Orbits with an eccentricity this close to 1 are treated as parabolic
+PARABOLIC_TOLERANCE = 1e-8
+KEPLER_ITERATIONS = 50
+
+
+def has_orbital_elements(target):
+    """
+    Returns whether a non-sidereal target has all orbital elements its scheme requires to be propagated.
+
+    :param target: target to check
+    :type target: Target
+
+    :rtype: bool
+    """
+    if target.type != Target.NON_SIDEREAL or target.scheme not in REQUIRED_NON_SIDEREAL_FIELDS_PER_SCHEME:
+        return False
+    fields = REQUIRED_NON_SIDEREAL_FIELDS + REQUIRED_NON_SIDEREAL_FIELDS_PER_SCHEME[target.scheme]
+    return all(getattr(target, field) not in (None, '') for field in fields)
+
+
+def _mjd(epoch):
+    return epoch - JULIAN_DATE_THRESHOLD if epoch > JULIAN_DATE_THRESHOLD else epoch
+
+
+def get_orbital_elements(targets):
+    """
+    Converts the orbital elements of non-sidereal targets, in any scheme, to perihelion elements as columns of arrays.
+    Comets are given by their perihelion distance and time, and minor and major planets by their semimajor axis and
+    mean anomaly at the epoch, with the mean daily motion derived from the semimajor axis if it is not given. Epochs
+    may be given as Julian Dates or Modified Julian Dates.
+
+    :param targets: non-sidereal targets with orbital elements, N targets
+    :type targets: list
+
+    :returns: dictionary of arrays of shape (N,) with the ``perihelion_distance`` in AU, ``eccentricity``,
+        ``inclination``, ``lng_asc_node`` and ``arg_of_perihelion`` in radians, ``mean_motion`` in radians per day
+        and ``time_of_perihelion`` as a Modified Julian Date
+    :rtype: dict
+    """
+    elements = {
+        'perihelion_distance': [], 'eccentricity': [], 'inclination': [], 'lng_asc_node': [],
+        'arg_of_perihelion': [], 'mean_motion': [], 'time_of_perihelion': []
+    }
+    for target in targets:
+        eccentricity = target.eccentricity
+        if target.scheme == 'MPC_COMET':
+            perihelion_distance = target.perihdist
+            time_of_perihelion = _mjd(target.epoch_of_perihelion)
+            if abs(eccentricity - 1) < PARABOLIC_TOLERANCE:
+                mean_motion = GAUSSIAN_GRAVITATIONAL_CONSTANT / np.sqrt(2 * perihelion_distance ** 3)
+            else:
+                semimajor_axis = abs(perihelion_distance / (1 - eccentricity))
+                mean_motion = GAUSSIAN_GRAVITATIONAL_CONSTANT / semimajor_axis ** 1.5
+        else:
+            perihelion_distance = target.semimajor_axis * (1 - eccentricity)
+            if target.mean_daily_motion:
+                mean_motion = np.radians(target.mean_daily_motion)
+            else:
+                mean_motion = GAUSSIAN_GRAVITATIONAL_CONSTANT / target.semimajor_axis ** 1.5
+            time_of_perihelion = _mjd(target.epoch) - np.radians(target.mean_anomaly) / mean_motion
+        elements['perihelion_distance'].append(perihelion_distance)
+        elements['eccentricity'].append(eccentricity)
+        elements['inclination'].append(np.radians(target.inclination))
+        elements['lng_asc_node'].append(np.radians(target.lng_asc_node))
+        elements['arg_of_perihelion'].append(np.radians(target.arg_of_perihelion))
+        elements['mean_motion'].append(mean_motion)
+        elements['time_of_perihelion'].append(time_of_perihelion)
+    return {key: np.array(values, dtype=float) for key, values in elements.items()}
+
+
+def _true_anomalies(eccentricity, mean_anomaly):
+    """
+    Solves Kepler's equation by Newton's method for all elliptical and hyperbolic orbits at once.
+
+    :param eccentricity: eccentricities, not equal to 1
+    :param mean_anomaly: mean anomalies in radians, of the same shape as ``eccentricity``
+
+    :returns: true anomalies in radians
+    :rtype: numpy.ndarray
+    """
+    elliptical = eccentricity < 1
+    e = np.where(elliptical, eccentricity, 0)
+    h = np.where(elliptical, 2, eccentricity)
+    ellipse_mean_anomaly = np.where(elliptical, np.remainder(mean_anomaly + np.pi, 2 * np.pi) - np.pi, 0)
+    hyperbola_mean_anomaly = np.where(elliptical, 0, mean_anomaly)
+
+    ellipse_anomaly = np.where(e > 0.8, np.pi * np.sign(ellipse_mean_anomaly), ellipse_mean_anomaly)
+    hyperbola_anomaly = np.arcsinh(hyperbola_mean_anomaly / h)
+    for i in range(KEPLER_ITERATIONS):
+        ellipse_step = (ellipse_anomaly - e * np.sin(ellipse_anomaly) - ellipse_mean_anomaly) / (
+            1 - e * np.cos(ellipse_anomaly))
+        hyperbola_step = (h * np.sinh(hyperbola_anomaly) - hyperbola_anomaly - hyperbola_mean_anomaly) / (
+            h * np.cosh(hyperbola_anomaly) - 1)
+        ellipse_anomaly -= ellipse_step
+        hyperbola_anomaly -= hyperbola_step
+        if max(np.abs(ellipse_step).max(initial=0), np.abs(hyperbola_step).max(initial=0)) < 1e-12:
+            break
+
+    return np.where(
+        elliptical,
+        2 * np.arctan2(np.sqrt(1 + e) * np.sin(ellipse_anomaly / 2), np.sqrt(1 - e) * np.cos(ellipse_anomaly / 2)),
+        2 * np.arctan(np.sqrt((h + 1) / (h - 1)) * np.tanh(hyperbola_anomaly / 2))
+    )
+
+
+def heliocentric_positions(elements, mjd):
+    """
+    Propagates orbits as two-body orbits around the sun, using Kepler's equation for elliptical and hyperbolic
+    orbits and Barker's equation for parabolic orbits.
+
+    :param elements: orbital elements of N orbits, as returned by ``get_orbital_elements``
+    :type elements: dict
+
+    :param mjd: Modified Julian Dates, in TT, of shape (T,) or (N, T)
+    :type mjd: numpy.ndarray
+
+    :returns: heliocentric positions in AU, in equatorial coordinates of J2000, of shape (N, T, 3)
+    :rtype: numpy.ndarray
+    """
+    column = {key: value[:, np.newaxis] for key, value in elements.items()}
+    mean_anomaly = column['mean_motion'] * (np.asarray(mjd) - column['time_of_perihelion'])
+    q, e = np.broadcast_arrays(column['perihelion_distance'], column['eccentricity'], mean_anomaly)[:2]
+    parabolic = np.abs(e - 1) < PARABOLIC_TOLERANCE
+
+    # Barker's equation, tan(v/2)^3 + 3 tan(v/2) = 3 M, with M = n (t - T) and n = k / sqrt(2 q^3)
+    w = 3 * np.where(parabolic, mean_anomaly, 0) / 2
+    s = np.cbrt(w + np.sqrt(w ** 2 + 1))
+    true_anomaly = np.where(parabolic, 2 * np.arctan(s - 1 / s),
+                            _true_anomalies(np.where(parabolic, 0, e), mean_anomaly))
+    radius = q * (1 + e) / (1 + e * np.cos(true_anomaly))
+
+    node, inclination = column['lng_asc_node'], column['inclination']
+    argument_of_latitude = column['arg_of_perihelion'] + true_anomaly
+    x = radius * (np.cos(node) * np.cos(argument_of_latitude)
+                  - np.sin(node) * np.sin(argument_of_latitude) * np.cos(inclination))
+    y = radius * (np.sin(node) * np.cos(argument_of_latitude)
+                  + np.cos(node) * np.sin(argument_of_latitude) * np.cos(inclination))
+    z = radius * np.sin(argument_of_latitude) * np.sin(inclination)
+    obliquity = np.radians(OBLIQUITY_J2000)
+    return np.stack([x, y * np.cos(obliquity) - z * np.sin(obliquity), y * np.sin(obliquity) + z * np.cos(obliquity)],
+                    axis=-1)
+
+
+def get_orbital_coordinates(targets, times):
+    """
+    Calculates the astrometric geocentric positions of non-sidereal targets from their orbital elements at each time,
+    for all targets at once and without any remote service. The position of the Earth comes from the ephemeris built
+    into astropy, and the positions are corrected for light travel time. Perturbations by the planets and the
+    parallax of the observing site are neglected.
+
+    :param targets: non-sidereal targets with orbital elements, N targets
+    :type targets: list
+
+    :param times: times at which to calculate the positions, T times
+    :type times: astropy Time
+
+    :returns: right ascensions and declinations in degrees, each of shape (N, T)
+    :rtype: tuple
+    """
+    elements = get_orbital_elements(targets)
+    earth = get_body_barycentric('earth', times) - get_body_barycentric('sun', times)
+    earth = earth.xyz.to_value('AU').T[np.newaxis]
+    mjd = times.tt.mjd
+    geocentric = heliocentric_positions(elements, mjd) - earth
+    # One iteration of the light travel time is enough for the precision of the two-body propagation
+    distance = np.linalg.norm(geocentric, axis=-1)
+    geocentric = heliocentric_positions(elements, mjd[np.newaxis] - distance / SPEED_OF_LIGHT) - earth
+    x, y, z = np.moveaxis(geocentric, -1, 0)
+    ra = np.degrees(np.arctan2(y, x)) % 360
+    dec = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    return ra, dec
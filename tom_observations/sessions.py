@@ -0,0 +1,105 @@
+import threading
+
+from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Defaults for the HTTP options, which can be overridden per facility in settings.FACILITIES
+HTTP_DEFAULTS = {
+    'http_timeout': 30,  # seconds to wait for the facility to connect or send data
+    'http_retries': 3,  # number of times a request failing to connect or with a 429 or 5xx response is retried
+    'http_backoff': 0.5,  # backoff factor of the retries, which wait 0, 2, 4... times this many seconds
+    'http_pool_size': 10,  # maximum number of open connections to each host of the facility
+}
+# Responses retried by the session. Callers such as the status sync do not retry again, and the make_request helpers
+# of the facilities raise a RateLimitedException for a 429 that outlasts the retries.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_http_settings(facility_name):
+    """
+    Returns the HTTP options for a facility, read from its entry in ``settings.FACILITIES``, with ``HTTP_DEFAULTS``
+    for any option that is not set.
+
+    :param facility_name: name of the facility
+    :type facility_name: str
+
+    :returns: dictionary of HTTP options
+    :rtype: dict
+    """
+    try:
+        facility_settings = settings.FACILITIES.get(facility_name, {})
+    except AttributeError:
+        facility_settings = {}
+    return {key: facility_settings.get(key, default) for key, default in HTTP_DEFAULTS.items()}
+
+
+class FacilitySession(requests.Session):
+    """
+    ``requests.Session`` that applies a default timeout to every request that does not set its own.
+    """
+
+    def __init__(self, timeout=None):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def create_session(timeout, retries, backoff, pool_size):
+    """
+    Creates a session that keeps connections alive for reuse, opens at most ``pool_size`` connections to each host,
+    and retries requests failing to connect or with a rate limiting or server error response, with exponential backoff
+    that honors ``Retry-After`` headers. Only idempotent requests are retried after a response is received, so that
+    observations are never submitted twice.
+
+    :param timeout: default timeout of requests, in seconds
+    :type timeout: float
+
+    :param retries: maximum number of retries of a request
+    :type retries: int
+
+    :param backoff: backoff factor of the retries
+    :type backoff: float
+
+    :param pool_size: maximum number of open connections to each host
+    :type pool_size: int
+
+    :rtype: FacilitySession
+    """
+    session = FacilitySession(timeout=timeout)
+    retry = Retry(
+        total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUS_CODES, raise_on_status=False
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(facility_name):
+    """
+    Returns the pooled HTTP session shared by all requests to a facility, configured with the ``http_*`` options of
+    the facility in ``settings.FACILITIES``. The session is created on first use and reused by all threads.
+
+    :param facility_name: name of the facility
+    :type facility_name: str
+
+    :rtype: FacilitySession
+    """
+    http_settings = get_http_settings(facility_name)
+    key = (facility_name,) + tuple(sorted(http_settings.items()))
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = create_session(
+                http_settings['http_timeout'], http_settings['http_retries'], http_settings['http_backoff'],
+                http_settings['http_pool_size']
+            )
+    return session
@@ -0,0 +1,221 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from tom_observations.facility import GenericObservationFacility, get_service_classes
+from tom_observations.models import ObservationRecord
+
+logger = logging.getLogger(__name__)
+
+GENERIC_UPDATE_ALL = GenericObservationFacility.update_all_observation_statuses
+GENERIC_GET_STATUSES = GenericObservationFacility.get_observation_statuses
+
+# Defaults for the status synchronization options, which can be overridden per facility in settings.FACILITIES
+SYNC_DEFAULTS = {
+    'sync_workers': 4,  # number of concurrent requests to the facility
+    'sync_rate_limit': None,  # maximum number of requests per second, or None for no limit
+}
+
+
+def get_sync_settings(facility_name):
+    """
+    Returns the status synchronization options for a facility, read from its entry in ``settings.FACILITIES``, with
+    ``SYNC_DEFAULTS`` for any option that is not set.
+
+    :param facility_name: name of the facility
+    :type facility_name: str
+
+    :returns: dictionary of synchronization options
+    :rtype: dict
+    """
+    try:
+        facility_settings = settings.FACILITIES.get(facility_name, {})
+    except AttributeError:
+        facility_settings = {}
+    return {key: facility_settings.get(key, default) for key, default in SYNC_DEFAULTS.items()}
+
+
+class RateLimiter:
+    """
+    Spaces out calls shared between threads so that no more than ``rate`` of them start per second.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        """
+        Blocks until the next call is allowed.
+        """
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class StatusSyncReport:
+    """
+    Summary of a status synchronization: for each facility, the number of records whose status changed, the number
+    whose status was unchanged, the records that failed to update and the time taken.
+    """
+
+    def __init__(self):
+        self.facilities = {}
+
+    def facility(self, facility_name):
+        return self.facilities.setdefault(
+            facility_name, {'updated': 0, 'unchanged': 0, 'failed': [], 'elapsed': 0.0}
+        )
+
+    @property
+    def failed_records(self):
+        """
+        The records that failed to update, as a dictionary of facility names to lists of (observation id, error)
+        tuples.
+        """
+        return {name: summary['failed'] for name, summary in self.facilities.items()}
+
+    @property
+    def success(self):
+        return not any(summary['failed'] for summary in self.facilities.values())
+
+    def __str__(self):
+        return '\n'.join(
+            '{0}: {1} updated, {2} unchanged, {3} failed in {4:.1f}s'.format(
+                name, summary['updated'], summary['unchanged'], len(summary['failed']), summary['elapsed']
+            ) for name, summary in self.facilities.items()
+        )
+
+
+class _FacilitySync:
+    """
+    State of the status synchronization of a single facility: its worker pool, rate limiter and summary.
+    """
+
+    def __init__(self, facility, summary):
+        self.facility = facility
+        self.summary = summary
+        self.settings = get_sync_settings(facility.name)
+        self.rate_limiter = RateLimiter(self.settings['sync_rate_limit'])
+        self.executor = ThreadPoolExecutor(max_workers=self.settings['sync_workers'])
+        self.started = time.monotonic()
+
+    @property
+    def supports_batch(self):
+        return type(self.facility).get_observation_statuses is not GENERIC_GET_STATUSES
+
+    def submit(self, func):
+        # Failed requests are retried by the HTTP session of the facility, see tom_observations.sessions
+        def call():
+            self.rate_limiter.wait()
+            return func()
+        return self.executor.submit(call)
+
+    def submit_single(self, record):
+        return self.submit(lambda: self.facility.get_observation_status(record.observation_id))
+
+    def submit_batch(self, records):
+        return self.submit(lambda: self.facility.get_observation_statuses([r.observation_id for r in records]))
+
+    def apply(self, record, status):
+        try:
+            if self.facility.apply_observation_status(record, status):
+                self.summary['updated'] += 1
+            else:
+                self.summary['unchanged'] += 1
+        except Exception as e:
+            self.fail(record, e)
+
+    def fail(self, record, error):
+        logger.warning('Failed to update {0} observation {1}: {2}'.format(
+            self.facility.name, record.observation_id, error
+        ))
+        self.summary['failed'].append((record.observation_id, str(error)))
+
+
+def sync_observation_statuses(target=None, facility_names=None):
+    """
+    Updates the status of every non-terminal ``ObservationRecord``. Statuses are requested from all facilities at
+    once, each with its own bounded pool of ``sync_workers`` threads and at most ``sync_rate_limit`` requests per
+    second. Failed requests are retried by the HTTP session of each facility rather than here. Facilities implementing
+    ``get_observation_statuses`` are asked for all of their statuses in one batch, and only the observations missing
+    from the batch are requested individually. The results are written to the database from the calling thread as
+    they arrive, so the status methods of facilities must not access the database themselves.
+
+    :param target: only update the observations of this ``Target``
+    :type target: Target
+
+    :param facility_names: only update the observations of these facilities, rather than of all facilities
+    :type facility_names: list
+
+    :returns: summary of the synchronization
+    :rtype: StatusSyncReport
+    """
+    report = StatusSyncReport()
+    syncs = []
+    jobs = {}
+    try:
+        for facility_name, facility_class in get_service_classes().items():
+            if facility_names is not None and facility_name not in facility_names:
+                continue
+            facility = facility_class()
+            summary = report.facility(facility_name)
+            if facility_class.update_all_observation_statuses is not GENERIC_UPDATE_ALL:
+                # Facilities with their own way of updating all statuses keep using it
+                started = time.monotonic()
+                summary['failed'] = facility.update_all_observation_statuses(target=target)
+                summary['elapsed'] = time.monotonic() - started
+                continue
+            records = ObservationRecord.objects.filter(facility=facility_name, terminal=False)
+            if target:
+                records = records.filter(target=target)
+            records = list(records)
+            if not records:
+                continue
+
+            sync = _FacilitySync(facility, summary)
+            syncs.append(sync)
+            if sync.supports_batch:
+                jobs[sync.submit_batch(records)] = (sync, records)
+            else:
+                for record in records:
+                    jobs[sync.submit_single(record)] = (sync, record)
+
+        while jobs:
+            done, _ = wait(jobs, return_when=FIRST_COMPLETED)
+            for future in done:
+                sync, records = jobs.pop(future)
+                if isinstance(records, list):
+                    try:
+                        statuses = future.result()
+                    except Exception as e:
+                        logger.warning('Batch status request to {0} failed: {1}'.format(sync.facility.name, e))
+                        statuses = {}
+                    for record in records:
+                        if record.observation_id in statuses:
+                            sync.apply(record, statuses[record.observation_id])
+                        else:
+                            jobs[sync.submit_single(record)] = (sync, record)
+                else:
+                    try:
+                        sync.apply(records, future.result())
+                    except Exception as e:
+                        sync.fail(records, e)
+                sync.summary['elapsed'] = time.monotonic() - sync.started
+    finally:
+        # If the loop failed, cancel the requests that have not started and wait for the running ones, so that no
+        # facility calls outlive this function
+        for future in jobs:
+            future.cancel()
+        for sync in syncs:
+            sync.executor.shutdown(wait=True)
+    return report
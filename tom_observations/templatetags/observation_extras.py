@@ -1,4 +1,9 @@
+import hashlib
+import uuid
+
 from django import template
+from django.core.cache import cache
+from django.db.models import Case, CharField, F, OuterRef, Subquery, Value, When
 
 from tom_observations.models import ObservationRecord
 from tom_observations.facility import get_service_classes
@@ -9,6 +14,10 @@ import plotly.graph_objs as go
 
 register = template.Library()
 
+OBSERVATION_DISTRIBUTION_CACHE_TIMEOUT = 3600
+# Cache key of a token that changes whenever observations or targets change, invalidating the cached distributions
+OBSERVATION_DISTRIBUTION_VERSION_KEY = 'observation_distribution_version'
+
 
 @register.inclusion_tag('tom_observations/partials/observing_buttons.html')
 def observing_buttons(target):
@@ -31,63 +40,77 @@ def observation_list(target=None):
     return {'observations': observations}
 
 
+def observation_distribution_changed(sender, **kwargs):
+    """
+    Signal receiver that invalidates the cached observation distributions when an ``ObservationRecord`` or a ``Target``
+    changes.
+    """
+    cache.set(OBSERVATION_DISTRIBUTION_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def _distribution_locations(observations):
+    """
+    Returns the locations of the sidereal targets of the given observations, split by the status of the latest
+    observation of each target: without a status, not yet terminal, and terminal. The latest observation of each
+    target is the one with the latest scheduled end, and is found in the database.
+
+    :returns: dictionary of status categories to (ra, dec, name) lists
+    :rtype: dict
+    """
+    latest = observations.filter(target=OuterRef('pk')).order_by(F('scheduled_end').desc(nulls_last=True), '-pk')
+    targets = Target.objects.filter(
+        type=Target.SIDEREAL, pk__in=observations.values('target_id')
+    ).annotate(
+        latest_status=Subquery(latest.values('status')[:1]),
+        latest_terminal=Subquery(latest.values('terminal')[:1]),
+    ).annotate(
+        category=Case(
+            When(latest_status='', then=Value('no_status')),
+            When(latest_terminal=True, then=Value('terminal')),
+            default=Value('non_terminal'),
+            output_field=CharField(),
+        )
+    ).order_by()
+    locations = {category: ([], [], []) for category in ('no_status', 'non_terminal', 'terminal')}
+    for category, ra, dec, name in targets.values_list('category', 'ra', 'dec', 'name'):
+        lon, lat, text = locations[category]
+        lon.append(ra)
+        lat.append(dec)
+        text.append(name)
+    return locations
+
+
 @register.inclusion_tag('tom_observations/partials/observation_distribution.html')
 def observation_distribution(observations):
     """
-    Displays a plot showing on a map the locations of all observations recorded in the TOM.
+    Displays a plot showing on a map the locations of all observations recorded in the TOM. The locations are cached
+    for each distinct query until an ``ObservationRecord`` or ``Target`` changes.
     """
-
-    # "distinct" query is not supported, must manually find distinct observation per target
-    sorted_observations = observations.order_by('scheduled_end')  # ascending so that only the max is preserved
-    observation_targets = {}
-    for obs in sorted_observations:
-        observation_targets[obs.target_id] = (obs.status, obs.terminal)
-
-    observation_no_status = [t for t in observation_targets.keys()
-                             if not observation_targets[t][0]]  # status==""
-    observation_terminal = [t for t in observation_targets.keys()
-                            if observation_targets[t][0]
-                            and observation_targets[t][1]]  # status!="" and terminal
-    observation_non_terminal = [t for t in observation_targets.keys()
-                                if observation_targets[t][0]
-                                and not observation_targets[t][1]]  # status!="" and not terminal
-
-    targets_no_status = Target.objects.filter(pk__in=observation_no_status)
-    targets_terminal = Target.objects.filter(pk__in=observation_terminal)
-    targets_non_terminal = Target.objects.filter(pk__in=observation_non_terminal)
-
-    locations_no_status = targets_no_status.filter(type=Target.SIDEREAL).values_list('ra', 'dec', 'name')
-    locations_terminal = targets_terminal.filter(type=Target.SIDEREAL).values_list('ra', 'dec', 'name')
-    locations_non_terminal = targets_non_terminal.filter(type=Target.SIDEREAL).values_list('ra', 'dec', 'name')
+    version = cache.get_or_set(OBSERVATION_DISTRIBUTION_VERSION_KEY, lambda: uuid.uuid4().hex, None)
+    sql, params = observations.query.sql_with_params()
+    cache_key = 'observation_distribution_data_{}'.format(
+        hashlib.md5(repr((sql, params, version)).encode()).hexdigest()
+    )
+    locations = cache.get(cache_key)
+    if locations is None:
+        locations = _distribution_locations(observations)
+        cache.set(cache_key, locations, OBSERVATION_DISTRIBUTION_CACHE_TIMEOUT)
 
     data = [
         dict(
-            lon=[l[0] for l in locations_no_status],
-            lat=[l[1] for l in locations_no_status],
-            text=[l[2] for l in locations_no_status],
-            hoverinfo='lon+lat+text',
-            mode='markers',
-            marker=dict(color='rgba(90, 90, 90, .8)'),
-            type='scattergeo'
-        ),
-        dict(
-            lon=[l[0] for l in locations_non_terminal],
-            lat=[l[1] for l in locations_non_terminal],
-            text=[l[2] for l in locations_non_terminal],
-            hoverinfo='lon+lat+text',
-            mode='markers',
-            marker=dict(color='rgba(152, 0, 0, .8)'),
-            type='scattergeo'
-        ),
-        dict(
-            lon=[l[0] for l in locations_terminal],
-            lat=[l[1] for l in locations_terminal],
-            text=[l[2] for l in locations_terminal],
+            lon=locations[category][0],
+            lat=locations[category][1],
+            text=locations[category][2],
             hoverinfo='lon+lat+text',
             mode='markers',
-            marker=dict(color='rgba(0, 152, 0, .8)'),
+            marker=dict(color=color),
             type='scattergeo'
-        ),
+        ) for category, color in [
+            ('no_status', 'rgba(90, 90, 90, .8)'),
+            ('non_terminal', 'rgba(152, 0, 0, .8)'),
+            ('terminal', 'rgba(0, 152, 0, .8)'),
+        ]
+    ] + [
         dict(
             lon=list(range(0, 360, 60))+[180]*4,
             lat=[0]*6+[-60, -30, 30, 60],
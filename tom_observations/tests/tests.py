@@ -1,20 +1,38 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from importlib import import_module
+from io import StringIO
+import threading
+import time
 from unittest import mock
 
+from django.apps import apps
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
 
 from astroplan import Observer, FixedTarget
 from astropy import units
-from astropy.coordinates import get_sun, SkyCoord
+from astropy.coordinates import get_body, get_sun, SkyCoord
 from astropy.time import Time
+import numpy as np
 
 from .factories import TargetFactory, ObservingRecordFactory, TargetNameFactory
+from tom_observations import metadata, utils
+from tom_common.exceptions import ImproperCredentialsException, RateLimitedException
+from tom_observations.facilities.lco import LCOBaseObservationForm, LCOFacility, make_request
+from tom_observations.orbits import get_orbital_coordinates
+from tom_observations.sessions import get_session
 from tom_observations.utils import get_astroplan_sun_and_time, get_sidereal_visibility
-from tom_observations.tests.utils import FakeFacility
+from tom_observations.utils import get_target_list_visibility, get_targets_visibility
+from tom_observations.utils import get_site_ephemerides, get_sun_altitudes, get_time_grid, get_visibility
+from tom_observations.sync import sync_observation_statuses
+from tom_observations.templatetags.observation_extras import _distribution_locations, observation_distribution
+from tom_observations.tests.utils import FakeFacility, StubPortalFacility, StubPortalServer
 from tom_observations.models import ObservationRecord
-from tom_targets.models import Target
+from tom_dataproducts.models import DataProduct
+from tom_targets.models import Target, TargetList
 from guardian.shortcuts import assign_perm
 
 
@@ -101,6 +119,470 @@ class TestUpdatingObservations(TestCase):
             FakeFacility().update_all_observation_statuses(target=self.t1)
             self.assertEquals(uos_mock.call_count, 2)
 
+    # Tests that observations missing from a batch of statuses are requested individually
+    def test_update_all_observations_with_batch_statuses(self):
+        status = {'state': 'COMPLETED', 'scheduled_start': None, 'scheduled_end': None}
+        statuses = {str(self.or1.observation_id): status}
+        with mock.patch.object(FakeFacility, 'get_observation_statuses', return_value=statuses) as batch_mock:
+            with mock.patch.object(FakeFacility, 'update_observation_status') as uos_mock:
+                FakeFacility().update_all_observation_statuses(target=self.t1)
+        self.assertEqual(batch_mock.call_count, 1)
+        uos_mock.assert_called_once_with(str(self.or3.observation_id))
+        self.assertEqual(ObservationRecord.objects.get(pk=self.or1.id).status, 'COMPLETED')
+
+
+@override_settings(
+    TOM_FACILITY_CLASSES=['tom_observations.tests.utils.FakeFacility'],
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class TestAllDataProducts(TestCase):
+    def setUp(self):
+        self.target = TargetFactory.create()
+        self.record = ObservingRecordFactory.create(
+            target_id=self.target.id, facility=FakeFacility.name, parameters='{}'
+        )
+        self.frames = [{'id': i, 'filename': 'frame{0}.fits'.format(i)} for i in range(50)]
+        for i in range(0, 50, 5):
+            DataProduct.objects.create(product_id=str(i), target=self.target, observation_record=self.record)
+
+    def test_all_data_products(self):
+        with mock.patch.object(FakeFacility, 'data_products', return_value=self.frames) as dp_mock:
+            with self.assertNumQueries(3):
+                products = FakeFacility().all_data_products(self.record)
+            # The frame listing is cached
+            with self.assertNumQueries(3):
+                FakeFacility().all_data_products(self.record)
+        self.assertEqual(dp_mock.call_count, 1)
+        self.assertEqual([dp.product_id for dp in products['saved']], [str(i) for i in range(0, 50, 5)])
+        self.assertEqual(len(products['unsaved']), 40)
+
+
+@override_settings(
+    TOM_FACILITY_CLASSES=['tom_observations.tests.utils.FakeFacility'],
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class TestObservationDistribution(TestCase):
+    def setUp(self):
+        now = datetime.now(timezone.utc)
+        self.completed, self.pending, self.no_status = TargetFactory.create_batch(3, type=Target.SIDEREAL)
+        self.create_record(self.completed, 'PENDING', now - timedelta(days=2))
+        self.create_record(self.completed, 'COMPLETED', now - timedelta(days=1))
+        self.create_record(self.pending, 'COMPLETED', now - timedelta(days=2))
+        self.pending_record = self.create_record(self.pending, 'PENDING', now)
+        self.create_record(self.no_status, '', now)
+
+    def create_record(self, target, status, scheduled_end):
+        return ObservingRecordFactory.create(
+            target_id=target.id, facility=FakeFacility.name, status=status, scheduled_end=scheduled_end,
+            parameters='{}'
+        )
+
+    def test_latest_observation_per_target(self):
+        with self.assertNumQueries(1):
+            locations = _distribution_locations(ObservationRecord.objects.all())
+        self.assertEqual(locations['terminal'][2], [self.completed.name])
+        self.assertEqual(locations['non_terminal'], ([self.pending.ra], [self.pending.dec], [self.pending.name]))
+        self.assertEqual(locations['no_status'][2], [self.no_status.name])
+
+    def test_distribution_cached_until_observations_change(self):
+        observations = ObservationRecord.objects.all()
+        with mock.patch(
+            'tom_observations.templatetags.observation_extras._distribution_locations', wraps=_distribution_locations
+        ) as locations_mock:
+            observation_distribution(observations)
+            observation_distribution(observations)
+            self.assertEqual(locations_mock.call_count, 1)
+            record = ObservationRecord.objects.get(pk=self.pending_record.pk)
+            record.status = 'COMPLETED'
+            record.save()
+            self.assertIn(self.pending.name, observation_distribution(observations)['figure'])
+            self.assertEqual(locations_mock.call_count, 2)
+        self.assertEqual(_distribution_locations(observations)['non_terminal'], ([], [], []))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestFacilityMetadata(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.loader = mock.MagicMock(return_value=['instrument'])
+        metadata.register_metadata('test_instruments', self.loader)
+        self.addCleanup(metadata._loaders.pop, 'test_instruments')
+
+    def test_cold_cache_loads_synchronously(self):
+        self.assertEqual(metadata.get_metadata('test_instruments', default=[]), ['instrument'])
+        self.assertEqual(metadata.get_metadata('test_instruments', default=[]), ['instrument'])
+        self.assertEqual(self.loader.call_count, 1)
+
+    def test_cold_cache_failure_returns_default(self):
+        self.loader.side_effect = ConnectionError
+        self.assertEqual(metadata.get_metadata('test_instruments', default=[]), [])
+
+    @mock.patch('tom_observations.facilities.lco.LCOFacility.validate_observation', return_value={})
+    @mock.patch('tom_observations.facilities.lco.make_request')
+    def test_bound_lco_form_validates_on_cold_cache(self, mock_request, mock_validate):
+        mock_request.return_value.json.side_effect = [
+            {'proposals': [{'id': 'LCO2020A-001', 'title': 'Test', 'current': True}]},
+            {'1M0-SCICAM-SINISTRO': {
+                'name': 'Sinistro', 'type': 'IMAGE', 'class': '1m0',
+                'optical_elements': {'filters': [{'code': 'rp', 'name': 'rp'}]}
+            }},
+        ]
+        target = TargetFactory.create()
+        form = LCOBaseObservationForm({
+            'facility': 'LCO', 'target_id': target.id, 'name': 'test', 'proposal': 'LCO2020A-001',
+            'ipp_value': 1.05, 'observation_mode': 'NORMAL', 'start': '2020-01-01', 'end': '2020-01-02',
+            'filter': 'rp', 'instrument_type': '1M0-SCICAM-SINISTRO', 'exposure_count': 1, 'exposure_time': 30,
+            'max_airmass': 2
+        })
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.errors, {})
+
+    def test_stale_metadata_refreshed_in_background(self):
+        metadata.refresh_metadata('test_instruments')
+        release = threading.Event()
+        self.loader.side_effect = lambda: release.wait(5) and ['new instrument']
+        with mock.patch('tom_observations.metadata.METADATA_CACHE_TTL', 0):
+            refresh = metadata.refresh_in_background('test_instruments')
+            self.assertIsNotNone(refresh)
+            # While the refresh runs, stale metadata is returned and no further refresh is started
+            self.assertEqual(metadata.get_metadata('test_instruments'), ['instrument'])
+            self.assertIsNone(metadata.refresh_in_background('test_instruments'))
+            release.set()
+            refresh.join()
+        self.assertEqual(metadata.get_metadata('test_instruments'), ['new instrument'])
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_failed_refresh_keeps_stale_metadata(self):
+        metadata.refresh_metadata('test_instruments')
+        self.loader.side_effect = ConnectionError
+        metadata.refresh_in_background('test_instruments').join()
+        self.assertEqual(metadata.get_metadata('test_instruments'), ['instrument'])
+        # The failed refresh released its lock, so the next one can start
+        metadata.refresh_in_background('test_instruments').join()
+        self.assertEqual(self.loader.call_count, 3)
+
+    @mock.patch('tom_observations.facilities.lco.make_request')
+    def test_warmfacilitycache_command(self, mock_request):
+        mock_request.return_value.json.return_value = {'1M0-SCICAM-SINISTRO': {'name': 'Sinistro'}}
+        out = StringIO()
+        call_command('warmfacilitycache', key=['lco_instruments'], stdout=out)
+        self.assertIn('Cached lco_instruments', out.getvalue())
+        self.assertEqual(LCOBaseObservationForm._get_instruments(None), {'1M0-SCICAM-SINISTRO': {'name': 'Sinistro'}})
+
+
+class TestLCOBatchStatus(TestCase):
+    def listing(self, results, next_page=None):
+        response = mock.MagicMock()
+        response.json.return_value = {'results': results, 'next': next_page}
+        return response
+
+    @mock.patch('tom_observations.facilities.lco.make_request')
+    def test_get_observation_statuses(self, mock_request):
+        pending_block = {'id': 30, 'request': {'id': 3}, 'state': 'PENDING', 'start': '2020-01-01T00:00:00',
+                         'end': '2020-01-01T01:00:00'}
+        completed_block = {'id': 50, 'request': {'id': 5}, 'state': 'COMPLETED', 'start': '2020-01-02T00:00:00',
+                           'end': '2020-01-02T01:00:00'}
+        mock_request.side_effect = [
+            # Pending request groups, over two pages
+            self.listing([{'requests': [{'id': 1, 'state': 'PENDING'}, {'id': 2, 'state': 'COMPLETED'}]}], 'page2'),
+            self.listing([{'requests': [{'id': 3, 'state': 'PENDING'}, {'id': 4, 'state': 'PENDING'}]}]),
+            # Recently modified request groups
+            self.listing([{'requests': [{'id': 3, 'state': 'PENDING'}, {'id': 5, 'state': 'COMPLETED'}]}]),
+            # Pending and recently modified observation blocks
+            self.listing([pending_block]),
+            self.listing([pending_block, completed_block,
+                          dict(completed_block, id=51, state='CANCELED', start='2020-01-03T00:00:00')]),
+        ]
+        statuses = LCOFacility().get_observation_statuses(['1', '2', '3', '5'])
+        self.assertEqual(mock_request.call_count, 5)
+        self.assertEqual(mock_request.call_args_list[1][0][1], 'page2')
+        self.assertIn('modified_after=', mock_request.call_args_list[2][0][1])
+        # Request 2 left the pending state before the listing window, so it is requested individually
+        self.assertEqual(statuses, {
+            '1': {'state': 'PENDING', 'scheduled_start': None, 'scheduled_end': None},
+            '3': {'state': 'PENDING', 'scheduled_start': '2020-01-01T00:00:00', 'scheduled_end': '2020-01-01T01:00:00'},
+            '5': {'state': 'COMPLETED', 'scheduled_start': '2020-01-02T00:00:00',
+                  'scheduled_end': '2020-01-02T01:00:00'},
+        })
+
+    @mock.patch('tom_observations.facilities.lco.make_request')
+    def test_single_status_matches_batch(self, mock_request):
+        blocks = [
+            {'id': 50, 'request': {'id': 5}, 'state': 'COMPLETED', 'start': '2020-01-02T00:00:00',
+             'end': '2020-01-02T01:00:00'},
+            {'id': 51, 'request': {'id': 5}, 'state': 'PENDING', 'start': '2020-01-03T00:00:00',
+             'end': '2020-01-03T01:00:00'},
+        ]
+        request = mock.MagicMock()
+        request.json.return_value = {'state': 'COMPLETED'}
+        observations = mock.MagicMock()
+        observations.json.return_value = blocks
+        mock_request.side_effect = [
+            request, observations,
+            self.listing([]), self.listing([{'requests': [{'id': 5, 'state': 'COMPLETED'}]}]),
+            self.listing([]), self.listing(list(reversed(blocks))),
+        ]
+        single = LCOFacility().get_observation_status('5')
+        self.assertEqual(LCOFacility().get_observation_statuses(['5']), {'5': single})
+        self.assertEqual(single['scheduled_start'], '2020-01-02T00:00:00')
+
+
+@override_settings(TOM_FACILITY_CLASSES=['tom_observations.tests.utils.FakeFacility'])
+class TestTerminalStatus(TestCase):
+    def setUp(self):
+        self.target = TargetFactory.create()
+        self.record = ObservingRecordFactory.create(
+            target_id=self.target.id, facility=FakeFacility.name, status='PENDING', parameters='{}'
+        )
+
+    def test_terminal_computed_on_status_change(self):
+        self.assertFalse(self.record.terminal)
+        self.assertEqual(self.target.future_observations, [self.record])
+        self.record.status = 'COMPLETED'
+        self.record.save()
+        self.assertTrue(ObservationRecord.objects.get(pk=self.record.id).terminal)
+        self.assertEqual(self.target.future_observations, [])
+
+    def test_unknown_facility_not_terminal(self):
+        record = ObservingRecordFactory.create(
+            target_id=self.target.id, facility='Unknown', status='COMPLETED', parameters='{}'
+        )
+        self.assertFalse(record.terminal)
+
+    @override_settings(TOM_FACILITY_CLASSES=[
+        'tom_observations.tests.utils.FakeFacility', 'tom_observations.tests.utils.StubPortalFacility'
+    ])
+    def test_populate_terminal_skips_failing_facility(self):
+        migration = import_module('tom_observations.migrations.0004_observationrecord_terminal')
+        failing = ObservingRecordFactory.create(
+            target_id=self.target.id, facility=StubPortalFacility.name, status='COMPLETED', parameters='{}'
+        )
+        ObservationRecord.objects.update(status='COMPLETED', terminal=False)
+        error = ValueError('misconfigured')
+        with mock.patch.object(StubPortalFacility, 'get_terminal_observing_states', side_effect=error):
+            with self.assertLogs(migration.logger, 'WARNING') as logs:
+                migration.populate_terminal(apps, None)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn(StubPortalFacility.name, logs.output[0])
+        self.assertTrue(ObservationRecord.objects.get(pk=self.record.pk).terminal)
+        self.assertFalse(ObservationRecord.objects.get(pk=failing.pk).terminal)
+
+    def test_future_observations_single_query(self):
+        for i in range(5):
+            ObservingRecordFactory.create(
+                target_id=self.target.id, facility=FakeFacility.name, status='COMPLETED', parameters='{}'
+            )
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.target.future_observations), 1)
+
+
+@override_settings(TOM_FACILITY_CLASSES=['tom_observations.tests.utils.FakeFacility'])
+class TestObservationRecordChanges(TestCase):
+    def setUp(self):
+        self.target = TargetFactory.create()
+        record = ObservingRecordFactory.create(
+            target_id=self.target.id, facility=FakeFacility.name, status='PENDING', parameters='{}',
+            scheduled_start=datetime(2020, 1, 1, tzinfo=timezone.utc)
+        )
+        self.record = ObservationRecord.objects.get(pk=record.id)
+
+    def test_unchanged_record_not_saved(self):
+        with self.assertNumQueries(0):
+            self.record.save()
+        status = {'state': 'PENDING', 'scheduled_start': '2020-01-01T00:00:00Z', 'scheduled_end': None}
+        with self.assertNumQueries(0):
+            self.assertFalse(FakeFacility().apply_observation_status(self.record, status))
+
+    @mock.patch('tom_observations.models.run_hook')
+    def test_status_change_saves_changed_fields(self, run_hook_mock):
+        self.record.status = 'COMPLETED'
+        with self.assertNumQueries(1) as queries:
+            self.record.save()
+        sql = queries.captured_queries[0]['sql']
+        self.assertIn('"terminal"', sql)
+        self.assertNotIn('"parameters"', sql)
+        run_hook_mock.assert_called_once_with('observation_change_state', self.record, 'PENDING')
+        self.assertTrue(ObservationRecord.objects.get(pk=self.record.id).terminal)
+
+        # Saving again without changes neither writes nor runs the hook
+        with self.assertNumQueries(0):
+            self.record.save()
+        self.assertEqual(run_hook_mock.call_count, 1)
+
+    @mock.patch('tom_observations.models.run_hook')
+    def test_refresh_from_db_resets_loaded_values(self, run_hook_mock):
+        ObservationRecord.objects.filter(pk=self.record.id).update(status='COMPLETED')
+        self.record.refresh_from_db()
+        self.assertEqual(self.record.get_dirty_fields(), [])
+        with self.assertNumQueries(0):
+            self.record.save()
+
+        self.record.status = 'CANCELED'
+        self.record.save()
+        run_hook_mock.assert_called_once_with('observation_change_state', self.record, 'COMPLETED')
+
+    @mock.patch('tom_observations.models.run_hook')
+    def test_update_fields_without_status(self, run_hook_mock):
+        self.record.status = 'COMPLETED'
+        self.record.observation_id = 'changed'
+        self.record.save(update_fields=['observation_id'])
+        run_hook_mock.assert_not_called()
+        stored = ObservationRecord.objects.get(pk=self.record.id)
+        self.assertEqual((stored.observation_id, stored.status), ('changed', 'PENDING'))
+
+        # The unsaved status change is still written, and reported, by the next save
+        self.assertEqual(self.record.get_dirty_fields(), ['status'])
+        self.record.save()
+        run_hook_mock.assert_called_once_with('observation_change_state', self.record, 'PENDING')
+        self.assertTrue(ObservationRecord.objects.get(pk=self.record.id).terminal)
+
+    @mock.patch('tom_observations.models.run_hook')
+    def test_record_built_with_id_uses_stored_status(self, run_hook_mock):
+        record = ObservationRecord(
+            id=self.record.id, target_id=self.target.id, facility=FakeFacility.name, status='COMPLETED',
+            parameters='{}', observation_id=self.record.observation_id, created=self.record.created
+        )
+        record.save()
+        run_hook_mock.assert_called_once_with('observation_change_state', record, 'PENDING')
+        self.assertTrue(ObservationRecord.objects.get(pk=self.record.id).terminal)
+        self.assertEqual(ObservationRecord.objects.count(), 1)
+
+
+@override_settings(
+    TOM_FACILITY_CLASSES=[
+        'tom_observations.tests.utils.FakeFacility', 'tom_observations.tests.utils.StubPortalFacility'
+    ],
+    FACILITIES={'StubPortalFacility': {'sync_workers': 3, 'http_retries': 2, 'http_backoff': 0}}
+)
+class TestStatusSync(TestCase):
+    def setUp(self):
+        self.target = TargetFactory.create()
+
+    def create_records(self, observation_ids, facility=StubPortalFacility.name):
+        return [
+            ObservingRecordFactory.create(
+                target_id=self.target.id, facility=facility, observation_id=observation_id, status='PENDING',
+                parameters='{}'
+            ) for observation_id in observation_ids
+        ]
+
+    def test_sync_bounded_concurrency(self):
+        observation_ids = [str(i) for i in range(12)]
+        self.create_records(observation_ids)
+        self.create_records(['fake'], facility=FakeFacility.name)
+        with StubPortalServer({i: ['COMPLETED'] for i in observation_ids}, delay=0.05) as server:
+            with mock.patch.object(StubPortalFacility, 'portal_url', server.url):
+                report = sync_observation_statuses()
+        self.assertEqual(report.facilities[StubPortalFacility.name]['updated'], 12)
+        self.assertEqual(report.facilities[FakeFacility.name]['updated'], 1)
+        self.assertTrue(report.success)
+        self.assertEqual(ObservationRecord.objects.filter(terminal=True).count(), 13)
+        self.assertGreater(server.max_in_flight, 1)
+        self.assertLessEqual(server.max_in_flight, 3)
+
+    def test_sync_retries_and_reports_failures(self):
+        self.create_records(['flaky', 'broken', 'denied', 'pending'])
+        statuses = {'flaky': [503, 'COMPLETED'], 'broken': [500], 'denied': [403], 'pending': ['PENDING']}
+        with StubPortalServer(statuses) as server:
+            with mock.patch.object(StubPortalFacility, 'portal_url', server.url):
+                report = sync_observation_statuses(facility_names=[StubPortalFacility.name])
+        summary = report.facilities[StubPortalFacility.name]
+        self.assertEqual((summary['updated'], summary['unchanged']), (1, 1))
+        self.assertEqual(sorted(observation_id for observation_id, _ in summary['failed']), ['broken', 'denied'])
+        # The session retries the flaky request once, the server error twice, and the client error not at all, and
+        # the sync engine does not retry any of them again
+        self.assertEqual(server.request_count, 2 + 3 + 1 + 1)
+        self.assertFalse(report.success)
+        self.assertIn('StubPortalFacility: 1 updated, 1 unchanged, 2 failed', str(report))
+
+    def test_sync_batch_statuses(self):
+        observation_ids = [str(i) for i in range(10)]
+        self.create_records(observation_ids)
+        statuses = {i: {'state': 'COMPLETED', 'scheduled_start': None, 'scheduled_end': None} for i in observation_ids}
+        del statuses['0']
+        with StubPortalServer({'0': ['COMPLETED']}) as server:
+            with mock.patch.object(StubPortalFacility, 'portal_url', server.url):
+                with mock.patch.object(StubPortalFacility, 'get_observation_statuses', return_value=statuses):
+                    report = sync_observation_statuses(facility_names=[StubPortalFacility.name])
+        self.assertEqual(report.facilities[StubPortalFacility.name]['updated'], 10)
+        # Only the observation missing from the batch is requested individually
+        self.assertEqual(server.request_count, 1)
+
+    def test_sync_failed_batch_falls_back(self):
+        observation_ids = [str(i) for i in range(3)]
+        self.create_records(observation_ids)
+        with StubPortalServer({i: ['COMPLETED'] for i in observation_ids}) as server:
+            with mock.patch.object(StubPortalFacility, 'portal_url', server.url):
+                with mock.patch.object(StubPortalFacility, 'get_observation_statuses', side_effect=ValueError):
+                    report = sync_observation_statuses(facility_names=[StubPortalFacility.name])
+        self.assertEqual(report.facilities[StubPortalFacility.name]['updated'], 3)
+        self.assertEqual(server.request_count, 3)
+
+    @override_settings(FACILITIES={'StubPortalFacility': {'sync_workers': 1}})
+    def test_sync_error_cancels_pending_requests(self):
+        observation_ids = [str(i) for i in range(6)]
+        self.create_records(observation_ids)
+        with StubPortalServer({i: ['COMPLETED'] for i in observation_ids}, delay=0.05) as server:
+            with mock.patch.object(StubPortalFacility, 'portal_url', server.url):
+                with mock.patch('tom_observations.sync._FacilitySync.apply', side_effect=RuntimeError):
+                    with mock.patch('tom_observations.sync._FacilitySync.fail', side_effect=RuntimeError):
+                        with self.assertRaises(RuntimeError):
+                            sync_observation_statuses(facility_names=[StubPortalFacility.name])
+                request_count = server.request_count
+                time.sleep(0.2)
+                # No requests are made after the function has returned
+                self.assertEqual(server.request_count, request_count)
+                self.assertLess(request_count, 6)
+
+    @override_settings(FACILITIES={'StubPortalFacility': {'sync_workers': 5, 'sync_rate_limit': 20}})
+    def test_sync_rate_limit(self):
+        observation_ids = [str(i) for i in range(5)]
+        self.create_records(observation_ids)
+        with StubPortalServer({i: ['COMPLETED'] for i in observation_ids}) as server:
+            with mock.patch.object(StubPortalFacility, 'portal_url', server.url):
+                report = sync_observation_statuses(facility_names=[StubPortalFacility.name])
+        self.assertEqual(report.facilities[StubPortalFacility.name]['updated'], 5)
+        self.assertGreaterEqual(report.facilities[StubPortalFacility.name]['elapsed'], 0.19)
+
+    def test_updatestatus_command(self):
+        self.create_records(['1'])
+        with StubPortalServer({'1': ['COMPLETED']}) as server:
+            with mock.patch.object(StubPortalFacility, 'portal_url', server.url):
+                out = StringIO()
+                call_command('updatestatus', target_id=self.target.id, stdout=out)
+        self.assertIn('StubPortalFacility: 1 updated', out.getvalue())
+        self.assertIn('Update completed successfully', out.getvalue())
+
+
+@override_settings(FACILITIES={'StubPortalFacility': {'http_timeout': 5, 'http_retries': 2, 'http_backoff': 0}})
+class TestFacilitySessions(TestCase):
+    def test_session_shared_per_facility(self):
+        session = get_session(StubPortalFacility.name)
+        self.assertIs(get_session(StubPortalFacility.name), session)
+        self.assertIsNot(get_session(FakeFacility.name), session)
+        self.assertEqual(session.timeout, 5)
+        self.assertEqual(session.get_adapter('https://example.com').max_retries.total, 2)
+
+    def test_session_retries_server_errors(self):
+        with StubPortalServer({'1': [503, 429, 'COMPLETED'], '2': [500]}) as server:
+            session = get_session(StubPortalFacility.name)
+            response = session.get('{0}/api/requests/1'.format(server.url))
+            self.assertEqual(response.json()['state'], 'COMPLETED')
+            self.assertEqual(server.request_count, 3)
+            # Once the retries are exhausted the last response is returned
+            self.assertEqual(session.get('{0}/api/requests/2'.format(server.url)).status_code, 500)
+            self.assertEqual(server.request_count, 6)
+
+    @mock.patch('tom_observations.facilities.lco.get_session')
+    def test_rate_limiting_is_not_a_credentials_error(self, mock_session):
+        mock_session.return_value.request.return_value.status_code = 429
+        with self.assertRaises(RateLimitedException):
+            make_request('GET', 'https://observe.lco.global/api/requests/1/')
+        mock_session.return_value.request.return_value.status_code = 401
+        with self.assertRaises(ImproperCredentialsException):
+            make_request('GET', 'https://observe.lco.global/api/requests/1/')
+
 
 class TestGetVisibility(TestCase):
     def setUp(self):
@@ -164,3 +646,164 @@ class TestGetVisibility(TestCase):
         self.assertEqual(len(airmass_data), len(expected_airmass))
         for i in range(0, len(expected_airmass)):
             self.assertAlmostEqual(airmass_data[i], expected_airmass[i], places=3)
+
+    @mock.patch('tom_observations.utils.facility.get_service_classes')
+    def test_get_targets_visibility_matches_astroplan(self, mock_facility):
+        mock_facility.return_value = {'Fake Facility': FakeFacility}
+        targets = [
+            self.target,
+            Target(ra=(self.target.ra + 20) % 360, dec=-60, type=Target.SIDEREAL),
+            Target(ra=self.target.ra, dec=80, type=Target.SIDEREAL),
+        ]
+        end = self.start + timedelta(hours=12)
+        visibility = get_targets_visibility(targets, self.start, end, 30, 3)
+        time_range = get_astroplan_sun_and_time(self.start, end, 30)[1]
+        for site, site_details in FakeFacility().get_observing_sites().items():
+            observer = Observer(longitude=site_details['longitude']*units.deg,
+                                latitude=site_details['latitude']*units.deg,
+                                elevation=site_details['elevation']*units.m)
+            sun_alt = observer.altaz(time_range, get_sun(time_range)).alt.deg
+            for target, target_visibility in zip(targets, visibility):
+                single_visibility = get_sidereal_visibility(target, self.start, end, 30, 3)
+                self.assertEqual({k: v[1] for k, v in target_visibility.items()},
+                                 {k: v[1] for k, v in single_visibility.items()})
+                body = FixedTarget(coord=SkyCoord(target.ra, target.dec, unit='deg'))
+                expected = observer.altaz(time_range, body).secz
+                for airmass, expected_airmass, sun in zip(target_visibility[f'(Fake Facility) {site}'][1],
+                                                          expected, sun_alt):
+                    if airmass is None:
+                        # Only times within a hair of the limits may differ
+                        self.assertTrue(expected_airmass >= 2.99 or expected_airmass <= 1 or sun > -18.5)
+                    else:
+                        self.assertAlmostEqual(airmass / float(expected_airmass), 1, places=3)
+
+    @mock.patch('tom_observations.utils.facility.get_service_classes')
+    def test_get_target_list_visibility(self, mock_facility):
+        mock_facility.return_value = {'Fake Facility': FakeFacility}
+        self.target.save()
+        non_sidereal = TargetFactory.create(type=Target.NON_SIDEREAL)
+        comet = TargetFactory.create(
+            type=Target.NON_SIDEREAL, scheme='MPC_COMET', epoch=59000, epoch_of_perihelion=2459000.5, perihdist=0.5,
+            eccentricity=0.9, inclination=40, lng_asc_node=80, arg_of_perihelion=120
+        )
+        target_list = TargetList.objects.create(name='plan')
+        target_list.targets.add(self.target, non_sidereal, comet)
+        end = self.start + timedelta(minutes=60)
+        visibility = get_target_list_visibility(target_list, self.start, end, self.interval, self.airmass_limit)
+        self.assertEqual(set(visibility), {self.target, non_sidereal, comet})
+        single_visibility = get_sidereal_visibility(self.target, self.start, end, self.interval, self.airmass_limit)
+        self.assertEqual({k: v[1] for k, v in visibility[self.target].items()},
+                         {k: v[1] for k, v in single_visibility.items()})
+        # Non-sidereal targets are followed along their orbits, or have no visibility without orbital elements
+        self.assertEqual(visibility[non_sidereal], {})
+        comet_visibility = get_visibility(comet, self.start, end, self.interval, self.airmass_limit)
+        self.assertTrue(comet_visibility)
+        self.assertEqual({k: v[1] for k, v in visibility[comet].items()},
+                         {k: v[1] for k, v in comet_visibility.items()})
+
+
+class TestOrbits(TestCase):
+    def setUp(self):
+        # Mean J2000 elements of Mars
+        self.mars = Target(
+            type=Target.NON_SIDEREAL, scheme='JPL_MAJOR_PLANET', epoch=2451545.0, semimajor_axis=1.52371034,
+            eccentricity=0.09339410, inclination=1.84969142, lng_asc_node=49.55953891,
+            arg_of_perihelion=-23.94362959 - 49.55953891, mean_anomaly=-4.55343205 + 23.94362959,
+            mean_daily_motion=0.5240207766
+        )
+        self.times = Time('2000-03-01') + np.linspace(0, 60, 7) * units.day
+
+    def comet(self, eccentricity):
+        return Target(
+            type=Target.NON_SIDEREAL, scheme='MPC_COMET', epoch=59000, epoch_of_perihelion=2459000.5, perihdist=0.5,
+            eccentricity=eccentricity, inclination=40, lng_asc_node=80, arg_of_perihelion=120
+        )
+
+    def test_planet_matches_astropy(self):
+        ra, dec = get_orbital_coordinates([self.mars], self.times)
+        mars = get_body('mars', self.times)
+        self.assertLess(np.abs(ra[0] - mars.ra.deg).max(), 0.02)
+        self.assertLess(np.abs(dec[0] - mars.dec.deg).max(), 0.02)
+
+    def test_modified_julian_date_epoch(self):
+        ra, dec = get_orbital_coordinates([self.mars], self.times)
+        self.mars.epoch = 51544.5
+        self.assertTrue(np.allclose(get_orbital_coordinates([self.mars], self.times), (ra, dec)))
+
+    def test_parabolic_orbits(self):
+        times = Time(59000, format='mjd', scale='tt') + np.linspace(-30, 30, 7) * units.day
+        ra, dec = get_orbital_coordinates([self.comet(1), self.comet(0.99999), self.comet(1.00001)], times)
+        self.assertEqual(ra.shape, (3, 7))
+        self.assertLess(np.abs(ra[1:] - ra[0]).max(), 0.001)
+        self.assertLess(np.abs(dec[1:] - dec[0]).max(), 0.001)
+
+    @mock.patch('tom_observations.utils.facility.get_service_classes')
+    def test_non_sidereal_visibility(self, mock_facility):
+        mock_facility.return_value = {'Fake Facility': FakeFacility}
+        start = datetime(2000, 3, 1)
+        visibility = get_visibility(self.mars, start, start + timedelta(days=1), 30, 10)
+        times = get_astroplan_sun_and_time(start, start + timedelta(days=1), 30)[1]
+        checked = 0
+        for site, site_details in FakeFacility().get_observing_sites().items():
+            observer = Observer(longitude=site_details['longitude']*units.deg,
+                                latitude=site_details['latitude']*units.deg,
+                                elevation=site_details['elevation']*units.m)
+            expected = observer.altaz(times, get_body('mars', times)).secz
+            for airmass, expected_airmass in zip(visibility[f'(Fake Facility) {site}'][1], expected):
+                if airmass is not None:
+                    self.assertAlmostEqual(airmass / float(expected_airmass), 1, places=2)
+                    checked += 1
+        self.assertGreater(checked, 0)
+        self.assertEqual(get_visibility(Target(type=Target.NON_SIDEREAL), start, start + timedelta(days=1), 30, 10),
+                         {})
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestSiteEphemerides(TestCase):
+    def setUp(self):
+        utils._ephemeris_tables.clear()
+        self.sites = list(FakeFacility().get_observing_sites().values())
+        self.day = datetime(2018, 10, 10).date()
+
+    def test_tables_are_cached(self):
+        tables = get_site_ephemerides(self.sites, self.day)
+        self.assertEqual(len(tables), 2)
+        self.assertEqual(len(tables[0]['mjd']), 145)
+        with mock.patch('tom_observations.utils.get_sun') as mock_get_sun:
+            self.assertIs(get_site_ephemerides(self.sites, self.day)[0], tables[0])
+            utils._ephemeris_tables.clear()
+            cached = get_site_ephemerides(self.sites, self.day)
+            mock_get_sun.assert_not_called()
+        self.assertEqual(list(cached[1]['sun_altitude']), list(tables[1]['sun_altitude']))
+
+    def test_twilights(self):
+        table = get_site_ephemerides(self.sites[:1], self.day)[0]
+        self.assertEqual(len(table['evening_twilights']), 1)
+        self.assertEqual(len(table['morning_twilights']), 1)
+        for twilight in (table['evening_twilights'][0], table['morning_twilights'][0]):
+            altitude = get_sun_altitudes(self.sites[:1], Time([twilight], format='mjd'))[0][0]
+            self.assertAlmostEqual(altitude, -18, places=2)
+
+    def test_sun_altitudes_match_astroplan(self):
+        start = datetime(2018, 10, 9, 13, 56, 16)
+        times = get_time_grid(start, start + timedelta(days=2), 7)
+        altitudes = get_sun_altitudes(self.sites, times)
+        for site_details, site_altitudes in zip(self.sites, altitudes):
+            observer = Observer(longitude=site_details['longitude']*units.deg,
+                                latitude=site_details['latitude']*units.deg,
+                                elevation=site_details['elevation']*units.m)
+            expected = observer.altaz(times, get_sun(times)).alt.deg
+            self.assertLess(max(abs(site_altitudes - expected)), 0.1)
+
+    @mock.patch('tom_observations.utils.facility.get_service_classes')
+    def test_precompute_command(self, mock_facility):
+        mock_facility.return_value = {'Fake Facility': FakeFacility}
+        out = StringIO()
+        call_command('precomputeephemeris', nights=1, stdout=out)
+        self.assertIn('Ephemeris tables cached successfully', out.getvalue())
+        today = datetime.utcnow().date()
+        utils._ephemeris_tables.clear()
+        with mock.patch('tom_observations.utils.get_sun') as mock_get_sun:
+            get_site_ephemerides(self.sites, today)
+            get_site_ephemerides(self.sites, today + timedelta(days=1))
+            mock_get_sun.assert_not_called()
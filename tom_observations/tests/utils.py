@@ -1,9 +1,16 @@
 from django import forms
 from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import json
+import threading
+import time
+
 from django.utils import timezone
 from astropy import units
 
 from tom_observations.facility import GenericObservationFacility, GenericObservationForm
+from tom_observations.sessions import get_session
 
 # Site data matches built-in pyephem observer data for Los Angeles
 SITES = {
@@ -62,3 +69,126 @@ class FakeFacility(GenericObservationFacility):
 
     def validate_observation(self, observation_payload):
         return True
+
+
+class StubPortalHandler(BaseHTTPRequestHandler):
+    """
+    Serves observation statuses from ``server.statuses``, a dictionary of observation ids to lists of responses. Each
+    request consumes the first response in the list, unless it is the last one: an integer response is sent as an
+    error with that status code, and a string as the state of the observation.
+    """
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.request_count += 1
+            responses = server.statuses.get(self.path.rstrip('/').rsplit('/', 1)[-1], [404])
+            response = responses.pop(0) if len(responses) > 1 else responses[0]
+        time.sleep(server.delay)
+        if isinstance(response, int):
+            self.send_response(response)
+            self.end_headers()
+        else:
+            body = json.dumps({'state': response}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        with server.lock:
+            server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class StubPortalServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server standing in for a facility portal, for testing code that talks to facilities over HTTP.
+    """
+    daemon_threads = True
+
+    handler_class = StubPortalHandler
+
+    def __init__(self, statuses=None, delay=0):
+        super().__init__(('127.0.0.1', 0), self.handler_class)
+        self.statuses = statuses or {}
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.request_count = 0
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class StubFileHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files in ``server.files``, a dictionary of paths to contents, supporting range requests.
+    """
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            server.ranges.append(self.headers.get('Range'))
+        content = server.files.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        status = 200
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(content):
+                self.send_response(416)
+                self.end_headers()
+                return
+            content = content[start:]
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubFileServer(StubPortalServer):
+    """
+    Local HTTP server standing in for a facility archive, for testing data product downloads.
+    """
+    handler_class = StubFileHandler
+
+    def __init__(self, files=None):
+        super().__init__()
+        self.files = files or {}
+        self.ranges = []
+
+
+class StubPortalFacility(FakeFacility):
+    """
+    Facility that requests observation statuses from a ``StubPortalServer`` at ``portal_url``, through its pooled
+    HTTP session.
+    """
+    name = 'StubPortalFacility'
+    portal_url = None
+
+    def get_observation_status(self, observation_id):
+        response = get_session(self.name).get('{0}/api/requests/{1}'.format(self.portal_url, observation_id))
+        response.raise_for_status()
+        return {'state': response.json()['state'], 'scheduled_start': None, 'scheduled_end': None}
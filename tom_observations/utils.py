@@ -1,26 +1,440 @@
-from astropy.coordinates import get_sun, SkyCoord
+from collections import OrderedDict
+from datetime import date, timedelta
+import threading
+from astropy.coordinates import FK5, get_body, get_sun, SkyCoord
 from astropy import units
 from astropy.time import Time
-from astroplan import Observer, FixedTarget, time_grid_from_range
+from astropy.utils.iers import IERSRangeError
+from astroplan import FixedTarget, moon_illumination, time_grid_from_range
+from django.conf import settings
+from django.core.cache import cache
 import numpy as np
 import logging
 
 from tom_observations import facility
+from tom_observations.orbits import get_orbital_coordinates, has_orbital_elements
+from tom_targets.astrometry import julian_year, target_positions
+from tom_targets.models import Target
 
 logger = logging.getLogger(__name__)
 
+# Altitude of the sun, in degrees, below which it is night, i.e. between astronomical twilights
+TWILIGHT_ALTITUDE = -18
+
+try:
+    EPHEMERIS_RESOLUTION = settings.EPHEMERIS_RESOLUTION
+except AttributeError:
+    EPHEMERIS_RESOLUTION = 10
+
+try:
+    EPHEMERIS_CACHE_TIMEOUT = settings.EPHEMERIS_CACHE_TIMEOUT
+except AttributeError:
+    EPHEMERIS_CACHE_TIMEOUT = 30 * 24 * 3600
+
+# Number of ephemeris tables kept in memory by each process, in addition to the Django cache
+EPHEMERIS_MEMORY_SIZE = 512
+MJD_EPOCH = date(1858, 11, 17)
+
+_ephemeris_tables = OrderedDict()
+_ephemeris_lock = threading.Lock()
+
+
+def get_all_observing_sites():
+    """
+    Returns the observing sites of all facilities available in the TOM.
+
+    :returns: ordered dictionary of site labels, consisting of the site name prepended with the observing facility, to
+        site details with a latitude, longitude and elevation
+    :rtype: OrderedDict
+    """
+    sites = OrderedDict()
+    for facility_name, facility_class in facility.get_service_classes().items():
+        for site, site_details in facility_class().get_observing_sites().items():
+            sites[f'({facility_name}) {site}'] = site_details
+    return sites
+
+
+def get_time_grid(start_time, end_time, interval):
+    """
+    Returns the times at which visibility is calculated.
+
+    :param start_time: start of the window
+    :type start_time: datetime
+
+    :param end_time: end of the window
+    :type end_time: datetime
+
+    :param interval: time interval, in minutes, between the times
+    :type interval: int
+
+    :rtype: astropy Time
+    """
+    return time_grid_from_range(time_range=[Time(start_time), Time(end_time)], time_resolution=interval*units.minute)
+
+
+def _equatorial_of_date(ra, dec, times):
+    """
+    Precesses ICRS coordinates, in degrees, to the mean equator and equinox of the middle of ``times``.
+
+    :returns: right ascensions and declinations in radians
+    :rtype: tuple
+    """
+    equinox = times[len(times) // 2]
+    coords = SkyCoord(ra, dec, unit='deg', frame='icrs').transform_to(FK5(equinox=equinox))
+    return coords.ra.radian, coords.dec.radian
+
+
+def _local_sidereal_times(sites, times):
+    """
+    :returns: local mean sidereal times in radians, of shape (M, T) for M sites and T times
+    :rtype: numpy.ndarray
+    """
+    longitudes = np.radians([site['longitude'] for site in sites])
+    try:
+        greenwich = times.sidereal_time('mean', longitude=0).radian
+    except IERSRangeError:
+        # Times beyond the downloaded Earth rotation tables fall back to UT1 = UTC, which is off by under a second
+        times = times.copy()
+        times.delta_ut1_utc = 0
+        greenwich = times.sidereal_time('mean', longitude=0).radian
+    return greenwich[np.newaxis, :] + longitudes[:, np.newaxis]
+
+
+def _sin_altitudes(ra, dec, sites, lst):
+    """
+    Computes the sines of the altitudes of positions as seen from sites, broadcasting over positions, sites and times.
+
+    :param ra: right ascensions of date in radians, of shape (N, 1, 1) for fixed or (1, 1, T) for moving positions
+    :param dec: declinations of date in radians, of the same shape as ``ra``
+    :param sites: site details with a latitude in degrees, M sites
+    :param lst: local sidereal times of the sites in radians, of shape (M, T)
+
+    :rtype: numpy.ndarray of shape (N, M, T)
+    """
+    latitudes = np.radians([site['latitude'] for site in sites])[np.newaxis, :, np.newaxis]
+    hour_angles = lst[np.newaxis, :, :] - ra
+    return np.sin(latitudes) * np.sin(dec) + np.cos(latitudes) * np.cos(dec) * np.cos(hour_angles)
+
+
+def _body_altitudes(body, sites, times):
+    """
+    Computes the altitude of a solar system body, given by its geocentric positions at ``times``, at each of M sites.
+
+    :returns: altitudes in degrees, of shape (M, T)
+    :rtype: numpy.ndarray
+    """
+    ra, dec = _equatorial_of_date(body.ra.deg, body.dec.deg, times)
+    sin_altitudes = _sin_altitudes(ra[np.newaxis, np.newaxis, :], dec[np.newaxis, np.newaxis, :],
+                                   sites, _local_sidereal_times(sites, times))
+    return np.degrees(np.arcsin(np.clip(sin_altitudes[0], -1, 1)))
+
+
+def _crossings(mjd, altitudes, altitude):
+    """
+    :returns: times, as MJDs, at which the altitudes cross ``altitude`` downwards and upwards
+    :rtype: tuple
+    """
+    above = altitudes > altitude
+    setting = np.flatnonzero(above[:-1] & ~above[1:])
+    rising = np.flatnonzero(~above[:-1] & above[1:])
+
+    def interpolate(i):
+        fraction = (altitudes[i] - altitude) / (altitudes[i] - altitudes[i + 1])
+        return mjd[i] + fraction * (mjd[i + 1] - mjd[i])
+    return interpolate(setting), interpolate(rising)
+
+
+def _ephemeris_key(site, day, resolution):
+    return 'site_ephemeris_{0}_{1}_{2}_{3}_{4}'.format(
+        site['latitude'], site['longitude'], site.get('elevation', 0), day.isoformat(), resolution
+    )
+
+
+def _compute_ephemerides(sites, day, resolution):
+    """
+    Computes the ephemeris tables of several sites for a UTC date, sharing the positions of the sun and moon.
+    """
+    start = (day - MJD_EPOCH).days
+    mjd = start + np.linspace(0, 1, int(np.ceil(24 * 60 / resolution)) + 1)
+    times = Time(mjd, format='mjd', scale='utc')
+    sun_altitudes = _body_altitudes(get_sun(times), sites, times)
+    # The geocentric position of the moon is used, which may be off by up to a degree from where it is seen
+    moon_altitudes = _body_altitudes(get_body('moon', times), sites, times)
+    illumination = np.asarray(moon_illumination(times))
+    tables = []
+    for sun_altitude, moon_altitude in zip(sun_altitudes, moon_altitudes):
+        evening_twilights, morning_twilights = _crossings(mjd, sun_altitude, TWILIGHT_ALTITUDE)
+        tables.append({
+            'mjd': mjd,
+            'sun_altitude': sun_altitude,
+            'moon_altitude': moon_altitude,
+            'moon_illumination': illumination,
+            'evening_twilights': evening_twilights,
+            'morning_twilights': morning_twilights,
+        })
+    return tables
+
+
+def get_site_ephemerides(sites, day, resolution=None):
+    """
+    Returns the tables of the altitude of the sun and moon, the illuminated fraction of the moon, and the astronomical
+    twilights at each site over a UTC date. These do not depend on any target, so the tables are kept in memory and
+    in the Django cache, keyed by site, date and resolution, and only tables missing from both are calculated.
+
+    :param sites: site details with a latitude and longitude in degrees
+    :type sites: list
+
+    :param day: UTC date of the tables
+    :type day: date
+
+    :param resolution: time interval, in minutes, between the rows of the tables, defaults to ``EPHEMERIS_RESOLUTION``
+    :type resolution: int
+
+    :returns: for each site, a dictionary of arrays with the ``mjd`` of each row, the ``sun_altitude``,
+        ``moon_altitude`` and ``moon_illumination`` at that time, and the MJDs of the ``evening_twilights`` and
+        ``morning_twilights`` during the date
+    :rtype: list
+    """
+    resolution = resolution or EPHEMERIS_RESOLUTION
+    keys = [_ephemeris_key(site, day, resolution) for site in sites]
+    with _ephemeris_lock:
+        tables = {key: _ephemeris_tables[key] for key in keys if key in _ephemeris_tables}
+    missing = [key for key in keys if key not in tables]
+    if missing:
+        tables.update(cache.get_many(missing))
+        missing_sites = {key: site for key, site in zip(keys, sites) if key not in tables}
+        if missing_sites:
+            computed = dict(zip(missing_sites, _compute_ephemerides(list(missing_sites.values()), day, resolution)))
+            cache.set_many(computed, EPHEMERIS_CACHE_TIMEOUT)
+            tables.update(computed)
+        with _ephemeris_lock:
+            for key in missing:
+                _ephemeris_tables[key] = tables[key]
+            while len(_ephemeris_tables) > EPHEMERIS_MEMORY_SIZE:
+                _ephemeris_tables.popitem(last=False)
+    return [tables[key] for key in keys]
+
+
+def _interpolate_ephemerides(sites, times, column):
+    """
+    Interpolates a column of the ephemeris tables of each of M sites, for all UTC dates spanned by ``times``, to each
+    of T times.
+
+    :returns: values of shape (M, T)
+    :rtype: numpy.ndarray
+    """
+    mjd = times.utc.mjd
+    first, last = (MJD_EPOCH + timedelta(days=int(np.floor(day))) for day in (mjd.min(), mjd.max()))
+    days = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+    site_tables = list(zip(*(get_site_ephemerides(sites, day) for day in days)))
+    return np.array([
+        np.interp(mjd, np.concatenate([table['mjd'] for table in tables]),
+                  np.concatenate([table[column] for table in tables]))
+        for tables in site_tables
+    ])
+
+
+def get_sun_altitudes(sites, times):
+    """
+    Returns the altitude of the sun at each of M sites at each of T times, interpolated from the cached ephemeris
+    tables of the sites.
+
+    :param sites: site details with a latitude and longitude in degrees
+    :type sites: list
+
+    :param times: times at which to calculate the altitude
+    :type times: astropy Time
+
+    :returns: altitudes in degrees, of shape (M, T)
+    :rtype: numpy.ndarray
+    """
+    return _interpolate_ephemerides(sites, times, 'sun_altitude')
+
+
+def get_moon_altitudes(sites, times):
+    """
+    Returns the altitude of the moon at each of M sites at each of T times, interpolated from the cached ephemeris
+    tables of the sites.
+
+    :param sites: site details with a latitude and longitude in degrees
+    :type sites: list
+
+    :param times: times at which to calculate the altitude
+    :type times: astropy Time
+
+    :returns: altitudes in degrees, of shape (M, T)
+    :rtype: numpy.ndarray
+    """
+    return _interpolate_ephemerides(sites, times, 'moon_altitude')
+
+
+def get_airmasses(ra, dec, sites, times):
+    """
+    Computes the airmass, as the secant of the zenith angle, of each of N positions at each of M sites at each of T
+    times in a single pass. Positions below the horizon have negative airmasses.
+
+    :param ra: right ascensions of the positions in degrees, of shape (N,) for fixed positions or (N, T) for positions
+        that move over the times
+    :type ra: list
+
+    :param dec: declinations of the positions in degrees, of the same shape as ``ra``
+    :type dec: list
+
+    :param sites: site details with a latitude and longitude in degrees
+    :type sites: list
+
+    :param times: times at which to calculate the airmass
+    :type times: astropy Time
+
+    :returns: airmasses of shape (N, M, T)
+    :rtype: numpy.ndarray
+    """
+    ra, dec = _equatorial_of_date(np.asarray(ra, dtype=float), np.asarray(dec, dtype=float), times)
+    sin_altitudes = _sin_altitudes(ra.reshape(len(ra), 1, -1), dec.reshape(len(dec), 1, -1),
+                                   sites, _local_sidereal_times(sites, times))
+    with np.errstate(divide='ignore'):
+        return 1 / sin_altitudes
+
+
+def get_visibility_masks(airmasses, sun_altitudes, airmass_limit):
+    """
+    Returns which airmasses are observable: below the airmass limit, with the target above the horizon, and at night.
+
+    :param airmasses: airmasses of shape (N, M, T)
+    :type airmasses: numpy.ndarray
+
+    :param sun_altitudes: altitudes of the sun in degrees, of shape (M, T)
+    :type sun_altitudes: numpy.ndarray
+
+    :param airmass_limit: maximum acceptable airmass
+    :type airmass_limit: float
+
+    :rtype: numpy.ndarray of booleans of shape (N, M, T)
+    """
+    return (airmasses < airmass_limit) & (airmasses > 1) & (sun_altitudes <= TWILIGHT_ALTITUDE)[np.newaxis]
+
+
+def get_target_coordinates(targets, times):
+    """
+    Returns the positions of targets at each time. Sidereal targets are moved along their proper motions to the
+    middle of the times, and the positions of non-sidereal targets are propagated from their orbital elements.
+
+    :param targets: sidereal targets and non-sidereal targets with orbital elements, N targets
+    :type targets: list
+
+    :param times: times at which to return the positions, T times
+    :type times: astropy Time
+
+    :returns: right ascensions and declinations in degrees, each of shape (N,) if all targets are sidereal and
+        otherwise of shape (N, T)
+    :rtype: tuple
+    """
+    ra, dec = target_positions(targets, julian_year(times[len(times) // 2].datetime))
+    moving = [i for i, target in enumerate(targets) if target.type != Target.SIDEREAL]
+    if not moving:
+        return ra, dec
+    ra, dec = (np.repeat(coordinate[:, np.newaxis], len(times), axis=1) for coordinate in (ra, dec))
+    ra[moving], dec[moving] = get_orbital_coordinates([targets[i] for i in moving], times)
+    return ra, dec
+
+
+def get_targets_visibility(targets, start_time, end_time, interval, airmass_limit=None, sites=None):
+    """
+    Calculates the airmass of many targets at all observing sites at once, for each interval between the start and
+    end times. Airmasses above the limit, below the horizon or during the day are omitted. Non-sidereal targets are
+    followed along their orbits, and have no airmasses if they lack the orbital elements of their scheme.
+
+    :param targets: sidereal and non-sidereal targets to calculate the airmass for
+    :type targets: list
+
+    :param start_time: start of the window for which to calculate the airmass
+    :type start_time: datetime
+
+    :param end_time: end of the window for which to calculate the airmass
+    :type end_time: datetime
+
+    :param interval: time interval, in minutes, at which to calculate airmass within the given window
+    :type interval: int
+
+    :param airmass_limit: maximum acceptable airmass, defaults to 10
+    :type airmass_limit: float
+
+    :param sites: observing sites keyed by label, defaults to the sites of all facilities
+    :type sites: dict
+
+    :returns: for each target, in the order given, a dictionary of site labels to the airmass data, structured as an
+        array containing the datetimes used in the airmass calculations and the corresponding airmasses, with None for
+        omitted airmasses
+    :rtype: list
+    """
+    if end_time < start_time:
+        raise Exception('Start must be before end')
+    if airmass_limit is None:
+        airmass_limit = 10
+    targets = list(targets)
+    if sites is None:
+        sites = get_all_observing_sites()
+    supported = [target for target in targets if target.type == Target.SIDEREAL or has_orbital_elements(target)]
+    if not supported or not sites:
+        return [{} for target in targets]
+
+    times = get_time_grid(start_time, end_time, interval)
+    site_details = list(sites.values())
+    airmasses = get_airmasses(*get_target_coordinates(supported, times), site_details, times)
+    observable = get_visibility_masks(airmasses, get_sun_altitudes(site_details, times), airmass_limit)
+    datetimes = times.datetime
+    airmasses, observable = airmasses.tolist(), observable.tolist()
+    visibility = {id(target): {
+        label: (datetimes, [
+            airmass if visible else None for airmass, visible in zip(airmasses[i][j], observable[i][j])
+        ]) for j, label in enumerate(sites)
+    } for i, target in enumerate(supported)}
+    return [visibility.get(id(target), {}) for target in targets]
+
+
+def get_target_list_visibility(target_list, start_time, end_time, interval, airmass_limit=None):
+    """
+    Calculates the visibility of all targets of a ``TargetList`` in a single call, as ``get_targets_visibility``
+    does. Non-sidereal targets without the orbital elements of their scheme are included with an empty visibility.
+
+    :param target_list: the group of targets to calculate the visibility of
+    :type target_list: TargetList
+
+    :returns: dictionary of targets to their visibility
+    :rtype: dict
+    """
+    targets = list(target_list.targets.all())
+    visibility = get_targets_visibility(targets, start_time, end_time, interval, airmass_limit)
+    return dict(zip(targets, visibility))
+
+
+def get_visibility(target, start_time, end_time, interval, airmass_limit):
+    """
+    Calculates the airmass for a sidereal target, or a non-sidereal target with orbital elements, for each given
+    interval between the start and end times, at the sites of all facilities. The position of a non-sidereal target is
+    propagated from its orbital elements without any remote service.
+
+    :returns: A dictionary containing the airmass data for each site, as returned by ``get_sidereal_visibility``, or
+        an empty dictionary if the target type or its orbital elements are not supported
+    :rtype: dict
+    """
+    if target.type != Target.SIDEREAL and not has_orbital_elements(target):
+        logger.info('Airmass plotting requires a sidereal target or orbital elements')
+        return {}
+    return get_targets_visibility([target], start_time, end_time, interval, airmass_limit)[0]
+
 
 def get_sidereal_visibility(target, start_time, end_time, interval, airmass_limit):
     """
-    Uses astroplan to calculate the airmass for a sidereal target
-    for each given interval between the start and end times.
+    Calculates the airmass for a sidereal target for each given interval between the start and end times, at the
+    sites of all facilities. See ``get_targets_visibility`` for calculating the airmass of
+    many targets at once.
 
     The resulting data omits any airmass above the provided limit (or
     default, if one is not provided), as well as any airmass calculated
     during the day (defined as between astronomical twilights).
 
-    Important note: only works for sidereal targets! For non-sidereal visibility, see here:
-    https://github.com/TOMToolkit/tom_nonsidereal_airmass
+    Important note: only works for sidereal targets! For non-sidereal visibility, see ``get_visibility``.
 
     :param start_time: start of the window for which to calculate the airmass
     :type start_time: datetime
@@ -47,37 +461,7 @@ def get_sidereal_visibility(target, start_time, end_time, interval, airmass_limi
         empty_visibility = {}
         return empty_visibility
 
-    if end_time < start_time:
-        raise Exception('Start must be before end')
-
-    if airmass_limit is None:
-        airmass_limit = 10
-
-    body = FixedTarget(name=target.name, coord=SkyCoord(target.ra, target.dec, unit='deg'))
-
-    visibility = {}
-    sun, time_range = get_astroplan_sun_and_time(start_time, end_time, interval)
-    for observing_facility in facility.get_service_classes():
-        observing_facility_class = facility.get_service_class(observing_facility)
-        sites = observing_facility_class().get_observing_sites()
-        for site, site_details in sites.items():
-            observer = Observer(longitude=site_details.get('longitude')*units.deg,
-                                latitude=site_details.get('latitude')*units.deg,
-                                elevation=site_details.get('elevation')*units.m)
-
-            sun_alt = observer.altaz(time_range, sun).alt
-            obj_airmass = observer.altaz(time_range, body).secz
-
-            bad_indices = np.argwhere(
-                (obj_airmass >= airmass_limit) |
-                (obj_airmass <= 1) |
-                (sun_alt > -18*units.deg)  # between astronomical twilights, i.e. sun is up
-            )
-
-            obj_airmass = [None if i in bad_indices else float(airmass) for i, airmass in enumerate(obj_airmass)]
-
-            visibility[f'({observing_facility}) {site}'] = (time_range.datetime, obj_airmass)
-    return visibility
+    return get_targets_visibility([target], start_time, end_time, interval, airmass_limit)[0]
 
 
 def get_astroplan_sun_and_time(start_time, end_time, interval):
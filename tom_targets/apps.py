@@ -1,5 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class TomTargetsConfig(AppConfig):
     name = 'tom_targets'
+
+    def ready(self):
+        from tom_targets.crossmatch import target_changed
+        post_save.connect(target_changed, sender='tom_targets.Target', dispatch_uid='crossmatch_target_saved')
+        post_delete.connect(target_changed, sender='tom_targets.Target', dispatch_uid='crossmatch_target_deleted')
+
+        from tom_targets.observability import target_coordinates_changed
+        post_save.connect(target_coordinates_changed, sender='tom_targets.Target',
+                          dispatch_uid='observability_target_saved')
@@ -0,0 +1,154 @@
+from datetime import datetime, timezone
+
+from django.db import transaction
+from django.db.models.functions import Coalesce
+import numpy as np
+
+from tom_targets.spatial import sky_cell
+
+J2000 = datetime(2000, 1, 1, 12, tzinfo=timezone.utc)
+MILLIARCSECONDS_TO_RADIANS = np.pi / (180 * 3600 * 1000)
+# Epochs above this are taken to be Julian Dates rather than Julian years
+JULIAN_DATE_THRESHOLD = 100000
+# Number of targets updated per statement when refreshing current positions
+POSITION_UPDATE_BATCH_SIZE = 1000
+
+
+def julian_year(time=None):
+    """
+    Converts a time to a Julian year epoch, such as 2000.0 for J2000.
+
+    :param time: time to convert, defaults to the current time
+    :type time: datetime
+
+    :rtype: float
+    """
+    time = time or datetime.now(timezone.utc)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return 2000 + (time - J2000).total_seconds() / (86400 * 365.25)
+
+
+def _epochs(epoch):
+    epoch = np.nan_to_num(np.asarray(epoch, dtype=float), nan=2000)
+    return np.where(epoch > JULIAN_DATE_THRESHOLD, 2000 + (epoch - 2451545) / 365.25, epoch)
+
+
+def propagate_positions(ra, dec, pm_ra, pm_dec, epoch, to_epoch):
+    """
+    Moves catalog positions along their proper motions from their epochs to another epoch, for all positions at once.
+    Stars are moved in a straight line at constant velocity, without radial velocity or parallax, which are negligible
+    for pointing and cross-matching. Missing proper motions count as zero, and missing epochs as J2000.
+
+    :param ra: Right Ascensions at the catalog epochs, in degrees.
+    :type ra: array-like
+
+    :param dec: Declinations at the catalog epochs, in degrees.
+    :type dec: array-like
+
+    :param pm_ra: Proper motions in Right Ascension, including the cos(dec) factor, in milliarcseconds per year.
+    :type pm_ra: array-like
+
+    :param pm_dec: Proper motions in Declination, in milliarcseconds per year.
+    :type pm_dec: array-like
+
+    :param epoch: Catalog epochs, in Julian years, or as Julian Dates.
+    :type epoch: array-like
+
+    :param to_epoch: Epoch to move the positions to, in Julian years.
+    :type to_epoch: float
+
+    :returns: Right Ascensions and Declinations at ``to_epoch``, in degrees
+    :rtype: tuple
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    pm_ra = np.nan_to_num(np.asarray(pm_ra, dtype=float)) * MILLIARCSECONDS_TO_RADIANS
+    pm_dec = np.nan_to_num(np.asarray(pm_dec, dtype=float)) * MILLIARCSECONDS_TO_RADIANS
+    years = to_epoch - _epochs(epoch)
+    sin_ra, cos_ra, sin_dec, cos_dec = np.sin(ra), np.cos(ra), np.sin(dec), np.cos(dec)
+    # The position unit vector moves along the tangent plane, spanned by the directions of increasing RA and Dec
+    x = cos_dec * cos_ra + years * (-pm_ra * sin_ra - pm_dec * sin_dec * cos_ra)
+    y = cos_dec * sin_ra + years * (pm_ra * cos_ra - pm_dec * sin_dec * sin_ra)
+    z = sin_dec + years * pm_dec * cos_dec
+    return np.degrees(np.arctan2(y, x)) % 360, np.degrees(np.arctan2(z, np.hypot(x, y)))
+
+
+def target_positions(targets, to_epoch=None):
+    """
+    Returns the positions of sidereal ``Target`` objects at an epoch.
+
+    :param targets: sidereal targets with coordinates
+    :type targets: list
+
+    :param to_epoch: epoch in Julian years, defaults to the current epoch
+    :type to_epoch: float
+
+    :returns: Right Ascensions and Declinations, in degrees
+    :rtype: tuple
+    """
+    columns = [[getattr(target, field) for target in targets] for field in ('ra', 'dec', 'pm_ra', 'pm_dec', 'epoch')]
+    return propagate_positions(*columns, julian_year() if to_epoch is None else to_epoch)
+
+
+def current_positions(queryset, to_epoch=None):
+    """
+    Returns the positions of the sidereal targets of a queryset at an epoch, loading their coordinates and proper
+    motions in a single query and propagating them in a single NumPy pass.
+
+    :param queryset: targets to return the positions of
+    :type queryset: QuerySet
+
+    :param to_epoch: epoch in Julian years, defaults to the current epoch
+    :type to_epoch: float
+
+    :returns: ids, Right Ascensions and Declinations of the targets, as arrays
+    :rtype: tuple
+    """
+    rows = list(queryset.filter(ra__isnull=False, dec__isnull=False).values_list(
+        'id', 'ra', 'dec', 'pm_ra', 'pm_dec', 'epoch'
+    ))
+    columns = np.array(rows, dtype=float).reshape(-1, 6).T
+    ra, dec = propagate_positions(*columns[1:], julian_year() if to_epoch is None else to_epoch)
+    return columns[0].astype(np.int64), ra, dec
+
+
+def refresh_current_positions(queryset, to_epoch=None):
+    """
+    Stores the positions of the targets of a queryset at an epoch in their ``current_ra`` and ``current_dec``
+    columns, and moves them to the spatial index cell of that position, in batches of ``POSITION_UPDATE_BATCH_SIZE``
+    targets.
+
+    :param queryset: sidereal targets to update
+    :type queryset: QuerySet
+
+    :param to_epoch: epoch in Julian years, defaults to the current epoch
+    :type to_epoch: float
+
+    :returns: number of targets updated
+    :rtype: int
+    """
+    to_epoch = julian_year() if to_epoch is None else to_epoch
+    ids, ra, dec = current_positions(queryset, to_epoch)
+    model = queryset.model
+    targets = [
+        model(id=int(target_id), current_ra=float(target_ra), current_dec=float(target_dec), current_epoch=to_epoch,
+              sky_cell=sky_cell(target_ra, target_dec))
+        for target_id, target_ra, target_dec in zip(ids, ra, dec)
+    ]
+    model.objects.bulk_update(targets, ['current_ra', 'current_dec', 'current_epoch', 'sky_cell'],
+                              batch_size=POSITION_UPDATE_BATCH_SIZE)
+    # bulk_update sends no post_save signal, so the cross-match index is reloaded with the new positions instead
+    from tom_targets.crossmatch import targets_changed
+    transaction.on_commit(targets_changed)
+    return len(targets)
+
+
+def with_current_positions(queryset):
+    """
+    Annotates targets with their ``position_ra`` and ``position_dec``: their cached current position where it has been
+    calculated, and otherwise their catalog position.
+
+    :rtype: QuerySet
+    """
+    return queryset.annotate(position_ra=Coalesce('current_ra', 'ra'), position_dec=Coalesce('current_dec', 'dec'))
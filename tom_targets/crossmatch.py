@@ -0,0 +1,247 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+import numpy as np
+
+from tom_targets.astrometry import with_current_positions
+from tom_targets.models import Target
+
+try:
+    CROSSMATCH_MAX_AGE = settings.CROSSMATCH_MAX_AGE
+except AttributeError:
+    CROSSMATCH_MAX_AGE = 600
+
+# Upper bound on the number of candidate pairs examined at once, to keep memory bounded for large batches
+CANDIDATE_CHUNK_SIZE = 2000000
+
+
+def radec_to_xyz(ra, dec):
+    """
+    Converts positions to unit vectors.
+
+    :param ra: Right Ascension, in degrees.
+    :type ra: array-like
+
+    :param dec: Declination, in degrees.
+    :type dec: array-like
+
+    :returns: array of shape (N, 3)
+    :rtype: numpy.ndarray
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+class TargetCrossMatcher:
+    """
+    In-memory cross-match index of sidereal ``Target`` positions. Positions are held as unit vectors sorted by
+    declination, so a batch of queries only compares each query against the targets in its declination band, using
+    vectorized NumPy operations rather than one database query per position.
+
+    Changes to targets made in this process are applied incrementally before the next query. The whole index is
+    reloaded once it is older than ``settings.CROSSMATCH_MAX_AGE`` seconds, which picks up changes made by other
+    processes.
+    """
+
+    def __init__(self, max_age=None):
+        self.max_age = CROSSMATCH_MAX_AGE if max_age is None else max_age
+        self._lock = threading.RLock()
+        self._loaded = None
+        self._pending = set()
+        self._set_arrays(np.empty(0, dtype=np.int64), np.empty(0), np.empty(0))
+
+    def _set_arrays(self, ids, ra, dec):
+        order = np.argsort(dec, kind='mergesort')
+        self.ids = ids[order]
+        self.dec = dec[order]
+        self.xyz = radec_to_xyz(ra[order], self.dec)
+        self.ra = ra[order]
+
+    def _load(self, queryset):
+        # Cached current positions, where refreshed, keep high proper motion stars matched at their present position
+        rows = np.array(list(with_current_positions(queryset).values_list('id', 'position_ra', 'position_dec')),
+                        dtype=float).reshape(-1, 3)
+        return rows[:, 0].astype(np.int64), rows[:, 1] % 360, rows[:, 2]
+
+    def _queryset(self):
+        return Target.objects.filter(type=Target.SIDEREAL, ra__isnull=False, dec__isnull=False)
+
+    def refresh(self):
+        """
+        Reloads all target positions from the database.
+        """
+        with self._lock:
+            self._pending.clear()
+            self._set_arrays(*self._load(self._queryset()))
+            self._loaded = time.monotonic()
+
+    def invalidate(self, target_id):
+        """
+        Marks a target as changed, so that its position is reloaded before the next query.
+
+        :param target_id: primary key of the created, updated or deleted ``Target``
+        :type target_id: int
+        """
+        with self._lock:
+            if self._loaded is not None:
+                self._pending.add(target_id)
+
+    def expire(self):
+        """
+        Marks the whole index as out of date, so that all positions are reloaded before the next query.
+        """
+        with self._lock:
+            self._pending.clear()
+            self._loaded = None
+
+    def _ensure_current(self):
+        with self._lock:
+            if self._loaded is None or time.monotonic() - self._loaded > self.max_age:
+                self.refresh()
+            elif self._pending:
+                pending = list(self._pending)
+                self._pending.clear()
+                keep = ~np.isin(self.ids, pending)
+                ids, ra, dec = self._load(self._queryset().filter(id__in=pending))
+                self._set_arrays(
+                    np.concatenate([self.ids[keep], ids]),
+                    np.concatenate([self.ra[keep], ra]),
+                    np.concatenate([self.dec[keep], dec])
+                )
+
+    def __len__(self):
+        self._ensure_current()
+        return len(self.ids)
+
+    def match(self, ra, dec, radius):
+        """
+        Finds every target within ``radius`` of each of a batch of positions.
+
+        :param ra: Right Ascensions of the query positions, in degrees.
+        :type ra: array-like
+
+        :param dec: Declinations of the query positions, in degrees.
+        :type dec: array-like
+
+        :param radius: Match radius in arcseconds, either a single value or one per query position.
+        :type radius: float or array-like
+
+        :returns: Three arrays of equal length, one entry per match: the index of the query position, the id of the
+            matching ``Target``, and the separation in arcseconds. Matches are ordered by query position and then by
+            separation.
+        :rtype: tuple
+        """
+        self._ensure_current()
+        query_xyz = radec_to_xyz(np.atleast_1d(ra), np.atleast_1d(dec)).reshape(-1, 3)
+        query_dec = np.atleast_1d(np.asarray(dec, dtype=float)).ravel()
+        radius = np.broadcast_to(np.asarray(radius, dtype=float) / 3600, query_dec.shape)
+        # Compare squared chord lengths rather than angles, which keeps precision at arcsecond scales
+        max_chord_squared = (2 * np.sin(np.radians(radius) / 2)) ** 2
+
+        with self._lock:
+            ids, target_dec, target_xyz = self.ids, self.dec, self.xyz
+        first = np.searchsorted(target_dec, query_dec - radius, side='left')
+        last = np.searchsorted(target_dec, query_dec + radius, side='right')
+        counts = last - first
+
+        matched_queries, matched_targets, chords = [], [], []
+        start = 0
+        while start < len(counts):
+            # Take as many queries as fit within the candidate budget, but always at least one
+            cumulative = np.cumsum(counts[start:])
+            stop = start + max(int(np.searchsorted(cumulative, CANDIDATE_CHUNK_SIZE, side='right')), 1)
+            chunk_counts = counts[start:stop]
+            query_index = np.repeat(np.arange(start, stop), chunk_counts)
+            offsets = np.arange(chunk_counts.sum()) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+            candidates = np.repeat(first[start:stop], chunk_counts) + offsets
+            chord_squared = np.sum((target_xyz[candidates] - query_xyz[query_index]) ** 2, axis=1)
+            within = chord_squared <= max_chord_squared[query_index]
+            matched_queries.append(query_index[within])
+            matched_targets.append(candidates[within])
+            chords.append(chord_squared[within])
+            start = stop
+
+        matched_queries = np.concatenate(matched_queries) if matched_queries else np.empty(0, dtype=np.int64)
+        matched_targets = np.concatenate(matched_targets) if matched_targets else np.empty(0, dtype=np.int64)
+        chords = np.concatenate(chords) if chords else np.empty(0)
+        separations = np.degrees(2 * np.arcsin(np.sqrt(chords) / 2)) * 3600
+        order = np.lexsort((separations, matched_queries))
+        return matched_queries[order], ids[matched_targets[order]], separations[order]
+
+    def nearest(self, ra, dec, radius):
+        """
+        Finds the closest target within ``radius`` of each of a batch of positions.
+
+        :param ra: Right Ascensions of the query positions, in degrees.
+        :type ra: array-like
+
+        :param dec: Declinations of the query positions, in degrees.
+        :type dec: array-like
+
+        :param radius: Maximum separation in arcseconds, either a single value or one per query position.
+        :type radius: float or array-like
+
+        :returns: Two arrays with one entry per query position: the id of the closest ``Target``, or -1 if there is
+            none within the radius, and its separation in arcseconds, or NaN.
+        :rtype: tuple
+        """
+        query_count = np.atleast_1d(np.asarray(ra)).size
+        nearest_ids = np.full(query_count, -1, dtype=np.int64)
+        nearest_separations = np.full(query_count, np.nan)
+        queries, target_ids, separations = self.match(ra, dec, radius)
+        # Matches are sorted by separation within each query, so the first match of each query is the closest
+        queries, first = np.unique(queries, return_index=True)
+        nearest_ids[queries] = target_ids[first]
+        nearest_separations[queries] = separations[first]
+        return nearest_ids, nearest_separations
+
+
+_crossmatcher = None
+_crossmatcher_lock = threading.Lock()
+
+
+def get_crossmatcher():
+    """
+    Returns the shared ``TargetCrossMatcher`` for this process, creating it on first use.
+
+    :returns: cross-match index of all sidereal targets
+    :rtype: TargetCrossMatcher
+    """
+    global _crossmatcher
+    with _crossmatcher_lock:
+        if _crossmatcher is None:
+            _crossmatcher = TargetCrossMatcher()
+        return _crossmatcher
+
+
+def targets_changed(target_ids=None):
+    """
+    Queues changed targets for an update of the shared cross-match index. Bulk writes, which send no signals, call
+    this once their transaction has committed.
+
+    :param target_ids: primary keys of the created, updated or deleted targets, or None to reload every target
+    :type target_ids: iterable
+    """
+    if _crossmatcher is None:
+        return
+    if target_ids is None:
+        _crossmatcher.expire()
+    else:
+        for target_id in target_ids:
+            _crossmatcher.invalidate(target_id)
+
+
+def target_changed(sender, instance, **kwargs):
+    """
+    Signal receiver that queues a changed ``Target`` for an incremental update of the shared cross-match index, once
+    the change has been committed. An update made before would reload the target as it was before the change, or the
+    change of a transaction that is rolled back.
+    """
+    if _crossmatcher is None:
+        return
+    target_id = instance.pk
+    transaction.on_commit(lambda: targets_changed([target_id]))
@@ -1,9 +1,12 @@
 from django.conf import settings
-from django.db.models import ExpressionWrapper, F, FloatField, Q
-from django.db.models.functions.math import ACos, Cos, Sin
+from django.db.models import Exists, OuterRef
 import django_filters
 
-from tom_targets.models import Target, TargetList
+from tom_observations.utils import get_all_observing_sites
+from tom_targets.astrometry import with_current_positions
+from tom_targets.models import Target, TargetExtra, TargetList, TargetObservability
+from tom_targets.observability import OBSERVABILITY_AIRMASS_LIMITS, current_night
+from tom_targets.spatial import cone_search
 
 
 def filter_for_field(field):
@@ -21,24 +24,38 @@ def filter_for_field(field):
         )
 
 
+def filter_extra(queryset, name, **lookups):
+    """
+    Filters targets down to those with a ``TargetExtra`` of key ``name`` matching ``lookups``. The condition is a
+    correlated ``EXISTS`` subquery, which can use the (key, typed value) indexes of ``TargetExtra`` and does not join
+    extras into the target query, so any number of extra field filters can be combined without duplicating rows.
+    """
+    return queryset.filter(Exists(TargetExtra.objects.filter(target=OuterRef('pk'), key=name, **lookups)))
+
+
+def range_lookups(field_name, value):
+    lookups = {}
+    if value.start is not None:
+        lookups[f'{field_name}__gte'] = value.start
+    if value.stop is not None:
+        lookups[f'{field_name}__lte'] = value.stop
+    return lookups
+
+
 def filter_number(queryset, name, value):
-    return queryset.filter(
-        targetextra__key=name, targetextra__float_value__gte=value.start, targetextra__float_value__lte=value.stop
-    )
+    return filter_extra(queryset, name, **range_lookups('float_value', value))
 
 
 def filter_datetime(queryset, name, value):
-    return queryset.filter(
-        targetextra__key=name, targetextra__time_value__gte=value.start, targetextra__time_value__lte=value.stop
-    )
+    return filter_extra(queryset, name, **range_lookups('time_value', value))
 
 
 def filter_boolean(queryset, name, value):
-    return queryset.filter(targetextra__key=name, targetextra__bool_value=value)
+    return filter_extra(queryset, name, bool_value=value)
 
 
 def filter_text(queryset, name, value):
-    return queryset.filter(targetextra__key=name, targetextra__value__icontains=value)
+    return filter_extra(queryset, name, value__icontains=value)
 
 
 class TargetFilter(django_filters.FilterSet):
@@ -55,7 +72,7 @@ class TargetFilter(django_filters.FilterSet):
     name = django_filters.CharFilter(method='filter_name', label='Name')
 
     def filter_name(self, queryset, name, value):
-        return queryset.filter(Q(name__icontains=value) | Q(aliases__name__icontains=value)).distinct()
+        return queryset.resolve(value, contains=True)
 
     cone_search = django_filters.CharFilter(method='filter_cone_search', label='Cone Search',
                                             help_text='RA, Dec, Search Radius (degrees)')
@@ -68,29 +85,37 @@ class TargetFilter(django_filters.FilterSet):
             ra, dec, radius = value.split(',')
         elif name == 'target_cone_search':
             target_name, radius = value.split(',')
-            targets = Target.objects.filter(
-                Q(name__icontains=target_name) | Q(aliases__name__icontains=target_name)
-            ).distinct()
+            targets = Target.objects.resolve(target_name)[:2]
             if len(targets) == 1:
-                ra = targets[0].ra
-                dec = targets[0].dec
+                ra = targets[0].current_ra if targets[0].current_ra is not None else targets[0].ra
+                dec = targets[0].current_dec if targets[0].current_dec is not None else targets[0].dec
             else:
                 return queryset.filter(name=None)
 
-        half_pi = 90
-
-        separation = ExpressionWrapper(
-            ACos(
-                (Cos(half_pi - float(dec)) * Cos(half_pi - F('dec'))) +
-                (Sin(half_pi - float(dec)) * Sin(half_pi - F('dec')) * Cos(float(ra) - F('ra')))
-            ), FloatField()
-        )
-
-        return queryset.annotate(separation=separation).filter(separation__lte=radius)
+        return cone_search(with_current_positions(queryset), ra, dec, radius, ra_field='position_ra',
+                           dec_field='position_dec')
 
     def filter_target_cone_search(self, queryset, name, value):
         return queryset
 
+    observable_tonight = django_filters.CharFilter(method='filter_observable_tonight', label='Observable Tonight',
+                                                   help_text='Site, Maximum Airmass, Minimum Hours')
+
+    def filter_observable_tonight(self, queryset, name, value):
+        """
+        Filters targets down to those observable from a site during the current night below an airmass for at least a
+        number of hours, using the stored observability. Airmasses between the stored limits use the next lower limit.
+        """
+        site, airmass, hours = [part.strip() for part in value.split(',')]
+        site_details = get_all_observing_sites().get(site)
+        limits = [limit for limit in OBSERVABILITY_AIRMASS_LIMITS if limit <= float(airmass)]
+        if site_details is None or not limits:
+            return queryset.filter(name=None)
+        return queryset.filter(Exists(TargetObservability.objects.filter(
+            target=OuterRef('pk'), site=site, night=current_night(site_details), airmass_limit=max(limits),
+            hours_observable__gte=float(hours)
+        )))
+
     # hide target grouping list if user not logged in
     def get_target_list_queryset(request):
         if request.user.is_authenticated:
@@ -102,4 +127,4 @@ class TargetFilter(django_filters.FilterSet):
 
     class Meta:
         model = Target
-        fields = ['type', 'name', 'key', 'value', 'cone_search', 'targetlist__name']
+        fields = ['type', 'name', 'key', 'value', 'cone_search', 'observable_tonight', 'targetlist__name']
@@ -1,6 +1,103 @@
-from .filters import TargetFilter
-from .models import Target
 from django.contrib import messages
+from guardian.shortcuts import get_objects_for_user
+
+from .filters import TargetFilter
+from .models import Target, TargetList
+
+# Number of memberships written or deleted per query
+GROUPING_BATCH_SIZE = 500
+
+
+def _partition_targets(target_queryset, grouping_object, request):
+    """
+    Splits the targets of a queryset, in a fixed number of queries, into those the user may view that are in the
+    ``TargetList``, those the user may view that are not in it, and those the user may not view.
+
+    :returns: lists of (id, name) tuples of the member, non-member and forbidden targets
+    :rtype: tuple
+    """
+    targets = dict(target_queryset.order_by('pk').values_list('pk', 'name'))
+    permitted_ids = set(get_objects_for_user(
+        request.user, 'tom_targets.view_target', klass=target_queryset, accept_global_perms=False
+    ).values_list('pk', flat=True))
+    member_ids = set(TargetList.targets.through.objects.filter(
+        targetlist=grouping_object, target__in=target_queryset.values('pk')
+    ).values_list('target_id', flat=True))
+    members, non_members, forbidden = [], [], []
+    for target_id, name in targets.items():
+        if target_id not in permitted_ids:
+            forbidden.append((target_id, name))
+        elif target_id in member_ids:
+            members.append((target_id, name))
+        else:
+            non_members.append((target_id, name))
+    return members, non_members, forbidden
+
+
+def _add_memberships(grouping_object, target_ids):
+    through = TargetList.targets.through
+    through.objects.bulk_create(
+        [through(targetlist_id=grouping_object.pk, target_id=target_id) for target_id in target_ids],
+        batch_size=GROUPING_BATCH_SIZE, ignore_conflicts=True
+    )
+
+
+def _remove_memberships(grouping_object, target_ids):
+    through = TargetList.targets.through
+    for start in range(0, len(target_ids), GROUPING_BATCH_SIZE):
+        through.objects.filter(
+            targetlist=grouping_object, target_id__in=target_ids[start:start + GROUPING_BATCH_SIZE]
+        ).delete()
+
+
+def _selected_targets(targets_ids):
+    """
+    Returns the queryset of the selected targets, and failures for the selected ids that are not valid target ids.
+    """
+    valid_ids, failure_targets = [], []
+    for target_id in targets_ids:
+        try:
+            valid_ids.append(int(target_id))
+        except (TypeError, ValueError):
+            failure_targets.append((target_id, 'Invalid target id.'))
+    target_queryset = Target.objects.filter(pk__in=valid_ids)
+    found_ids = set(target_queryset.values_list('pk', flat=True))
+    failure_targets += [
+        (target_id, 'Target matching query does not exist.') for target_id in valid_ids if target_id not in found_ids
+    ]
+    return target_queryset, failure_targets
+
+
+def _add_to_grouping(target_queryset, grouping_object, request, failure_targets):
+    members, non_members, forbidden = _partition_targets(target_queryset, grouping_object, request)
+    _add_memberships(grouping_object, [target_id for target_id, _ in non_members])
+    success_targets = [name for _, name in non_members]
+    warning_targets = [name for _, name in members]  # targets that are already in the grouping
+    failure_targets = failure_targets + [(name, 'Permission denied.',) for _, name in forbidden]
+    messages.success(request, "{} target(s) successfully added to group '{}'."
+                              .format(len(success_targets), grouping_object.name))
+    if warning_targets:
+        messages.warning(request, "{} target(s) already in group '{}': {}"
+                                  .format(len(warning_targets), grouping_object.name, ', '.join(warning_targets)))
+    for failure_target in failure_targets:
+        messages.error(request, "Failed to add target with id={} to group '{}'; {}"
+                                .format(failure_target[0], grouping_object.name, failure_target[1]))
+
+
+def _remove_from_grouping(target_queryset, grouping_object, request, failure_targets):
+    members, non_members, forbidden = _partition_targets(target_queryset, grouping_object, request)
+    _remove_memberships(grouping_object, [target_id for target_id, _ in members])
+    success_targets = [name for _, name in members]
+    warning_targets = [name for _, name in non_members]
+    failure_targets = failure_targets + [(name, 'Permission denied.',) for _, name in forbidden]
+    messages.success(request, "{} target(s) successfully removed from group '{}'."
+                              .format(len(success_targets), grouping_object.name))
+    if warning_targets:
+        messages.warning(request, "{} target(s) not in group '{}': {}"
+                                  .format(len(warning_targets), grouping_object.name, ', '.join(warning_targets)))
+    for failure_target in failure_targets:
+        messages.error(request, "Failed to remove target with id={} from group '{}'; {}"
+                                .format(failure_target[0], grouping_object.name, failure_target[1]))
 
 
 def add_all_to_grouping(filter_data, grouping_object, request):
@@ -17,34 +114,13 @@ def add_all_to_grouping(filter_data, grouping_object, request):
     :param request: request object passed to the calling view
     :type request: HTTPRequest
     """
-    success_targets = []
-    warning_targets = []  # targets that are already in the grouping
-    failure_targets = []
     try:
         target_queryset = TargetFilter(request=request, data=filter_data, queryset=Target.objects.all()).qs
     except Exception as e:
         messages.error(request, "Error with filter parameters. No target(s) were added to group '{}'."
                                 .format(grouping_object.name))
         return
-    for target_object in target_queryset:
-        try:
-            if not request.user.has_perm('tom_targets.view_target', target_object):
-                failure_targets.append((target_object.name, 'Permission denied.',))
-            elif target_object in grouping_object.targets.all():
-                warning_targets.append(target_object.name)
-            else:
-                grouping_object.targets.add(target_object)
-                success_targets.append(target_object.name)
-        except Exception as e:
-            failure_targets.append((target_object.pk, e,))
-    messages.success(request, "{} target(s) successfully added to group '{}'."
-                              .format(len(success_targets), grouping_object.name))
-    if warning_targets:
-        messages.warning(request, "{} target(s) already in group '{}': {}"
-                                  .format(len(warning_targets), grouping_object.name, ', '.join(warning_targets)))
-    for failure_target in failure_targets:
-        messages.error(request, "Failed to add target with id={} to group '{}'; {}"
-                                .format(failure_target[0], grouping_object.name, failure_target[1]))
+    _add_to_grouping(target_queryset, grouping_object, request, [])
 
 
 def add_selected_to_grouping(targets_ids, grouping_object, request):
@@ -61,29 +137,8 @@ def add_selected_to_grouping(targets_ids, grouping_object, request):
     :param request: request object passed to the calling view
     :type request: HTTPRequest
     """
-    success_targets = []
-    warning_targets = []
-    failure_targets = []
-    for target_id in targets_ids:
-        try:
-            target_object = Target.objects.get(pk=target_id)
-            if not request.user.has_perm('tom_targets.view_target', target_object):
-                failure_targets.append((target_object.name, 'Permission denied.',))
-            elif target_object in grouping_object.targets.all():
-                warning_targets.append(target_object.name)
-            else:
-                grouping_object.targets.add(target_object)
-                success_targets.append(target_object.name)
-        except Exception as e:
-            failure_targets.append((target_object.pk, e,))
-    messages.success(request, "{} target(s) successfully added to group '{}'."
-                              .format(len(success_targets), grouping_object.name))
-    if warning_targets:
-        messages.warning(request, "{} target(s) already in group '{}': {}"
-                                  .format(len(warning_targets), grouping_object.name, ', '.join(warning_targets)))
-    for failure_target in failure_targets:
-        messages.error(request, "Failed to add target with id={} to group '{}'; {}"
-                                .format(failure_target[0], grouping_object.name, failure_target[1]))
+    target_queryset, failure_targets = _selected_targets(targets_ids)
+    _add_to_grouping(target_queryset, grouping_object, request, failure_targets)
 
 
 def remove_all_from_grouping(filter_data, grouping_object, request):
@@ -100,34 +155,13 @@ def remove_all_from_grouping(filter_data, grouping_object, request):
     :param request: request object passed to the calling view
     :type request: HTTPRequest
     """
-    success_targets = []
-    warning_targets = []
-    failure_targets = []
     try:
         target_queryset = TargetFilter(request=request, data=filter_data, queryset=Target.objects.all()).qs
     except Exception as e:
         messages.error(request, "Error with filter parameters. No target(s) were removed from group '{}'."
                                 .format(grouping_object.name))
         return
-    for target_object in target_queryset:
-        try:
-            if not request.user.has_perm('tom_targets.view_target', target_object):
-                failure_targets.append((target_object.name, 'Permission denied.',))
-            elif target_object not in grouping_object.targets.all():
-                warning_targets.append(target_object.name)
-            else:
-                grouping_object.targets.remove(target_object)
-                success_targets.append(target_object.name)
-        except Exception as e:
-            failure_targets.append({'name': target_object.name, 'error': e})
-    messages.success(request, "{} target(s) successfully removed from group '{}'."
-                              .format(len(success_targets), grouping_object.name))
-    if warning_targets:
-        messages.warning(request, "{} target(s) not in group '{}': {}"
-                                  .format(len(warning_targets), grouping_object.name, ', '.join(warning_targets)))
-    for failure_target in failure_targets:
-        messages.error(request, "Failed to remove target with id={} from group '{}'; {}"
-                                .format(failure_target['id'], grouping_object.name, failure_target['error']))
+    _remove_from_grouping(target_queryset, grouping_object, request, [])
 
 
 def remove_selected_from_grouping(targets_ids, grouping_object, request):
@@ -144,26 +178,5 @@ def remove_selected_from_grouping(targets_ids, grouping_object, request):
     :param request: request object passed to the calling view
     :type request: HTTPRequest
     """
-    success_targets = []
-    warning_targets = []
-    failure_targets = []
-    for target_id in targets_ids:
-        try:
-            target_object = Target.objects.get(pk=target_id)
-            if not request.user.has_perm('tom_targets.view_target', target_object):
-                failure_targets.append((target_object.name, 'Permission denied.',))
-            elif target_object not in grouping_object.targets.all():
-                warning_targets.append(target_object.name)
-            else:
-                grouping_object.targets.remove(target_object)
-                success_targets.append(target_object.name)
-        except Exception as e:
-            failure_targets.append({'id': target_id, 'error': e})
-    messages.success(request, "{} target(s) successfully removed from group '{}'."
-                              .format(len(success_targets), grouping_object.name))
-    if warning_targets:
-        messages.warning(request, "{} target(s) not in group '{}': {}"
-                                  .format(len(warning_targets), grouping_object.name, ', '.join(warning_targets)))
-    for failure_target in failure_targets:
-        messages.error(request, "Failed to remove target with id={} from group '{}'; {}"
-                                .format(failure_target['id'], grouping_object.name, failure_target['error']))
+    target_queryset, failure_targets = _selected_targets(targets_ids)
+    _remove_from_grouping(target_queryset, grouping_object, request, failure_targets)
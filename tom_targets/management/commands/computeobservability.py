@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from tom_targets.models import Target
+from tom_targets.observability import update_observability
+
+
+class Command(BaseCommand):
+    help = 'Calculates when sidereal targets are observable from all observing sites over the coming nights'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--nights',
+            type=int,
+            default=1,
+            help='Number of nights, starting tonight, to calculate the observability for'
+        )
+        parser.add_argument(
+            '--target_id',
+            type=int,
+            action='append',
+            help='Only calculate the observability of this target, can be given several times'
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Recalculate observability that is already stored'
+        )
+
+    def handle(self, *args, **options):
+        targets = Target.objects.all()
+        if options['target_id']:
+            targets = targets.filter(pk__in=options['target_id'])
+        stored = update_observability(targets, nights=options['nights'], force=options['force'])
+        self.stdout.write('Stored {0} observability rows'.format(stored))
+        return 'Observability calculated successfully'
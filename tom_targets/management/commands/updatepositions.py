@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from tom_targets.astrometry import julian_year, refresh_current_positions
+from tom_targets.models import Target
+
+
+class Command(BaseCommand):
+    help = 'Moves sidereal targets along their proper motions and caches their positions at the current epoch'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--epoch',
+            type=float,
+            help='Epoch to calculate the positions at, in Julian years, defaults to the current epoch'
+        )
+
+    def handle(self, *args, **options):
+        epoch = options['epoch'] if options['epoch'] is not None else julian_year()
+        updated = refresh_current_positions(Target.objects.filter(type=Target.SIDEREAL), epoch)
+        self.stdout.write('Updated the positions of {0} targets to epoch {1:.2f}'.format(updated, epoch))
+        return 'Positions updated successfully'
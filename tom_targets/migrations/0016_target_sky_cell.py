@@ -0,0 +1,33 @@
+# Generated by Django 3.0.14 on 2026-10-16 20:29
+
+from django.db import migrations, models
+
+from tom_targets.spatial import sky_cell
+
+
+def populate_sky_cells(apps, schema_editor):
+    Target = apps.get_model('tom_targets', 'Target')
+    targets = []
+    for target in Target.objects.filter(ra__isnull=False, dec__isnull=False).only('id', 'ra', 'dec').iterator():
+        target.sky_cell = sky_cell(target.ra, target.dec)
+        targets.append(target)
+        if len(targets) >= 1000:
+            Target.objects.bulk_update(targets, ['sky_cell'])
+            targets = []
+    Target.objects.bulk_update(targets, ['sky_cell'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0015_auto_20190923_2233'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='target',
+            name='sky_cell',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, help_text='Spatial index cell containing the target coordinates, used to speed up cone searches.', null=True, verbose_name='Sky Cell'),
+        ),
+        migrations.RunPython(populate_sky_cells, reverse_code=migrations.RunPython.noop),
+    ]
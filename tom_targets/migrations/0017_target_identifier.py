@@ -0,0 +1,40 @@
+# Generated by Django 3.0.14 on 2026-10-16 20:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from tom_targets.names import normalize_name
+
+
+def populate_identifiers(apps, schema_editor):
+    Target = apps.get_model('tom_targets', 'Target')
+    TargetName = apps.get_model('tom_targets', 'TargetName')
+    TargetIdentifier = apps.get_model('tom_targets', 'TargetIdentifier')
+    identifiers = [
+        TargetIdentifier(target_id=target_id, identifier=normalize_name(name))
+        for target_id, name in Target.objects.values_list('id', 'name').iterator()
+    ] + [
+        TargetIdentifier(target_id=target_id, alias_id=alias_id, identifier=normalize_name(name))
+        for alias_id, target_id, name in TargetName.objects.values_list('id', 'target_id', 'name').iterator()
+    ]
+    TargetIdentifier.objects.bulk_create(identifiers, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0016_target_sky_cell'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TargetIdentifier',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identifier', models.CharField(db_index=True, max_length=100)),
+                ('alias', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='tom_targets.TargetName')),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='identifiers', to='tom_targets.Target')),
+            ],
+        ),
+        migrations.RunPython(populate_identifiers, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.0.14 on 2026-10-16 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0017_target_identifier'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='targetextra',
+            index=models.Index(fields=['key', 'float_value'], name='tom_targets_key_958a56_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='targetextra',
+            index=models.Index(fields=['key', 'time_value'], name='tom_targets_key_7cd479_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='targetextra',
+            index=models.Index(fields=['key', 'bool_value'], name='tom_targets_key_044f71_idx'),
+        ),
+    ]
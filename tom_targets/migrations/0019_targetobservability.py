@@ -0,0 +1,36 @@
+# Generated by Django 3.0.14 on 2026-10-16 21:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0018_targetextra_typed_value_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TargetObservability',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('site', models.CharField(max_length=100)),
+                ('night', models.DateField()),
+                ('airmass_limit', models.FloatField()),
+                ('rise_time', models.DateTimeField(blank=True, null=True)),
+                ('set_time', models.DateTimeField(blank=True, null=True)),
+                ('transit_time', models.DateTimeField()),
+                ('hours_observable', models.FloatField()),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='observability', to='tom_targets.Target')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='targetobservability',
+            index=models.Index(fields=['site', 'night', 'airmass_limit', 'hours_observable'], name='tom_targets_observable_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='targetobservability',
+            unique_together={('target', 'site', 'night', 'airmass_limit')},
+        ),
+    ]
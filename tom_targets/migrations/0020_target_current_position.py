@@ -0,0 +1,28 @@
+# Generated by Django 3.0.14 on 2026-10-16 21:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0019_targetobservability'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='target',
+            name='current_dec',
+            field=models.FloatField(blank=True, editable=False, help_text='Declination at the current epoch, in degrees, moved along the proper motion.', null=True, verbose_name='Current Declination'),
+        ),
+        migrations.AddField(
+            model_name='target',
+            name='current_epoch',
+            field=models.FloatField(blank=True, editable=False, help_text='Epoch of the current position, in Julian years.', null=True, verbose_name='Current Epoch'),
+        ),
+        migrations.AddField(
+            model_name='target',
+            name='current_ra',
+            field=models.FloatField(blank=True, editable=False, help_text='Right Ascension at the current epoch, in degrees, moved along the proper motion.', null=True, verbose_name='Current Right Ascension'),
+        ),
+    ]
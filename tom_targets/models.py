@@ -7,6 +7,9 @@ from dateutil.parser import parse
 from datetime import datetime
 
 from tom_common.hooks import run_hook
+from tom_targets.astrometry import propagate_positions
+from tom_targets.names import normalize_name
+from tom_targets.spatial import sky_cell
 
 GLOBAL_TARGET_FIELDS = ['name', 'type']
 
@@ -24,6 +27,8 @@ NON_SIDEREAL_FIELDS = GLOBAL_TARGET_FIELDS + [
 ]
 
 REQUIRED_SIDEREAL_FIELDS = ['ra', 'dec']
+# Fields that together give the position of a sidereal target at any epoch
+POSITION_FIELDS = ['ra', 'dec', 'pm_ra', 'pm_dec', 'epoch']
 REQUIRED_NON_SIDEREAL_FIELDS = [
     'scheme', 'epoch', 'inclination', 'lng_asc_node', 'arg_of_perihelion',
     'eccentricity',
@@ -37,6 +42,36 @@ REQUIRED_NON_SIDEREAL_FIELDS_PER_SCHEME = {
 }
 
 
+class TargetQuerySet(models.QuerySet):
+    def resolve(self, name, prefix=False, contains=False):
+        """
+        Finds the targets with a name or alias matching ``name``, using the index of normalized names, so that
+        differently written versions of a designation are found, e.g. "SN 2020abc" for a target named "AT2020abc".
+
+        :param name: Name to look up
+        :type name: str
+
+        :param prefix: Whether to match every target with a name or alias starting with ``name``, rather than only
+            exact matches
+        :type prefix: bool
+
+        :param contains: Whether to match every target with a name or alias containing ``name``, rather than only
+            exact matches
+        :type contains: bool
+
+        :returns: matching targets
+        :rtype: QuerySet
+        """
+        if contains:
+            lookup = 'identifier__contains'
+        elif prefix:
+            lookup = 'identifier__startswith'
+        else:
+            lookup = 'identifier'
+        identifiers = TargetIdentifier.objects.filter(**{lookup: normalize_name(name)})
+        return self.filter(pk__in=identifiers.values('target_id'))
+
+
 class Target(models.Model):
     """
     Class representing a target in a TOM
@@ -121,6 +156,19 @@ class Target(models.Model):
 
     :param ephemeris_epoch_err: Days
     :type ephemeris_epoch_err: float
+
+    :param sky_cell: Spatial index cell containing the current position, or ``ra`` and ``dec`` if there is none,
+        maintained automatically on save.
+    :type sky_cell: int
+
+    :param current_ra: Right Ascension at ``current_epoch``, in degrees, cached by ``updatepositions``.
+    :type current_ra: float
+
+    :param current_dec: Declination at ``current_epoch``, in degrees, cached by ``updatepositions``.
+    :type current_dec: float
+
+    :param current_epoch: Epoch of the cached current position, in Julian years.
+    :type current_epoch: float
     """
 
     SIDEREAL = 'SIDEREAL'
@@ -224,10 +272,44 @@ class Target(models.Model):
     perihdist = models.FloatField(
         null=True, blank=True, verbose_name='Perihelion Distance', help_text='AU'
     )
+    sky_cell = models.IntegerField(
+        null=True, blank=True, editable=False, db_index=True, verbose_name='Sky Cell',
+        help_text='Spatial index cell containing the target coordinates, used to speed up cone searches.'
+    )
+    current_ra = models.FloatField(
+        null=True, blank=True, editable=False, verbose_name='Current Right Ascension',
+        help_text='Right Ascension at the current epoch, in degrees, moved along the proper motion.'
+    )
+    current_dec = models.FloatField(
+        null=True, blank=True, editable=False, verbose_name='Current Declination',
+        help_text='Declination at the current epoch, in degrees, moved along the proper motion.'
+    )
+    current_epoch = models.FloatField(
+        null=True, blank=True, editable=False, verbose_name='Current Epoch',
+        help_text='Epoch of the current position, in Julian years.'
+    )
+
+    objects = TargetQuerySet.as_manager()
 
     class Meta:
         ordering = ('id',)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._indexed_name = instance.__dict__.get('name')
+        instance._loaded_coordinates = tuple(instance.__dict__.get(field) for field in POSITION_FIELDS)
+        return instance
+
+    def coordinates_changed(self):
+        """
+        Returns whether the coordinates of this ``Target``, including its proper motion and epoch, differ from those
+        it was loaded or last saved with. Targets that were not loaded from the database count as changed.
+
+        :rtype: bool
+        """
+        return getattr(self, '_loaded_coordinates', None) != tuple(getattr(self, field) for field in POSITION_FIELDS)
+
     @transaction.atomic
     def save(self, *args, **kwargs):
         """
@@ -236,25 +318,68 @@ class Target(models.Model):
 
         :Keyword Arguments:
             * extras (`dict`): dictionary of key/value pairs representing target attributes
+            * names (`list`): aliases of this target
         """
         extras = kwargs.pop('extras', {})
         names = kwargs.pop('names', [])
 
+        if self.current_epoch is not None and self.ra is not None and self.dec is not None:
+            current_ra, current_dec = propagate_positions(
+                self.ra, self.dec, self.pm_ra, self.pm_dec, self.epoch, self.current_epoch
+            )
+            self.current_ra, self.current_dec = float(current_ra), float(current_dec)
+            self.sky_cell = sky_cell(self.current_ra, self.current_dec)
+        else:
+            self.current_ra = self.current_dec = None
+            self.sky_cell = sky_cell(self.ra, self.dec)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and set(POSITION_FIELDS).intersection(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'sky_cell', 'current_ra', 'current_dec'}
+
         created = False if self.id else True
         super().save(*args, **kwargs)
 
-        for k, v in extras.items():
-            target_extra, _ = TargetExtra.objects.get_or_create(target=self, key=k)
-            target_extra.value = v
-            target_extra.save()
+        if created:
+            TargetIdentifier.objects.index(targets=[self])
+        elif self.name != getattr(self, '_indexed_name', None):
+            TargetIdentifier.objects.update_or_create(
+                target=self, alias=None, defaults={'identifier': normalize_name(self.name)}
+            )
+        self._indexed_name = self.name
+        self._loaded_coordinates = tuple(getattr(self, field) for field in POSITION_FIELDS)
 
-        for name in names:
-            name, _ = TargetName.objects.get_or_create(target=self, name=name)
-            name.save()
+        self.upsert(extras=extras, names=names, created=created)
 
         if not created:
             run_hook('target_post_save', target=self, created=created)
 
+    def upsert(self, extras=None, names=None, created=False):
+        """
+        Creates or updates extra fields and aliases of this ``Target`` with a few set-based statements, rather than a
+        query per field. Existing extras whose value has changed are updated together, and new extras and aliases are
+        inserted together. Called automatically on save; calling it directly does not run the ``target_post_save`` hook.
+
+        :param extras: dictionary of key/value pairs representing target attributes
+        :type extras: dict
+
+        :param names: aliases of this ``Target``
+        :type names: list
+
+        :param created: whether this ``Target`` was just created, in which case there is nothing to look up
+        :type created: bool
+        """
+        if extras:
+            TargetExtra.objects.upsert(self, extras, created=created)
+
+        if names:
+            existing_names = set() if created else set(
+                TargetName.objects.filter(target=self, name__in=names).values_list('name', flat=True)
+            )
+            new_names = [name for name in dict.fromkeys(names) if name not in existing_names]
+            if new_names:
+                aliases = TargetName.objects.bulk_create([TargetName(target=self, name=name) for name in new_names])
+                TargetIdentifier.objects.index(aliases=aliases)
+
     def validate_unique(self, *args, **kwargs):
         """
         Ensures that Target.name and all aliases of the target are unique. Called automatically on save.
@@ -298,9 +423,7 @@ class Target(models.Model):
         :returns: List of ``ObservationRecord`` objects without a terminal status
         :rtype: list
         """
-        return [
-            obs for obs in self.observationrecord_set.all().order_by('scheduled_start') if not obs.terminal
-        ]
+        return list(self.observationrecord_set.filter(terminal=False).order_by('scheduled_start'))
 
     @property
     def extra_fields(self):
@@ -374,6 +497,16 @@ class TargetName(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        """
+        Saves TargetName model data to the database, and updates the normalized name of this alias used to resolve
+        targets.
+        """
+        super().save(*args, **kwargs)
+        TargetIdentifier.objects.update_or_create(
+            alias=self, defaults={'target_id': self.target_id, 'identifier': normalize_name(self.name)}
+        )
+
     def validate_unique(self, *args, **kwargs):
         """
         Ensures that Target.name and all aliases of the target are unique. Called automatically on save.
@@ -383,6 +516,98 @@ class TargetName(models.Model):
             raise ValidationError('Target name and target aliases must be unique')
 
 
+class TargetIdentifierManager(models.Manager):
+    def index(self, targets=(), aliases=()):
+        """
+        Adds the normalized names of newly created targets and aliases to the index with a single bulk insert. Used
+        wherever targets or aliases are created with ``bulk_create``, which bypasses ``save``.
+
+        :param targets: newly created ``Target`` objects
+        :type targets: list
+
+        :param aliases: newly created ``TargetName`` objects
+        :type aliases: list
+        """
+        aliases = list(aliases)
+        unsaved = [alias for alias in aliases if alias.pk is None]
+        if unsaved:
+            # Not every database backend returns primary keys from a bulk insert, so look them up by name
+            alias_ids = dict(
+                TargetName.objects.filter(name__in=[alias.name for alias in unsaved]).values_list('name', 'id')
+            )
+            for alias in unsaved:
+                alias.pk = alias_ids[alias.name]
+        self.bulk_create(
+            [self.model(target=target, identifier=normalize_name(target.name)) for target in targets] +
+            [self.model(target_id=alias.target_id, alias=alias, identifier=normalize_name(alias.name))
+             for alias in aliases]
+        )
+
+
+class TargetIdentifier(models.Model):
+    """
+    Class representing the normalized form of a name or alias of a ``Target``, as returned by
+    ``tom_targets.names.normalize_name``. Maintained automatically when targets and aliases are saved, and used to
+    resolve names to targets with an indexed lookup.
+
+    :param target: The ``Target`` object this ``TargetIdentifier`` is associated with.
+
+    :param alias: The ``TargetName`` this identifier was derived from, or empty if derived from ``Target.name``.
+
+    :param identifier: The normalized name.
+    :type identifier: str
+    """
+    target = models.ForeignKey(Target, on_delete=models.CASCADE, related_name='identifiers')
+    alias = models.OneToOneField(TargetName, on_delete=models.CASCADE, null=True, blank=True)
+    identifier = models.CharField(max_length=100, db_index=True)
+
+    objects = TargetIdentifierManager()
+
+    def __str__(self):
+        return self.identifier
+
+
+class TargetExtraManager(models.Manager):
+    def upsert(self, target, extras, created=False):
+        """
+        Sets the extra fields of a ``Target`` in at most three queries: one to fetch the existing extras with the given
+        keys, one ``bulk_update`` for those whose value has changed, and one ``bulk_create`` for the new keys. The typed
+        values of every written ``TargetExtra`` are computed before writing.
+
+        :param target: ``Target`` that the extras belong to
+        :type target: Target
+
+        :param extras: dictionary of key/value pairs representing target attributes
+        :type extras: dict
+
+        :param created: whether the ``Target`` was just created, in which case it has no existing extras to look up
+        :type created: bool
+
+        :returns: list of the created and updated ``TargetExtra`` objects
+        :rtype: list
+        """
+        existing = {} if created else {
+            target_extra.key: target_extra for target_extra in self.filter(target=target, key__in=list(extras))
+        }
+        to_create, to_update = [], []
+        for key, value in extras.items():
+            target_extra = existing.get(key)
+            if target_extra is None:
+                target_extra = self.model(target=target, key=key, value=value)
+                to_create.append(target_extra)
+            elif target_extra.value != str(value):
+                target_extra.value = value
+                to_update.append(target_extra)
+            else:
+                continue
+            target_extra.set_typed_values()
+
+        self.bulk_create(to_create)
+        if to_update:
+            self.bulk_update(to_update, ['value', 'float_value', 'bool_value', 'time_value'])
+        return to_create + to_update
+
+
 class TargetExtra(models.Model):
     """
     Class representing a list of targets in a TOM.
@@ -411,8 +636,15 @@ class TargetExtra(models.Model):
     bool_value = models.BooleanField(null=True, blank=True)
     time_value = models.DateTimeField(null=True, blank=True)
 
+    objects = TargetExtraManager()
+
     class Meta:
         unique_together = ['target', 'key']
+        indexes = [
+            models.Index(fields=['key', 'float_value']),
+            models.Index(fields=['key', 'time_value']),
+            models.Index(fields=['key', 'bool_value']),
+        ]
 
     def __str__(self):
         return f'{self.key}: {self.value}'
@@ -422,6 +654,15 @@ class TargetExtra(models.Model):
         Saves TargetExtra model data to the database. In the process, converts the string value of the ``TargetExtra``
         to the appropriate type, and stores it in the corresponding field as well.
         """
+        self.set_typed_values()
+        super().save(*args, **kwargs)
+
+    def set_typed_values(self):
+        """
+        Converts the string value of the ``TargetExtra`` to each of the typed representations, storing the results in
+        ``float_value``, ``bool_value`` and ``time_value``. Called automatically on save, and should be called directly
+        before writing ``TargetExtra`` objects with ``bulk_create`` or ``bulk_update``.
+        """
         try:
             self.float_value = float(self.value)
         except (TypeError, ValueError, OverflowError):
@@ -438,8 +679,6 @@ class TargetExtra(models.Model):
         except (TypeError, ValueError, OverflowError) as e:
             self.time_value = None
 
-        super().save(*args, **kwargs)
-
     def typed_value(self, type_val):
         """
         Returns the value of this ``TargetExtra`` in the corresponding type provided by the caller. If the type is
@@ -491,3 +730,53 @@ class TargetList(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class TargetObservability(models.Model):
+    """
+    Class representing when a ``Target`` can be observed from an observing site during a night, for one airmass
+    limit. Filled in bulk by the ``computeobservability`` management command, and recalculated when the coordinates
+    of a target change.
+
+    :param target: The ``Target`` object this ``TargetObservability`` is associated with.
+
+    :param site: The label of the observing site, consisting of the site name prepended with the observing facility.
+    :type site: str
+
+    :param night: The local date at the site on which the night starts.
+    :type night: date
+
+    :param airmass_limit: The maximum airmass at which the target is considered observable.
+    :type airmass_limit: float
+
+    :param rise_time: The time at which the target rises below the airmass limit, or empty if it does not.
+    :type rise_time: datetime
+
+    :param set_time: The time at which the target sets above the airmass limit, or empty if it does not.
+    :type set_time: datetime
+
+    :param transit_time: The time at which the target crosses the meridian.
+    :type transit_time: datetime
+
+    :param hours_observable: The number of hours during which the target is below the airmass limit while the sun is
+        below astronomical twilight.
+    :type hours_observable: float
+    """
+    target = models.ForeignKey(Target, on_delete=models.CASCADE, related_name='observability')
+    site = models.CharField(max_length=100)
+    night = models.DateField()
+    airmass_limit = models.FloatField()
+    rise_time = models.DateTimeField(null=True, blank=True)
+    set_time = models.DateTimeField(null=True, blank=True)
+    transit_time = models.DateTimeField()
+    hours_observable = models.FloatField()
+
+    class Meta:
+        unique_together = ('target', 'site', 'night', 'airmass_limit')
+        indexes = [
+            models.Index(fields=['site', 'night', 'airmass_limit', 'hours_observable'],
+                         name='tom_targets_observable_idx'),
+        ]
+
+    def __str__(self):
+        return '{0} from {1} on {2}'.format(self.target, self.site, self.night)
@@ -0,0 +1,24 @@
+import re
+
+# Transient designations are published with or without an "SN" or "AT" prefix depending on classification, so the
+# prefix is dropped when it is followed by the discovery year.
+TRANSIENT_PREFIX = re.compile(r'^(?:sn|at)(?=\d{4})')
+# Characters that are used inconsistently to separate the parts of a name, as in "ZTF 20aaaaaaa" or "PGC_012626"
+SEPARATORS = re.compile(r'[\s_]+')
+
+
+def normalize_name(name):
+    """
+    Returns the canonical form of a target name or alias, under which differently written versions of the same
+    designation compare equal. The name is case folded, separating whitespace and underscores are removed, and "SN"
+    and "AT" prefixes in front of a year are dropped, so that "SN 2020abc", "AT2020abc" and "2020ABC" all normalize to
+    "2020abc", and "ZTF 20aaaaaaa" to "ztf20aaaaaaa".
+
+    :param name: Target name or alias
+    :type name: str
+
+    :returns: normalized name
+    :rtype: str
+    """
+    name = SEPARATORS.sub('', str(name).casefold())
+    return TRANSIENT_PREFIX.sub('', name)
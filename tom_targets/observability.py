@@ -0,0 +1,201 @@
+from datetime import datetime, timedelta, timezone
+import logging
+
+from django.conf import settings
+from django.db import transaction
+import numpy as np
+
+from tom_observations.utils import (
+    EPHEMERIS_RESOLUTION, TWILIGHT_ALTITUDE, get_airmasses, get_all_observing_sites, get_sun_altitudes, get_time_grid
+)
+from tom_targets.astrometry import julian_year, target_positions
+from tom_targets.models import Target, TargetObservability
+
+logger = logging.getLogger(__name__)
+
+try:
+    OBSERVABILITY_AIRMASS_LIMITS = settings.OBSERVABILITY_AIRMASS_LIMITS
+except AttributeError:
+    OBSERVABILITY_AIRMASS_LIMITS = [1.5, 2, 3]
+
+# Number of targets whose airmasses are held in memory at once
+OBSERVABILITY_CHUNK_SIZE = 1000
+
+
+def night_window(site_details, night):
+    """
+    Returns the window within which a night at a site falls, from local noon on the date of the night to local noon
+    the next day, using the mean solar time at the site.
+
+    :param site_details: site details with a longitude in degrees
+    :type site_details: dict
+
+    :param night: local date at the site on which the night starts
+    :type night: date
+
+    :returns: start and end of the window in UTC
+    :rtype: tuple
+    """
+    start = datetime(night.year, night.month, night.day, 12, tzinfo=timezone.utc)
+    start -= timedelta(hours=site_details['longitude'] / 15)
+    return start, start + timedelta(days=1)
+
+
+def current_night(site_details, now=None):
+    """
+    Returns the local date on which the night under way, or the coming night if it is day, started at a site.
+
+    :param site_details: site details with a longitude in degrees
+    :type site_details: dict
+
+    :param now: time to find the night of, defaults to the current time
+    :type now: datetime
+
+    :rtype: date
+    """
+    now = now or datetime.now(timezone.utc)
+    return (now + timedelta(hours=site_details['longitude'] / 15 - 12)).date()
+
+
+def _first_crossings(crossings, datetimes):
+    """
+    :returns: for each row of ``crossings``, the time after its first crossing, or None if there is none
+    :rtype: list
+    """
+    indices = crossings.argmax(axis=1) + 1
+    return [datetimes[i] if found else None for i, found in zip(indices, crossings.any(axis=1))]
+
+
+def compute_observability(targets, sites, night, airmass_limits=None):
+    """
+    Calculates the observability of sidereal targets, moved along their proper motions, from each site during a
+    night, for each airmass limit. The airmasses of all targets are calculated at once for each site, at intervals of
+    ``EPHEMERIS_RESOLUTION`` minutes, using the cached sun tables of the site.
+
+    :param targets: sidereal targets with coordinates
+    :type targets: list
+
+    :param sites: observing sites keyed by label
+    :type sites: dict
+
+    :param night: local date on which the night starts
+    :type night: date
+
+    :param airmass_limits: airmass limits to calculate the observability for, defaults to
+        ``OBSERVABILITY_AIRMASS_LIMITS``
+    :type airmass_limits: list
+
+    :returns: unsaved ``TargetObservability`` objects
+    :rtype: list
+    """
+    airmass_limits = airmass_limits or OBSERVABILITY_AIRMASS_LIMITS
+    observability = []
+    if not targets:
+        return observability
+    for label, site_details in sites.items():
+        times = get_time_grid(*night_window(site_details, night), EPHEMERIS_RESOLUTION)
+        datetimes = [time.replace(tzinfo=timezone.utc) for time in times.datetime]
+        dark = get_sun_altitudes([site_details], times)[0] <= TWILIGHT_ALTITUDE
+        ra, dec = target_positions(targets, julian_year(night_window(site_details, night)[0]))
+        with np.errstate(divide='ignore'):
+            sin_altitudes = 1 / get_airmasses(ra, dec, [site_details], times)[:, 0, :]
+        transits = [datetimes[i] for i in sin_altitudes.argmax(axis=1)]
+        for limit in airmass_limits:
+            above = sin_altitudes >= 1 / limit
+            rises = _first_crossings(~above[:, :-1] & above[:, 1:], datetimes)
+            sets = _first_crossings(above[:, :-1] & ~above[:, 1:], datetimes)
+            hours = (above & dark).sum(axis=1) * EPHEMERIS_RESOLUTION / 60
+            observability += [
+                TargetObservability(
+                    target=target, site=label, night=night, airmass_limit=limit, rise_time=rise_time,
+                    set_time=set_time, transit_time=transit_time, hours_observable=float(target_hours)
+                ) for target, rise_time, set_time, transit_time, target_hours in zip(
+                    targets, rises, sets, transits, hours
+                )
+            ]
+    return observability
+
+
+def update_observability(targets=None, nights=1, start=None, sites=None, force=False):
+    """
+    Stores the observability of sidereal targets from all observing sites for a number of nights, in chunks of
+    ``OBSERVABILITY_CHUNK_SIZE`` targets. Unless ``force`` is given, targets that already have observability stored
+    for a site and night are skipped, so that only new targets are calculated.
+
+    :param targets: sidereal targets to calculate, defaults to all sidereal targets with valid coordinates
+    :type targets: QuerySet
+
+    :param nights: number of nights to calculate
+    :type nights: int
+
+    :param start: date of the first night, defaults to the current night at each site
+    :type start: date
+
+    :param sites: observing sites keyed by label, defaults to the sites of all facilities
+    :type sites: dict
+
+    :param force: whether to recalculate observability that is already stored
+    :type force: bool
+
+    :returns: number of ``TargetObservability`` rows stored
+    :rtype: int
+    """
+    if targets is None:
+        targets = Target.objects.all()
+    targets = targets.filter(type=Target.SIDEREAL, ra__isnull=False, dec__gte=-90, dec__lte=90)
+    targets = targets.only('id', 'ra', 'dec', 'pm_ra', 'pm_dec', 'epoch')
+    if sites is None:
+        sites = get_all_observing_sites()
+    stored = 0
+    for label, site_details in sites.items():
+        first_night = start or current_night(site_details)
+        for night in (first_night + timedelta(days=i) for i in range(nights)):
+            existing = TargetObservability.objects.filter(site=label, night=night)
+            pending = targets if force else targets.exclude(pk__in=existing.values('target_id'))
+            ids = list(pending.values_list('id', flat=True))
+            for i in range(0, len(ids), OBSERVABILITY_CHUNK_SIZE):
+                chunk = list(targets.filter(pk__in=ids[i:i + OBSERVABILITY_CHUNK_SIZE]))
+                rows = compute_observability(chunk, {label: site_details}, night)
+                with transaction.atomic():
+                    existing.filter(target__in=chunk).delete()
+                    TargetObservability.objects.bulk_create(rows)
+                stored += len(rows)
+    return stored
+
+
+def recalculate_observability(target_id):
+    """
+    Recalculates the stored observability of a ``Target`` for the nights and sites it is stored for.
+
+    :param target_id: primary key of the target
+    :type target_id: int
+    """
+    instance = Target.objects.filter(pk=target_id).first()
+    if instance is None:
+        return
+    stored = TargetObservability.objects.filter(target=instance)
+    nights = {}
+    for site, night in stored.values_list('site', 'night').distinct():
+        nights.setdefault(night, set()).add(site)
+    if not nights:
+        return
+    stored.delete()
+    if instance.type != Target.SIDEREAL or instance.ra is None or instance.dec is None or abs(instance.dec) > 90:
+        return
+    sites = get_all_observing_sites()
+    rows = []
+    for night, labels in nights.items():
+        rows += compute_observability([instance], {label: sites[label] for label in labels if label in sites}, night)
+    TargetObservability.objects.bulk_create(rows)
+
+
+def target_coordinates_changed(sender, instance, created, **kwargs):
+    """
+    Signal receiver that recalculates the stored observability of a ``Target`` whose coordinates or proper motion
+    have changed. The recalculation runs once the save has been committed, so it does not hold the transaction open,
+    but it still runs in the thread that saved the target.
+    """
+    if created or not instance.coordinates_changed():
+        return
+    target_id = instance.pk
+    transaction.on_commit(lambda: recalculate_observability(target_id))
@@ -0,0 +1,145 @@
+import math
+
+from django.db.models import ExpressionWrapper, F, FloatField, Q, Value
+from django.db.models.functions import ACos, Cos, Degrees, Greatest, Least, Radians, Sin
+
+# The sky is divided into declination zones of ZONE_HEIGHT degrees, each of which is divided into
+# CELLS_PER_ZONE cells of equal width in right ascension. A cell is identified by a single integer,
+# zone * CELLS_PER_ZONE + ra_cell, so that any interval of right ascension within a zone maps to a
+# contiguous range of cell numbers that can be answered from an ordinary database index.
+ZONE_HEIGHT = 0.5
+ZONE_COUNT = int(180 / ZONE_HEIGHT)
+CELLS_PER_ZONE = int(360 / ZONE_HEIGHT)
+
+# Beyond this radius (in degrees) the candidate cell ranges stop being selective, and the exact separation test is
+# applied on its own.
+MAX_INDEXED_RADIUS = 30
+
+
+def _zone(dec):
+    return min(max(int(math.floor((dec + 90) / ZONE_HEIGHT)), 0), ZONE_COUNT - 1)
+
+
+def _ra_cell(ra):
+    return min(int(math.floor((ra % 360) / ZONE_HEIGHT)), CELLS_PER_ZONE - 1)
+
+
+def sky_cell(ra, dec):
+    """
+    Returns the spatial index cell containing the given position.
+
+    :param ra: Right Ascension, in degrees.
+    :type ra: float
+
+    :param dec: Declination, in degrees.
+    :type dec: float
+
+    :returns: cell number, or None if either coordinate is missing
+    :rtype: int
+    """
+    if ra is None or dec is None:
+        return None
+    return _zone(float(dec)) * CELLS_PER_ZONE + _ra_cell(float(ra))
+
+
+def sky_cell_ranges(ra, dec, radius):
+    """
+    Returns the ranges of spatial index cells that together cover a cone on the sky. Every position within ``radius``
+    degrees of the center falls in one of the ranges, but the ranges may also contain positions outside of the cone.
+
+    :param ra: Right Ascension of the cone center, in degrees.
+    :type ra: float
+
+    :param dec: Declination of the cone center, in degrees.
+    :type dec: float
+
+    :param radius: Radius of the cone, in degrees.
+    :type radius: float
+
+    :returns: sorted list of inclusive (first cell, last cell) tuples
+    :rtype: list
+    """
+    ra = ra % 360
+    dec_min = max(dec - radius, -90)
+    dec_max = min(dec + radius, 90)
+
+    if abs(dec) + radius >= 90:
+        # The cone contains a pole, so every right ascension is covered
+        ra_intervals = [(0, CELLS_PER_ZONE - 1)]
+    else:
+        half_width = math.degrees(math.asin(min(math.sin(math.radians(radius)) / math.cos(math.radians(dec)), 1)))
+        if half_width >= 180 - ZONE_HEIGHT:
+            ra_intervals = [(0, CELLS_PER_ZONE - 1)]
+        elif ra - half_width < 0:
+            ra_intervals = [(0, _ra_cell(ra + half_width)), (_ra_cell(ra - half_width + 360), CELLS_PER_ZONE - 1)]
+        elif ra + half_width >= 360:
+            ra_intervals = [(0, _ra_cell(ra + half_width - 360)), (_ra_cell(ra - half_width), CELLS_PER_ZONE - 1)]
+        else:
+            ra_intervals = [(_ra_cell(ra - half_width), _ra_cell(ra + half_width))]
+
+    ranges = []
+    for zone in range(_zone(dec_min), _zone(dec_max) + 1):
+        for first, last in ra_intervals:
+            first, last = zone * CELLS_PER_ZONE + first, zone * CELLS_PER_ZONE + last
+            if ranges and ranges[-1][1] + 1 >= first:
+                ranges[-1] = (ranges[-1][0], last)
+            else:
+                ranges.append((first, last))
+    return ranges
+
+
+def separation_expression(ra, dec, ra_field='ra', dec_field='dec'):
+    """
+    Returns a database expression for the great-circle distance, in degrees, between a fixed position and the position
+    stored in the given fields.
+
+    :param ra: Right Ascension of the fixed position, in degrees.
+    :type ra: float
+
+    :param dec: Declination of the fixed position, in degrees.
+    :type dec: float
+
+    :returns: expression evaluating to the separation in degrees
+    :rtype: django.db.models.Expression
+    """
+    ra, dec = math.radians(float(ra)), math.radians(float(dec))
+    cos_separation = (
+        Value(math.sin(dec)) * Sin(Radians(F(dec_field))) +
+        Value(math.cos(dec)) * Cos(Radians(F(dec_field))) * Cos(Radians(F(ra_field)) - Value(ra))
+    )
+    # Rounding can push the cosine of very small separations just past 1, outside of the domain of ACos
+    return ExpressionWrapper(
+        Degrees(ACos(Least(Greatest(cos_separation, Value(-1.0)), Value(1.0)))), output_field=FloatField()
+    )
+
+
+def cone_search(queryset, ra, dec, radius, ra_field='ra', dec_field='dec', cell_field='sky_cell'):
+    """
+    Filters a queryset down to the rows within ``radius`` degrees of a position. Candidates are first narrowed to the
+    spatial index cells covering the cone, and the exact great-circle separation is then tested on those candidates.
+    The result is annotated with the ``separation``, in degrees.
+
+    :param queryset: queryset of objects with sky positions, usually ``Target`` objects
+    :type queryset: QuerySet
+
+    :param ra: Right Ascension of the cone center, in degrees.
+    :type ra: float
+
+    :param dec: Declination of the cone center, in degrees.
+    :type dec: float
+
+    :param radius: Radius of the cone, in degrees.
+    :type radius: float
+
+    :returns: filtered queryset
+    :rtype: QuerySet
+    """
+    ra, dec, radius = float(ra), float(dec), float(radius)
+    if radius < MAX_INDEXED_RADIUS:
+        candidates = Q()
+        for first, last in sky_cell_ranges(ra, dec, radius):
+            candidates |= Q(**{f'{cell_field}__gte': first, f'{cell_field}__lte': last})
+        queryset = queryset.filter(candidates)
+    return queryset.annotate(
+        separation=separation_expression(ra, dec, ra_field=ra_field, dec_field=dec_field)
+    ).filter(separation__lte=radius)
@@ -1,5 +1,10 @@
+import hashlib
+
 from django import template
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Max
+from django.db.models.functions import Floor
 from dateutil.parser import parse
 from plotly import offline
 import plotly.graph_objs as go
@@ -8,10 +13,21 @@ from astropy.coordinates import Angle
 
 from tom_targets.models import Target, TargetExtra, TargetList
 from tom_targets.forms import TargetVisibilityForm
-from tom_observations.utils import get_sidereal_visibility
+from tom_observations.orbits import has_orbital_elements
+from tom_observations.utils import get_visibility
 
 register = template.Library()
 
+try:
+    TARGET_DISTRIBUTION_DENSITY_THRESHOLD = settings.TARGET_DISTRIBUTION_DENSITY_THRESHOLD
+except AttributeError:
+    TARGET_DISTRIBUTION_DENSITY_THRESHOLD = 5000
+
+# Width and height, in degrees, of the sky cells that targets are counted in above the density threshold
+TARGET_DISTRIBUTION_BIN_SIZE = 2
+# Number of seconds a rendered distribution plot is kept in the cache
+TARGET_DISTRIBUTION_CACHE_TIMEOUT = 3600
+
 
 @register.inclusion_tag('tom_targets/partials/recent_targets.html')
 def recent_targets(limit=10):
@@ -54,12 +70,15 @@ def target_groups(target):
 def target_plan(context):
     """
     Displays form and renders plot for visibility calculation. Using this templatetag to render a plot requires that
-    the context of the parent view have values for start_time, end_time, and airmass.
+    the context of the parent view have values for start_time, end_time, and airmass. Non-sidereal targets without a
+    supported scheme and all of its orbital elements get an explanation instead.
     """
     request = context['request']
+    target = context['object']
+    supported = target.type == Target.SIDEREAL or has_orbital_elements(target)
     plan_form = TargetVisibilityForm()
     visibility_graph = ''
-    if all(request.GET.get(x) for x in ['start_time', 'end_time']):
+    if supported and all(request.GET.get(x) for x in ['start_time', 'end_time']):
         plan_form = TargetVisibilityForm({
             'start_time': request.GET.get('start_time'),
             'end_time': request.GET.get('end_time'),
@@ -73,7 +92,7 @@ def target_plan(context):
                 airmass_limit = float(request.GET.get('airmass'))
             else:
                 airmass_limit = None
-            visibility_data = get_sidereal_visibility(context['object'], start_time, end_time, 10, airmass_limit)
+            visibility_data = get_visibility(context['object'], start_time, end_time, 10, airmass_limit)
             plot_data = [
                 go.Scatter(x=data[0], y=data[1], mode='lines', name=site) for site, data in visibility_data.items()
             ]
@@ -83,26 +102,89 @@ def target_plan(context):
             )
     return {
         'form': plan_form,
-        'target': context['object'],
+        'target': target,
+        'supported': supported,
         'visibility_graph': visibility_graph
     }
 
 
-@register.inclusion_tag('tom_targets/partials/target_distribution.html')
-def target_distribution(targets):
+def _binned_locations(targets):
     """
-    Displays a plot showing on a map the locations of all sidereal targets in the TOM.
+    Counts the targets in each cell of an RA/Dec grid with cells of ``TARGET_DISTRIBUTION_BIN_SIZE`` degrees, in a
+    single grouped query.
+
+    :returns: lists of the cell center longitudes, cell center latitudes and target counts of all non-empty cells
+    :rtype: tuple
     """
-    locations = targets.filter(type=Target.SIDEREAL).values_list('ra', 'dec', 'name')
-    data = [
-        dict(
-            lon=[l[0] for l in locations],
-            lat=[l[1] for l in locations],
-            text=[l[2] for l in locations],
+    bins = Target.objects.filter(
+        pk__in=targets.values('pk'), ra__isnull=False, dec__isnull=False
+    ).annotate(
+        ra_bin=Floor(F('ra') / TARGET_DISTRIBUTION_BIN_SIZE),
+        dec_bin=Floor((F('dec') + 90) / TARGET_DISTRIBUTION_BIN_SIZE)
+    ).order_by().values('ra_bin', 'dec_bin').annotate(count=Count('pk'))
+    lon, lat, counts = [], [], []
+    for cell in bins:
+        lon.append((cell['ra_bin'] + 0.5) * TARGET_DISTRIBUTION_BIN_SIZE)
+        lat.append(min((cell['dec_bin'] + 0.5) * TARGET_DISTRIBUTION_BIN_SIZE - 90, 90))
+        counts.append(cell['count'])
+    return lon, lat, counts
+
+
+def _distribution_trace(targets, count):
+    """
+    Builds the plot trace of the targets for ``target_distribution``, either as one marker per target or, above
+    ``TARGET_DISTRIBUTION_DENSITY_THRESHOLD`` targets, as one marker per sky cell colored by the number of targets in
+    it.
+
+    :returns: trace and plot title
+    :rtype: tuple
+    """
+    if count > TARGET_DISTRIBUTION_DENSITY_THRESHOLD:
+        lon, lat, counts = _binned_locations(targets)
+        trace = dict(
+            lon=lon,
+            lat=lat,
+            text=[f'{count} targets' for count in counts],
             hoverinfo='lon+lat+text',
             mode='markers',
+            marker=dict(color=counts, colorscale='Viridis', showscale=True, symbol='square'),
             type='scattergeo'
-        ),
+        )
+        return trace, 'Target Distribution (sidereal, {}° bins)'.format(TARGET_DISTRIBUTION_BIN_SIZE)
+
+    locations = targets.values_list('ra', 'dec', 'name')
+    trace = dict(
+        lon=[l[0] for l in locations],
+        lat=[l[1] for l in locations],
+        text=[l[2] for l in locations],
+        hoverinfo='lon+lat+text',
+        mode='markers',
+        type='scattergeo'
+    )
+    return trace, 'Target Distribution (sidereal)'
+
+
+@register.inclusion_tag('tom_targets/partials/target_distribution.html')
+def target_distribution(targets):
+    """
+    Displays a plot showing on a map the locations of all sidereal targets in the TOM. Above
+    ``TARGET_DISTRIBUTION_DENSITY_THRESHOLD`` targets, the targets are counted per sky cell in the database and the
+    counts are plotted instead of the individual targets. The plotted data is cached for each distinct query, and is
+    recomputed when the number of matching targets or their latest modification time changes.
+    """
+    sidereal = targets.filter(type=Target.SIDEREAL)
+    summary = sidereal.aggregate(count=Count('pk'), last_modified=Max('modified'))
+    sql, params = sidereal.query.sql_with_params()
+    cache_key = 'target_distribution_data_{}'.format(hashlib.md5(
+        repr((sql, params, summary['count'], summary['last_modified'])).encode()
+    ).hexdigest())
+    cached = cache.get(cache_key)
+    if cached is None:
+        cached = _distribution_trace(sidereal, summary['count'])
+        cache.set(cache_key, cached, TARGET_DISTRIBUTION_CACHE_TIMEOUT)
+    targets_trace, title = cached
+    data = [
+        targets_trace,
         dict(
             lon=list(range(0, 360, 60))+[180]*4,
             lat=[0]*6+[-60, -30, 30, 60],
@@ -113,7 +195,7 @@ def target_distribution(targets):
         )
     ]
     layout = {
-        'title': 'Target Distribution (sidereal)',
+        'title': title,
         'hovermode': 'closest',
         'showlegend': False,
         'geo': {
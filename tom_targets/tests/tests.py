@@ -1,16 +1,74 @@
 import pytz
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest import mock
 
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth.models import User, Group
+from django.contrib.messages import get_messages
+from django.core.files.uploadedfile import SimpleUploadedFile
+from astropy import units as u
+from astropy.coordinates import SkyCoord, get_sun
+from astropy.time import Time
 
 from .factories import SiderealTargetFactory, NonSiderealTargetFactory, TargetGroupingFactory, TargetNameFactory
-from tom_targets.models import Target, TargetExtra, TargetList, TargetName
-from tom_targets.utils import import_targets
+from tom_targets.models import Target, TargetExtra, TargetIdentifier, TargetList, TargetName, TargetObservability
+from tom_targets.names import normalize_name
+from tom_targets.observability import compute_observability, current_night, update_observability
+from tom_dataproducts.models import DataProduct
+from tom_observations.models import ObservationRecord
+from tom_observations.tests.utils import FakeFacility
+from tom_observations.utils import get_targets_visibility
+from tom_targets.astrometry import current_positions, propagate_positions, refresh_current_positions
+from tom_targets.crossmatch import TargetCrossMatcher, get_crossmatcher
+from tom_targets.spatial import cone_search, sky_cell, sky_cell_ranges
+from tom_targets.templatetags.targets_extras import target_distribution
+from tom_targets.utils import export_targets, import_targets
 from guardian.shortcuts import assign_perm
 
 
+class TestTargetList(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='testuser')
+        self.client.force_login(self.user)
+
+    def create_targets(self, count):
+        for i in range(count):
+            target = SiderealTargetFactory.create()
+            assign_perm('tom_targets.view_target', self.user, target)
+            TargetNameFactory.create(name='alias{}-{}'.format(count, i), target=target)
+            ObservationRecord.objects.create(target=target, facility='Fake', parameters='{}', observation_id=str(i))
+            DataProduct.objects.create(target=target, product_id='{}-{}'.format(count, i))
+
+    def get_query_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('targets:list'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_target_list_counts(self):
+        self.create_targets(2)
+        target = Target.objects.first()
+        ObservationRecord.objects.create(target=target, facility='Fake', parameters='{}', observation_id='extra')
+        _, response = self.get_query_count()
+        page = {t.id: t for t in response.context['object_list']}
+        self.assertEqual(page[target.id].observation_count, 2)
+        self.assertEqual(page[target.id].data_product_count, 1)
+        self.assertContains(response, target.aliases.first().name)
+
+    def test_target_list_query_count_independent_of_page_size(self):
+        self.create_targets(2)
+        small_page_queries, _ = self.get_query_count()
+        self.create_targets(20)
+        large_page_queries, response = self.get_query_count()
+        self.assertEqual(len(response.context['object_list']), 22)
+        self.assertEqual(small_page_queries, large_page_queries)
+
+
 class TestTargetDetail(TestCase):
     def setUp(self):
         user = User.objects.create(username='testuser')
@@ -27,6 +85,9 @@ class TestTargetDetail(TestCase):
     def test_non_sidereal_target_detail(self):
         response = self.client.get(reverse('targets:detail', kwargs={'pk': self.nst.id}))
         self.assertContains(response, self.nst.id)
+        # The target has no scheme, so its visibility cannot be plotted
+        self.assertContains(response, 'Airmass plotting for non-sidereal targets requires')
+        self.assertNotContains(response, 'value="Plan"')
 
     @override_settings(EXTRA_FIELDS=[
         {'name': 'somefield', 'type': 'string'},
@@ -189,6 +250,21 @@ class TestTargetCreate(TestCase):
         target.save(extras={'foo': 5})
         self.assertTrue(TargetExtra.objects.filter(target=target, key='foo', value='5').exists())
 
+    def test_target_save_upserts_extras_and_names(self):
+        target = SiderealTargetFactory.create()
+        target.save(extras={'foo': 5, 'bar': 'baz'}, names=['alias1'])
+        extras = {'field{}'.format(i): i for i in range(30)}
+        extras.update({'foo': 6, 'bar': 'baz'})
+        # Savepoint, target update, extras lookup, insert and update, aliases lookup and insert, alias primary key
+        # lookup and normalized name insert, release
+        with self.assertNumQueries(10):
+            target.save(extras=extras, names=['alias1', 'alias2'])
+        self.assertEqual(TargetExtra.objects.filter(target=target).count(), 32)
+        foo = TargetExtra.objects.get(target=target, key='foo')
+        self.assertEqual((foo.value, foo.float_value), ('6', 6))
+        self.assertEqual(TargetExtra.objects.get(target=target, key='field3').float_value, 3)
+        self.assertEqual(sorted(target.aliases.values_list('name', flat=True)), ['alias1', 'alias2'])
+
     def test_non_sidereal_required_fields(self):
         base_data = {
             'name': 'nonsidereal_target',
@@ -374,6 +450,120 @@ class TestTargetImport(TestCase):
             for alias in aliases[target_name].split(','):
                 self.assertTrue(TargetName.objects.filter(target=target, name=alias).exists())
 
+    def test_import_reports_errors_per_line(self):
+        SiderealTargetFactory.create(name='m27')
+        csv = [
+            'name,type,ra,dec,name2',
+            'm13,SIDEREAL,250.421,36.459,Tom',
+            'm27,SIDEREAL,299.901,22.721,',
+            'm31,SIDEREAL,notanumber,41.269,',
+            'm42,SIDEREAL,83.822,-5.391,Tom',
+            'm13,SIDEREAL,250.421,36.459,',
+            'm57,SIDEREAL,283.396,33.029,'
+        ]
+        result = import_targets(csv, chunk_size=2)
+        self.assertEqual([target.name for target in result['targets']], ['m13', 'm57'])
+        self.assertEqual(len(result['errors']), 4)
+        for line, error in zip([3, 4, 5, 6], result['errors']):
+            self.assertTrue(error.startswith('Error on line {}:'.format(line)))
+        self.assertEqual(Target.objects.get(name='m57').sky_cell, sky_cell(283.396, 33.029))
+
+    @override_settings(EXTRA_FIELDS=[{'name': 'redshift', 'type': 'number'}])
+    def test_import_dry_run(self):
+        csv = [
+            'name,type,ra,dec,redshift,name2',
+            'm13,SIDEREAL,250.421,36.459,5,Tom',
+            'm13,SIDEREAL,250.421,36.459,5,',
+        ]
+        with self.assertNumQueries(2):
+            result = import_targets(csv, dry_run=True)
+        self.assertEqual(len(result['targets']), 1)
+        self.assertEqual(len(result['errors']), 1)
+        self.assertFalse(Target.objects.exists())
+
+    def test_import_uses_bulk_queries(self):
+        csv = ['name,type,ra,dec,redshift,name2'] + [
+            't{0},SIDEREAL,{0},0,5,alias{0}'.format(i) for i in range(50)
+        ]
+        # Name lookups, then a bulk insert per model and primary key lookups for targets and aliases, inside a
+        # transaction
+        with self.assertNumQueries(11):
+            result = import_targets(csv)
+        self.assertEqual(len(result['targets']), 50)
+        self.assertEqual(TargetExtra.objects.filter(key='redshift', float_value=5).count(), 50)
+        self.assertEqual(TargetName.objects.count(), 50)
+
+    @mock.patch('tom_targets.crossmatch._crossmatcher', None)
+    def test_imported_targets_are_cross_matched(self):
+        SiderealTargetFactory.create(name='existing', ra=10, dec=10)
+        matcher = get_crossmatcher()
+        self.assertEqual(len(matcher), 1)
+        # TestCase never commits, so run the callbacks at once
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func()) as on_commit:
+            import_targets(['name,type,ra,dec', 'm13,SIDEREAL,250.421,36.459', 'm27,SIDEREAL,299.901,22.721'])
+        self.assertEqual(on_commit.call_count, 1)
+        target_ids, _ = matcher.nearest([250.421, 299.901], [36.459, 22.721], 1)
+        self.assertEqual(list(target_ids), list(Target.objects.filter(name__in=['m13', 'm27']).order_by('name')
+                                                .values_list('id', flat=True)))
+
+    def test_import_rejects_derived_fields(self):
+        result = import_targets(['name,type,ra,dec,current_ra,current_dec,current_epoch',
+                                 'm13,SIDEREAL,250.421,36.459,10,10,2025'])
+        self.assertEqual(result['targets'], [])
+        self.assertIn('current_ra is calculated from the target coordinates', result['errors'][0])
+        self.assertFalse(Target.objects.exists())
+
+    def test_import_view_dry_run(self):
+        target_csv = SimpleUploadedFile('targets.csv', b'name,type,ra,dec\nm13,SIDEREAL,250.421,36.459\n')
+        response = self.client.post(reverse('targets:import'), {'target_csv': target_csv, 'dry_run': 'on'})
+        self.assertRedirects(response, reverse('targets:import'), fetch_redirect_response=False)
+        self.assertFalse(Target.objects.exists())
+
+
+class TestTargetExport(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='testuser')
+        self.client.force_login(user)
+        self.st = SiderealTargetFactory.create(name='m13')
+        assign_perm('tom_targets.view_target', user, self.st)
+        TargetExtra.objects.create(target=self.st, key='redshift', value='5')
+        TargetNameFactory.create(name='Tom', target=self.st)
+        TargetNameFactory.create(name='Joe', target=self.st)
+        self.nst = SiderealTargetFactory.create(name='m27')
+
+    def test_export_csv(self):
+        lines = ''.join(export_targets(Target.objects.all())).splitlines()
+        header = lines[0].split(',')
+        self.assertNotIn('id', header)
+        self.assertNotIn('sky_cell', header)
+        self.assertNotIn('current_ra', header)
+        self.assertNotIn('current_epoch', header)
+        self.assertEqual(header[-3:], ['redshift', 'name2', 'name3'])
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith('m13,'))
+        self.assertTrue(lines[1].endswith(',5,Tom,Joe'))
+        self.assertTrue(lines[2].endswith(',,,'))
+
+    def test_export_without_aliases(self):
+        lines = ''.join(export_targets(Target.objects.filter(name='m27'))).splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertNotIn('name2', lines[0])
+        self.assertNotIn('redshift', lines[0])
+
+    @mock.patch('tom_targets.utils.EXPORT_CHUNK_SIZE', 1)
+    def test_export_queries_per_chunk(self):
+        # Header queries, then a query per chunk plus prefetches for extras and aliases, and one final empty chunk
+        with self.assertNumQueries(2 + 3 * 2 + 1):
+            lines = list(export_targets(Target.objects.all()))
+        self.assertEqual(len(lines), 3)
+
+    def test_export_view_streams(self):
+        response = self.client.get(reverse('targets:export'))
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('m13', content)
+        self.assertIn('Tom', content)
+
 
 class TestTargetSearch(TestCase):
     def setUp(self):
@@ -402,6 +592,15 @@ class TestTargetSearch(TestCase):
         self.assertContains(response, '1337target')
         self.assertNotContains(response, '1309Target')
 
+    def test_search_name_substring(self):
+        TargetNameFactory.create(name='SN 1987A', target=self.st)
+
+        response = self.client.get(reverse('targets:list') + '?name=1987')
+        self.assertContains(response, '1337target')
+
+        response = self.client.get(reverse('targets:list') + '?name=essier')
+        self.assertContains(response, '1337target')
+
     @override_settings(EXTRA_FIELDS=[{'name': 'color', 'type': 'string'}])
     def test_search_extra_fields(self):
         TargetExtra.objects.create(target=self.st, key='color', value='red')
@@ -426,8 +625,27 @@ class TestTargetSearch(TestCase):
         response = self.client.get(reverse('targets:list') + '?checked=3')
         self.assertContains(response, '1337target')
 
+    @override_settings(EXTRA_FIELDS=[
+        {'name': 'redshift', 'type': 'number'},
+        {'name': 'checked', 'type': 'boolean'},
+        {'name': 'color', 'type': 'string'},
+    ])
+    def test_search_combined_extra_fields(self):
+        assign_perm('tom_targets.view_target', self.user, self.target2)
+        self.st.save(extras={'redshift': 0.5, 'checked': True, 'color': 'red'})
+        self.target2.save(extras={'redshift': 2, 'checked': True, 'color': 'red'})
+
+        response = self.client.get(reverse('targets:list') + '?redshift_min=0.1&checked=2&color=red')
+        self.assertEqual(list(response.context['object_list']), [self.st, self.target2])
+
+        response = self.client.get(reverse('targets:list') + '?redshift_min=1&checked=2&color=red')
+        self.assertEqual(list(response.context['object_list']), [self.target2])
+
+        response = self.client.get(reverse('targets:list') + '?redshift_max=1&color=blue')
+        self.assertEqual(list(response.context['object_list']), [])
+
     def test_cone_search_coordinates(self):
-        response = self.client.get(reverse('targets:list') + '?cone_search=83,-5,0.8')
+        response = self.client.get(reverse('targets:list') + '?cone_search=83,-5,1')
         self.assertContains(response, '1337target')
         self.assertNotContains(response, 'Target1309')
 
@@ -436,10 +654,293 @@ class TestTargetSearch(TestCase):
         cone_search_failure = Target.objects.create(name='Failed Search', ra=82, dec=-6)
         assign_perm('tom_targets.view_target', self.user, cone_search_target)
         assign_perm('tom_targets.view_target', self.user, cone_search_failure)
-        response = self.client.get(reverse('targets:list') + '?target_cone_search=1337target,0.8')
+        response = self.client.get(reverse('targets:list') + '?target_cone_search=1337target,1')
         self.assertContains(response, 'Cone Search')
         self.assertNotContains(response, 'Failed Search')
 
+    def test_cone_search_radius_in_degrees(self):
+        # 1337target is 0.91 degrees from the center of the search
+        response = self.client.get(reverse('targets:list') + '?cone_search=83,-5,0.9')
+        self.assertNotContains(response, '1337target')
+
+
+class TestTargetNameResolution(TestCase):
+    def setUp(self):
+        self.target = SiderealTargetFactory.create(name='AT2020abc')
+        self.alias = TargetNameFactory.create(name='ZTF20aaaaaaa', target=self.target)
+        self.other = SiderealTargetFactory.create(name='M42')
+
+    def test_normalize_name(self):
+        self.assertEqual(normalize_name('SN 2020abc'), '2020abc')
+        self.assertEqual(normalize_name(' at2020ABC'), '2020abc')
+        self.assertEqual(normalize_name('ZTF 20aaaaaaa'), 'ztf20aaaaaaa')
+        self.assertEqual(normalize_name('PGC_012626'), 'pgc012626')
+        self.assertEqual(normalize_name('SNR G1.9+0.3'), 'snrg1.9+0.3')
+
+    def test_resolve(self):
+        self.assertEqual(list(Target.objects.resolve('SN 2020abc')), [self.target])
+        self.assertEqual(list(Target.objects.resolve('ztf 20AAAAAAA')), [self.target])
+        self.assertEqual(list(Target.objects.resolve('m 42')), [self.other])
+        self.assertFalse(Target.objects.resolve('2020ab').exists())
+        self.assertEqual(list(Target.objects.resolve('2020ab', prefix=True)), [self.target])
+        self.assertEqual(list(Target.objects.resolve('20ab', contains=True)), [self.target])
+
+    def test_index_follows_changes(self):
+        self.target.name = 'SN2021xyz'
+        self.target.save()
+        self.alias.name = 'ZTF21bbbbbbb'
+        self.alias.save()
+        self.assertEqual(list(Target.objects.resolve('2021xyz')), [self.target])
+        self.assertEqual(list(Target.objects.resolve('ztf21bbbbbbb')), [self.target])
+        self.assertFalse(Target.objects.resolve('2020abc').exists())
+        self.alias.delete()
+        self.assertFalse(Target.objects.resolve('ztf21bbbbbbb').exists())
+        self.assertEqual(TargetIdentifier.objects.filter(target=self.target).count(), 1)
+
+    def test_bulk_paths_are_indexed(self):
+        self.other.save(names=['Orion Nebula'])
+        import_targets(['name,type,ra,dec,name2', 'SN 2019xyz,SIDEREAL,10,10,Gaia19abc'])
+        self.assertEqual(list(Target.objects.resolve('orionnebula')), [self.other])
+        imported = Target.objects.get(name='SN 2019xyz')
+        self.assertEqual(list(Target.objects.resolve('AT2019xyz')), [imported])
+        self.assertEqual(list(Target.objects.resolve('gaia19abc')), [imported])
+
+
+class TestSkyCellIndex(TestCase):
+    def setUp(self):
+        positions = [(0.1, 0), (359.9, 0.2), (180, 45), (181.5, 45.5), (10, 89.8), (190, 89.7), (45, -89.9),
+                     (300, -30), (302, -30)]
+        self.targets = [SiderealTargetFactory.create(ra=ra, dec=dec) for ra, dec in positions]
+
+    def test_sky_cell_maintained_on_save(self):
+        target = self.targets[0]
+        self.assertEqual(target.sky_cell, sky_cell(0.1, 0))
+        target.ra, target.dec = 120, -10
+        target.save()
+        target.refresh_from_db()
+        self.assertEqual(target.sky_cell, sky_cell(120, -10))
+
+    def test_cone_search_matches_exact_separation(self):
+        for ra, dec, radius in [(0, 0, 0.5), (180, 45, 2), (100, 89, 2), (0, -89, 1), (301, -30, 1.5),
+                                (181, 45, 0.1)]:
+            center = SkyCoord(ra, dec, unit='deg')
+            expected = {t.id for t in self.targets
+                        if center.separation(SkyCoord(t.ra, t.dec, unit='deg')).deg <= radius}
+            found = set(cone_search(Target.objects.all(), ra, dec, radius).values_list('id', flat=True))
+            self.assertEqual(found, expected)
+
+    def test_sky_cell_ranges_cover_cone(self):
+        for first, last in zip(sky_cell_ranges(359.9, 0, 1), sky_cell_ranges(359.9, 0, 1)[1:]):
+            self.assertLess(first[1], last[0])
+        for ra, dec in [(0.5, 0.5), (359.5, -0.5)]:
+            cell = sky_cell(ra, dec)
+            self.assertTrue(any(first <= cell <= last for first, last in sky_cell_ranges(359.9, 0, 1)))
+
+
+class TestTargetCrossMatch(TestCase):
+    def setUp(self):
+        self.t1 = SiderealTargetFactory.create(name='t1', ra=359.9999, dec=10)
+        self.t2 = SiderealTargetFactory.create(name='t2', ra=150, dec=-45)
+        self.t3 = SiderealTargetFactory.create(name='t3', ra=150.001, dec=-45)
+        self.matcher = TargetCrossMatcher()
+
+    def test_match_within_radius(self):
+        queries, target_ids, separations = self.matcher.match([0.0001, 150, 20], [10, -45, 20], 5)
+        self.assertEqual(list(queries), [0, 1, 1])
+        self.assertEqual(list(target_ids), [self.t1.id, self.t2.id, self.t3.id])
+        self.assertAlmostEqual(separations[0], 0.709, places=3)
+        self.assertAlmostEqual(separations[1], 0)
+
+    def test_nearest(self):
+        target_ids, separations = self.matcher.nearest([150.0009, 20], [-45, 20], 10)
+        self.assertEqual(list(target_ids), [self.t3.id, -1])
+        self.assertTrue(separations[1] != separations[1])  # NaN
+
+    @mock.patch('tom_targets.crossmatch._crossmatcher', None)
+    def test_incremental_updates(self):
+        matcher = get_crossmatcher()
+        self.assertEqual(len(matcher), 3)
+        self.t2.ra = 10
+        with mock.patch('django.db.transaction.on_commit') as on_commit:
+            self.t2.save()
+            self.t3.delete()
+        # The index is only updated once the changes are committed
+        self.assertEqual(len(matcher), 3)
+        with mock.patch('tom_targets.observability.recalculate_observability'):
+            for call in on_commit.call_args_list:
+                call[0][0]()
+        with self.assertNumQueries(1):
+            _, target_ids, _ = matcher.match([150, 10], [-45, -45], 5)
+        self.assertEqual(list(target_ids), [self.t2.id])
+        self.assertEqual(len(matcher), 2)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestProperMotion(TestCase):
+    def setUp(self):
+        # Barnard's star, which moves over 10 arcseconds a year
+        self.barnard = SiderealTargetFactory.create(name='barnard', ra=269.452075, dec=4.693391, pm_ra=-802.803,
+                                                    pm_dec=10362.542, epoch=2000)
+        self.still = SiderealTargetFactory.create(name='still', ra=10, dec=10, pm_ra=None, pm_dec=None, epoch=None)
+
+    def test_propagate_matches_astropy(self):
+        coordinate = SkyCoord(self.barnard.ra * u.deg, self.barnard.dec * u.deg,
+                              pm_ra_cosdec=self.barnard.pm_ra * u.mas / u.yr, pm_dec=self.barnard.pm_dec * u.mas / u.yr,
+                              distance=1.83 * u.pc, radial_velocity=0 * u.km / u.s, obstime=Time('J2000'))
+        expected = coordinate.apply_space_motion(new_obstime=Time('J2025'))
+        ra, dec = propagate_positions([self.barnard.ra], [self.barnard.dec], [self.barnard.pm_ra],
+                                      [self.barnard.pm_dec], [2451545.0], 2025)
+        self.assertAlmostEqual(ra[0], expected.ra.deg, places=7)
+        self.assertAlmostEqual(dec[0], expected.dec.deg, places=7)
+
+    def test_current_positions(self):
+        with self.assertNumQueries(1):
+            ids, ra, dec = current_positions(Target.objects.all(), 2025)
+        self.assertEqual(list(ids), [self.barnard.id, self.still.id])
+        self.assertAlmostEqual((dec[0] - self.barnard.dec) * 3600, 259.06, places=2)
+        self.assertAlmostEqual(ra[1], 10)
+        self.assertAlmostEqual(dec[1], 10)
+
+    @mock.patch('tom_targets.crossmatch._crossmatcher', None)
+    def test_refresh_current_positions(self):
+        matcher = get_crossmatcher()
+        self.assertEqual(list(matcher.nearest([self.barnard.ra], [self.barnard.dec], 1)[0]), [self.barnard.id])
+        out = StringIO()
+        # TestCase never commits, so run the callbacks at once
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func()) as on_commit:
+            call_command('updatepositions', epoch=2025, stdout=out)
+        self.assertEqual(on_commit.call_count, 1)
+        self.assertIn('Updated the positions of 2 targets', out.getvalue())
+        self.barnard.refresh_from_db()
+        self.assertEqual(self.barnard.current_epoch, 2025)
+        self.assertEqual(self.barnard.sky_cell, sky_cell(self.barnard.current_ra, self.barnard.current_dec))
+        current_ra, current_dec = self.barnard.current_ra, self.barnard.current_dec
+
+        self.assertEqual(list(matcher.nearest([current_ra], [current_dec], 1)[0]), [self.barnard.id])
+        self.assertEqual(list(cone_search(Target.objects.all(), current_ra, current_dec, 0.001)), [])
+        user = User.objects.create(username='testuser')
+        self.client.force_login(user)
+        assign_perm('tom_targets.view_target', user, self.barnard)
+        response = self.client.get(reverse('targets:list'),
+                                   {'cone_search': '{0},{1},0.001'.format(current_ra, current_dec)})
+        self.assertEqual(list(response.context['filter'].qs), [self.barnard])
+
+        # Saving keeps the cached position at its epoch in step with the catalog position
+        self.barnard.pm_dec = 0
+        self.barnard.save()
+        self.assertAlmostEqual(self.barnard.current_dec, self.barnard.dec, places=4)
+        self.assertEqual(refresh_current_positions(Target.objects.filter(pk=self.still.pk), 2030), 1)
+
+
+class TestTargetDistribution(TestCase):
+    def setUp(self):
+        SiderealTargetFactory.create(name='m13', ra=250.421, dec=36.459)
+        SiderealTargetFactory.create(name='m92', ra=259.281, dec=43.136)
+        SiderealTargetFactory.create(name='m31', ra=10.685, dec=41.269)
+        NonSiderealTargetFactory.create(name='ceres')
+
+    def test_markers_below_threshold(self):
+        figure = target_distribution(Target.objects.all())['figure']
+        self.assertIn('m13', figure)
+        self.assertNotIn('ceres', figure)
+
+    @mock.patch('tom_targets.templatetags.targets_extras.TARGET_DISTRIBUTION_DENSITY_THRESHOLD', 2)
+    @mock.patch('tom_targets.templatetags.targets_extras.TARGET_DISTRIBUTION_BIN_SIZE', 20)
+    def test_binned_above_threshold(self):
+        figure = target_distribution(Target.objects.all())['figure']
+        self.assertNotIn('m13', figure)
+        self.assertIn('"2 targets"', figure)
+        self.assertIn('"1 targets"', figure)
+
+    def test_cached_per_query(self):
+        target_distribution(Target.objects.all())
+        target_distribution(Target.objects.filter(name='m13'))
+        with self.assertNumQueries(1):
+            figure = target_distribution(Target.objects.filter(name='m13'))['figure']
+        self.assertNotIn('m31', figure)
+        SiderealTargetFactory.create(name='m57', ra=283.396, dec=33.029)
+        self.assertIn('m57', target_distribution(Target.objects.all())['figure'])
+
+
+@override_settings(
+    TOM_FACILITY_CLASSES=['tom_observations.tests.utils.FakeFacility'],
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class TestTargetObservability(TestCase):
+    def setUp(self):
+        self.site = '(FakeFacility) Siding Spring'
+        self.sites = {self.site: FakeFacility().get_observing_sites()['Siding Spring']}
+        sun = get_sun(Time.now())
+        self.night_target = SiderealTargetFactory.create(ra=(sun.ra.deg + 180) % 360, dec=-sun.dec.deg, pm_ra=0,
+                                                         pm_dec=0)
+        self.day_target = SiderealTargetFactory.create(ra=sun.ra.deg, dec=sun.dec.deg, pm_ra=0, pm_dec=0)
+
+    def test_compute_observability_matches_visibility(self):
+        night = date(2019, 10, 9)
+        sun = get_sun(Time(datetime(2019, 10, 9, 13)))
+        target = Target(ra=(sun.ra.deg + 180) % 360, dec=-sun.dec.deg, type=Target.SIDEREAL)
+        rows = compute_observability([target], self.sites, night, airmass_limits=[2])
+        self.assertEqual(len(rows), 1)
+        start = datetime(2019, 10, 9, 2, 3, 43, tzinfo=pytz.utc)
+        visibility = get_targets_visibility([target], start, start + timedelta(days=1), 10, 2, self.sites)[0]
+        airmasses = visibility[self.site][1]
+        self.assertAlmostEqual(rows[0].hours_observable, sum(a is not None for a in airmasses) / 6)
+        self.assertGreater(rows[0].hours_observable, 6)
+        self.assertLess(rows[0].rise_time, rows[0].transit_time)
+        self.assertLess(rows[0].transit_time, rows[0].set_time)
+
+    def test_update_observability(self):
+        stored = update_observability(sites=self.sites)
+        self.assertEqual(stored, 2 * 3)
+        self.assertEqual(update_observability(sites=self.sites), 0)
+        target = SiderealTargetFactory.create(ra=10, dec=-20)
+        SiderealTargetFactory.create(dec=100)
+        self.assertEqual(update_observability(sites=self.sites), 3)
+        self.assertEqual(update_observability(Target.objects.filter(pk=target.pk), sites=self.sites, force=True), 3)
+        self.assertEqual(TargetObservability.objects.count(), 3 * 3)
+
+    def test_coordinates_change_recalculates(self):
+        update_observability(sites=self.sites)
+        night = TargetObservability.objects.get(target=self.night_target, airmass_limit=2)
+        with mock.patch('django.db.transaction.on_commit') as on_commit:
+            self.night_target.save()
+        on_commit.assert_not_called()
+        self.assertEqual(TargetObservability.objects.get(target=self.night_target, airmass_limit=2).pk, night.pk)
+        self.night_target.ra = (self.night_target.ra + 90) % 360
+        with mock.patch('django.db.transaction.on_commit') as on_commit:
+            self.night_target.save()
+        # The recalculation waits for the save to be committed
+        self.assertEqual(TargetObservability.objects.get(target=self.night_target, airmass_limit=2).pk, night.pk)
+        self.assertEqual(on_commit.call_count, 1)
+        on_commit.call_args[0][0]()
+        changed = TargetObservability.objects.get(target=self.night_target, airmass_limit=2)
+        self.assertNotEqual(changed.transit_time, night.transit_time)
+        self.assertEqual(TargetObservability.objects.filter(target=self.night_target).count(), 3)
+
+    def test_proper_motion_change_recalculates(self):
+        update_observability(sites=self.sites)
+        self.night_target.pm_dec = 10000
+        with mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func()) as on_commit:
+            self.night_target.save()
+        self.assertEqual(on_commit.call_count, 1)
+        self.assertEqual(TargetObservability.objects.filter(target=self.night_target).count(), 3)
+
+    def test_filter_observable_tonight(self):
+        user = User.objects.create(username='testuser')
+        self.client.force_login(user)
+        assign_perm('tom_targets.view_target', user, self.night_target)
+        assign_perm('tom_targets.view_target', user, self.day_target)
+        update_observability(sites=self.sites)
+        self.assertTrue(TargetObservability.objects.filter(
+            night=current_night(self.sites[self.site]), target=self.night_target
+        ).exists())
+        response = self.client.get(reverse('targets:list'), {'observable_tonight': f'{self.site}, 2.5, 2'})
+        self.assertEqual(list(response.context['filter'].qs), [self.night_target])
+        response = self.client.get(reverse('targets:list'), {'observable_tonight': f'{self.site}, 1.2, 2'})
+        self.assertEqual(list(response.context['filter'].qs), [])
+        response = self.client.get(reverse('targets:list'), {'observable_tonight': 'Unknown, 2, 2'})
+        self.assertEqual(list(response.context['filter'].qs), [])
+
 
 class TestTargetGrouping(TestCase):
     def setUp(self):
@@ -609,6 +1110,57 @@ class TestTargetAddRemoveGrouping(TestCase):
         self.client.post(reverse('targets:add-remove-grouping'), data=data)
         self.assertEqual(self.fake_grouping.targets.count(), 0)
 
+    def test_add_all_messages(self):
+        forbidden = SiderealTargetFactory.create()
+        data = {
+            'grouping': self.fake_grouping.id,
+            'add': True,
+            'isSelectAll': 'True',
+            'selected-target': [],
+            'query_string': 'type=SIDEREAL',
+        }
+        response = self.client.post(reverse('targets:add-remove-grouping'), data=data)
+        messages = [str(message) for message in get_messages(response.wsgi_request)]
+        self.assertEqual(len(messages), 3)
+        self.assertTrue(messages[0].startswith('2 target(s) successfully added'))
+        self.assertTrue(messages[1].startswith('1 target(s) already in group'))
+        self.assertIn(forbidden.name, messages[2])
+        self.assertNotIn(forbidden, self.fake_grouping.targets.all())
+
+    def test_remove_selected_invalid_ids(self):
+        data = {
+            'grouping': self.fake_grouping.id,
+            'remove': True,
+            'isSelectAll': 'False',
+            'selected-target': [self.fake_targets[0].id, self.fake_targets[1].id, 0],
+            'query_string': '',
+        }
+        response = self.client.post(reverse('targets:add-remove-grouping'), data=data)
+        messages = [str(message) for message in get_messages(response.wsgi_request)]
+        self.assertEqual(len(messages), 3)
+        self.assertTrue(messages[0].startswith('1 target(s) successfully removed'))
+        self.assertTrue(messages[2].startswith('Failed to remove target with id=0'))
+        self.assertEqual(self.fake_grouping.targets.count(), 0)
+
+    def test_add_all_query_count_independent_of_target_count(self):
+        data = {
+            'grouping': self.fake_grouping.id,
+            'add': True,
+            'isSelectAll': 'True',
+            'selected-target': [],
+            'query_string': 'type=SIDEREAL',
+        }
+        with CaptureQueriesContext(connection) as few_targets:
+            self.client.post(reverse('targets:add-remove-grouping'), data=data)
+        self.fake_grouping.targets.clear()
+        user = User.objects.get(username='testuser')
+        for i in range(20):
+            assign_perm('tom_targets.view_target', user, SiderealTargetFactory.create())
+        with CaptureQueriesContext(connection) as many_targets:
+            self.client.post(reverse('targets:add-remove-grouping'), data=data)
+        self.assertEqual(self.fake_grouping.targets.count(), 23)
+        self.assertEqual(len(few_targets), len(many_targets))
+
     def test_persist_filter(self):
         data = {'query_string': "type=SIDEREAL&name=B&key=C&value=123&targetlist__name=1"}
         expected_query_dict = {
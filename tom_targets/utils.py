@@ -1,95 +1,256 @@
-from django.db.models import Count
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import DatabaseError, transaction
+from django.db.models import Count, Max, Prefetch
 
 import csv
-from .models import Target, TargetExtra, TargetName
-from io import StringIO
+from .crossmatch import targets_changed
+from .models import Target, TargetExtra, TargetIdentifier, TargetName
+from .spatial import sky_cell
+
+# Number of targets read from the database at a time when exporting
+EXPORT_CHUNK_SIZE = 1000
+
+# Number of rows of an imported CSV that are validated and written together
+IMPORT_CHUNK_SIZE = 1000
+
+# Target fields calculated from the catalog position on save, which are neither exported nor accepted on import
+DERIVED_TARGET_FIELDS = ['sky_cell', 'current_ra', 'current_dec', 'current_epoch']
+
+
+class _Echo:
+    """
+    File-like object that returns what is written to it, so that ``csv.writer`` can produce lines for a streaming
+    response without buffering them.
+    """
+    def write(self, value):
+        return value
 
 
-# NOTE: This saves locally. To avoid this, create file buffer.
-# referenced https://www.codingforentrepreneurs.com/blog/django-queryset-to-csv-files-datasets/
 def export_targets(qs):
     """
-    Exports all the specified targets into a csv file in folder csvTargetFiles
-    NOTE: This saves locally. To avoid this, create file buffer.
+    Exports the specified targets as CSV, one line at a time, so that the result can be streamed to the client.
+
+    Targets are read in chunks of ``EXPORT_CHUNK_SIZE``, with their extras and aliases prefetched, so exporting costs a
+    fixed number of queries per chunk and only one chunk is held in memory at a time.
 
-    :param qs: List of targets to export
+    :param qs: Targets to export
     :type qs: QuerySet
 
-    :returns: String buffer of exported targets
-    :rtype: StringIO
+    :returns: generator of CSV lines, starting with the header
+    :rtype: generator
     """
-    qs_pk = [data['id'] for data in qs]
-    data_list = list(qs)
-    target_fields = [field.name for field in Target._meta.get_fields()]
-    target_extra_fields = list({field.key for field in TargetExtra.objects.filter(target__in=qs_pk)})
-    # Gets the count of the target names for the target with the most aliases in the database
+    target_fields = [
+        field.name for field in Target._meta.concrete_fields if field.name not in ['id'] + DERIVED_TARGET_FIELDS
+    ]
+    target_ids = qs.values('pk')
+    target_extra_fields = list(
+        TargetExtra.objects.filter(target__in=target_ids).order_by('key').values_list('key', flat=True).distinct()
+    )
+    # Gets the count of the target names for the exported target with the most aliases
     # This is to construct enough row headers of format "name2, name3, name4, etc" for exporting aliases
     # The alias headers are then added to the set of fields for export
-    max_alias_count = max([alias['count'] for alias
-                           in TargetName.objects.values('target_id').annotate(count=Count('target_id'))])
+    max_alias_count = TargetName.objects.filter(target__in=target_ids).values('target_id').annotate(
+        count=Count('id')
+    ).aggregate(max_count=Max('count'))['max_count'] or 0
     all_fields = target_fields + target_extra_fields + [f'name{index+1}' for index in range(1, max_alias_count+1)]
-    for key in ['id', 'targetlist', 'dataproduct', 'observationrecord', 'reduceddatum', 'aliases', 'targetextra']:
-        all_fields.remove(key)
-
-    file_buffer = StringIO()
-    writer = csv.DictWriter(file_buffer, fieldnames=all_fields)
-    writer.writeheader()
-    for target_data in data_list:
-        extras = list(TargetExtra.objects.filter(target_id=target_data['id']))
-        names = list(TargetName.objects.filter(target_id=target_data['id']))
-        for e in extras:
-            target_data[e.key] = e.value
-        name_index = 2
-        for name in names:
-            target_data[f'name{str(name_index)}'] = name.name
-            name_index += 1
-        del target_data['id']  # do not export 'id'
-        writer.writerow(target_data)
-    return file_buffer
-
-
-def import_targets(targets):
+
+    writer = csv.DictWriter(_Echo(), fieldnames=all_fields)
+    yield writer.writeheader()
+
+    chunk_queryset = qs.order_by('pk').prefetch_related(
+        'targetextra_set', Prefetch('aliases', queryset=TargetName.objects.order_by('id'))
+    )
+    last_pk = None
+    while True:
+        chunk = chunk_queryset if last_pk is None else chunk_queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk[:EXPORT_CHUNK_SIZE])
+        if not chunk:
+            break
+        for target in chunk:
+            target_data = {field: getattr(target, field) for field in target_fields}
+            for e in target.targetextra_set.all():
+                target_data[e.key] = e.value
+            for name_index, name in enumerate(target.aliases.all(), start=2):
+                target_data[f'name{str(name_index)}'] = name.name
+            yield writer.writerow(target_data)
+        last_pk = chunk[-1].pk
+
+
+def _parse_import_row(row, target_fields):
+    """
+    Splits a row of an imported CSV into ``Target`` field values, ``TargetExtra`` key/value pairs and alias names.
+    Empty values for ``Target`` fields are dropped, as converting an empty string to a number would fail.
+    """
+    fields = {}
+    extras = []
+    names = []
+    for k, v in row.items():
+        if k is None:
+            # Values beyond the header row are collected under a None key by DictReader
+            continue
+        # All fields starting with 'name' (e.g. name2, name3) that aren't literally 'name' will be added as
+        # TargetNames
+        if k != 'name' and k.startswith('name'):
+            if v:
+                names.append(v)
+        elif k not in target_fields:
+            extras.append((k, v))
+        elif v:
+            fields[k] = v
+    return fields, extras, names
+
+
+def _validate_import_row(fields, names, seen_targets, seen_aliases):
+    """
+    Converts the ``Target`` field values of an imported row to their Python types and checks that neither the target
+    name nor the aliases are already taken. Raises ``ValidationError`` describing the first problem found.
+    """
+    for k, v in fields.items():
+        try:
+            field = Target._meta.get_field(k)
+        except FieldDoesNotExist:
+            field = None
+        if field is None or not field.concrete:
+            raise ValidationError('{0} is not a valid target field'.format(k))
+        if k in DERIVED_TARGET_FIELDS:
+            raise ValidationError('{0} is calculated from the target coordinates and cannot be imported'.format(k))
+        try:
+            fields[k] = field.to_python(v)
+        except ValidationError as e:
+            raise ValidationError('{0}: {1}'.format(k, ' '.join(e.messages)))
+    if not fields.get('name'):
+        raise ValidationError('Target name is required')
+    if fields['name'] in seen_targets:
+        raise ValidationError('Target with this Name already exists.')
+    for name in names:
+        if name in seen_aliases or names.count(name) > 1:
+            raise ValidationError('Target name with this Alias for target already exists.')
+
+
+def _write_import_rows(rows):
+    """
+    Writes validated rows with one bulk insert each for targets, extras, aliases and their normalized names.
+    """
+    targets = [target for _, target, _, _ in rows]
+    Target.objects.bulk_create(targets)
+    # Not every database backend returns primary keys from a bulk insert, so look them up by name
+    target_ids = dict(Target.objects.filter(name__in=[t.name for t in targets]).values_list('name', 'id'))
+    target_extras = []
+    target_names = []
+    for _, target, extras, names in rows:
+        target.id = target_ids[target.name]
+        for key, value in extras:
+            target_extra = TargetExtra(target=target, key=key, value=value)
+            target_extra.set_typed_values()
+            target_extras.append(target_extra)
+        target_names.extend(TargetName(target=target, name=name) for name in names)
+    TargetExtra.objects.bulk_create(target_extras)
+    TargetName.objects.bulk_create(target_names)
+    TargetIdentifier.objects.index(targets=targets, aliases=target_names)
+    # Bulk inserts send no post_save signal, so the cross-match index is told about the new targets directly
+    transaction.on_commit(lambda: targets_changed(target_ids.values()))
+
+
+def _import_chunk(chunk, seen_targets, seen_aliases, dry_run):
+    """
+    Validates and, unless ``dry_run`` is set, writes a chunk of rows from an imported CSV. ``seen_targets`` and
+    ``seen_aliases`` hold the names used by earlier rows of the same import, and are updated with the names of the
+    valid rows in this chunk.
+
+    :returns: the valid ``Target`` objects, and the errors for the remaining rows
+    :rtype: tuple
+    """
+    errors = []
+    target_fields = [field.name for field in Target._meta.get_fields()]
+    parsed = [(line, *_parse_import_row(row, target_fields)) for line, row in chunk]
+
+    # Names already in the database are fetched for the whole chunk at once
+    taken_targets = seen_targets | set(Target.objects.filter(
+        name__in=[fields['name'] for _, fields, _, _ in parsed if fields.get('name')]
+    ).values_list('name', flat=True))
+    taken_aliases = seen_aliases | set(TargetName.objects.filter(
+        name__in=[name for _, _, _, names in parsed for name in names]
+    ).values_list('name', flat=True))
+
+    valid_rows = []
+    for line, fields, extras, names in parsed:
+        try:
+            _validate_import_row(fields, names, taken_targets, taken_aliases)
+            target = Target(**fields)
+            target.sky_cell = sky_cell(target.ra, target.dec)
+        except (ValidationError, TypeError, ValueError) as e:
+            message = ' '.join(e.messages) if isinstance(e, ValidationError) else str(e)
+            errors.append((line, message))
+            continue
+        for taken, seen, new_names in [(taken_targets, seen_targets, [target.name]),
+                                       (taken_aliases, seen_aliases, names)]:
+            taken.update(new_names)
+            seen.update(new_names)
+        valid_rows.append((line, target, extras, names))
+
+    if dry_run or not valid_rows:
+        return [target for _, target, _, _ in valid_rows], errors
+
+    try:
+        with transaction.atomic():
+            _write_import_rows(valid_rows)
+        targets = [target for _, target, _, _ in valid_rows]
+    except DatabaseError:
+        # Something not caught by validation, such as a conflicting write from another process, failed the chunk.
+        # Retry the rows one at a time so that the failure can be attributed to the right lines.
+        targets = []
+        for row in valid_rows:
+            row[1].pk = None
+            try:
+                with transaction.atomic():
+                    _write_import_rows([row])
+                targets.append(row[1])
+            except DatabaseError as e:
+                errors.append((row[0], str(e)))
+    return targets, errors
+
+
+def import_targets(targets, dry_run=False, chunk_size=IMPORT_CHUNK_SIZE):
     """
     Imports a set of targets into the TOM and saves them to the database.
 
-    :param targets: String buffer of targets
-    :type targets: StringIO
+    The CSV is read as a stream and processed in chunks of ``chunk_size`` rows. Each chunk is validated with a couple of
+    queries, then written with a single bulk insert each for targets, extras and aliases. Rows that fail validation are
+    reported by line number and do not prevent the remaining rows from being imported.
+
+    :param targets: CSV lines, such as an open text file or a list of strings
+    :type targets: iterable
+
+    :param dry_run: If True, validates every row and reports errors without writing anything to the database
+    :type dry_run: bool
+
+    :param chunk_size: Number of rows to validate and write at a time
+    :type chunk_size: int
 
     :returns: dictionary of successfully imported targets, as well errors
     :rtype: dict
     """
-    # TODO: Replace this with an in memory iterator
     targetreader = csv.DictReader(targets, dialect=csv.excel)
-    targets = []
+    imported = []
     errors = []
-    base_target_fields = [field.name for field in Target._meta.get_fields()]
+    seen_targets = set()
+    seen_aliases = set()
+    chunk = []
+
+    def flush():
+        chunk_targets, chunk_errors = _import_chunk(chunk, seen_targets, seen_aliases, dry_run)
+        imported.extend(chunk_targets)
+        errors.extend(chunk_errors)
+        chunk.clear()
+
     for index, row in enumerate(targetreader):
-        # filter out empty values in base fields, otherwise converting empty string to float will throw error
-        row = {k: v for (k, v) in row.items() if not (k in base_target_fields and not v)}
-        target_extra_fields = []
-        target_names = []
-        target_fields = {}
-        for k in row:
-            # All fields starting with 'name' (e.g. name2, name3) that aren't literally 'name' will be added as
-            # TargetNames
-            if k != 'name' and k.startswith('name'):
-                target_names.append(row[k])
-            elif k not in base_target_fields:
-                target_extra_fields.append((k, row[k]))
-            else:
-                target_fields[k] = row[k]
-        for extra in target_extra_fields:
-            row.pop(extra[0])
-        try:
-            target = Target.objects.create(**target_fields)
-            for extra in target_extra_fields:
-                TargetExtra.objects.create(target=target, key=extra[0], value=extra[1])
-            for name in target_names:
-                if name:
-                    TargetName.objects.create(target=target, name=name)
-            targets.append(target)
-        except Exception as e:
-            error = 'Error on line {0}: {1}'.format(index + 2, str(e))
-            errors.append(error)
-
-    return {'targets': targets, 'errors': errors}
+        chunk.append((index + 2, row))
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+
+    return {
+        'targets': imported,
+        'errors': ['Error on line {0}: {1}'.format(line, error) for line, error in sorted(errors)]
+    }
@@ -1,3 +1,4 @@
+import codecs
 import logging
 
 from datetime import datetime
@@ -9,6 +10,8 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import Group
 from django.core.management import call_command
 from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.http import QueryDict, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.urls import reverse_lazy, reverse
@@ -34,6 +37,8 @@ from tom_targets.filters import TargetFilter
 from tom_targets.groups import add_all_to_grouping, add_selected_to_grouping
 from tom_targets.groups import remove_all_from_grouping, remove_selected_from_grouping
 from tom_dataproducts.forms import DataProductUploadForm
+from tom_dataproducts.models import DataProduct
+from tom_observations.models import ObservationRecord
 
 logger = logging.getLogger(__name__)
 
@@ -49,6 +54,30 @@ class TargetListView(PermissionListMixin, FilterView):
     filterset_class = TargetFilter
     permission_required = 'tom_targets.view_target'
 
+    @staticmethod
+    def _count_per_target(model):
+        counts = model.objects.filter(target=OuterRef('pk')).order_by().values('target').annotate(
+            count=Count('pk')
+        ).values('count')
+        return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        Paginates the filtered targets, then annotates the targets on the current page with their numbers of
+        observations and data products and prefetches their aliases. The page is therefore rendered with a fixed
+        number of queries, whatever its size, and the counts are only computed for the targets that are displayed.
+
+        :returns: paginator, page, targets on the page, and whether the results are paginated
+        :rtype: tuple
+        """
+        paginator, page, object_list, is_paginated = super().paginate_queryset(queryset, page_size)
+        object_list = object_list.annotate(
+            observation_count=self._count_per_target(ObservationRecord),
+            data_product_count=self._count_per_target(DataProduct)
+        ).prefetch_related('aliases')
+        page.object_list = object_list
+        return paginator, page, object_list, is_paginated
+
     def get_context_data(self, *args, **kwargs):
         """
         Adds the number of targets visible, the available ``TargetList`` objects if the user is authenticated, and
@@ -359,20 +388,29 @@ class TargetImportView(LoginRequiredMixin, TemplateView):
 
     def post(self, request):
         """
-        Handles the POST requests to this view. Creates a StringIO object and passes it to ``import_targets``.
+        Handles the POST requests to this view. Streams the uploaded CSV to ``import_targets``. If ``dry_run`` is set,
+        the CSV is only validated, and the user is returned to the import page to see the errors.
 
         :param request: the request object passed to this view
         :type request: HTTPRequest
         """
         csv_file = request.FILES['target_csv']
-        csv_stream = StringIO(csv_file.read().decode('utf-8'), newline=None)
-        result = import_targets(csv_stream)
-        messages.success(
-            request,
-            'Targets created: {}'.format(len(result['targets']))
-        )
+        dry_run = bool(request.POST.get('dry_run'))
+        result = import_targets(codecs.iterdecode(csv_file, 'utf-8'), dry_run=dry_run)
+        if dry_run:
+            messages.info(
+                request,
+                'Dry run complete, no targets were created. Valid targets: {}'.format(len(result['targets']))
+            )
+        else:
+            messages.success(
+                request,
+                'Targets created: {}'.format(len(result['targets']))
+            )
         for error in result['errors']:
             messages.warning(request, error)
+        if dry_run:
+            return redirect(reverse('tom_targets:import'))
         return redirect(reverse('tom_targets:list'))
 
 
@@ -382,7 +420,7 @@ class TargetExportView(TargetListView):
     """
     def render_to_response(self, context, **response_kwargs):
         """
-        Returns a response containing the exported CSV of selected targets.
+        Returns a streaming response containing the exported CSV of selected targets.
 
         :param context: Context object for this view
         :type context: dict
@@ -390,10 +428,7 @@ class TargetExportView(TargetListView):
         :returns: response class with CSV
         :rtype: StreamingHttpResponse
         """
-        qs = context['filter'].qs.values()
-        file_buffer = export_targets(qs)
-        file_buffer.seek(0)  # goto the beginning of the buffer
-        response = StreamingHttpResponse(file_buffer, content_type="text/csv")
+        response = StreamingHttpResponse(export_targets(context['filter'].qs), content_type='text/csv')
         filename = "targets-{}.csv".format(slugify(datetime.utcnow()))
         response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
         return response